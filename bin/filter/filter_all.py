@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+"""
+Write all the filtered csv files for PD source csv files in one pass
+over each source file, see ckanext.canada.filters for the filters
+
+Usage:
+    filter_all.py WORKDIR [SOURCE.csv ...]
+    filter_all.py --output FILTERED.csv < SOURCE.csv > FILTERED.csv
+"""
+
+from ckanext.canada.filters import main
+
+main()
@@ -1,44 +0,0 @@
-#!/usr/bin/env python3
-
-"""
-Script that takes csv on stdin with Year, Month as the first two columns
-and outputs the header row and all rows within the past two years on stdout
-"""
-
-import csv
-import sys
-
-start_year_month = 2020, 1  # publicly accessible records
-
-REMOVE_COLUMNS = [
-    'record_created',
-    'record_modified',
-    'user_modified',
-]
-
-BOM = "\N{bom}"
-
-def main():
-    bom = sys.stdin.read(1)  # first code point
-    if not bom:
-        # empty file -> empty file
-        return
-    assert bom == BOM
-    sys.stdout.write(BOM)
-
-
-    reader = csv.DictReader(sys.stdin)
-    outnames = [f for f in reader.fieldnames if f not in REMOVE_COLUMNS]
-    writer = csv.DictWriter(sys.stdout, outnames)
-    writer.writeheader()
-    for row in reader:
-        try:
-            for rem in REMOVE_COLUMNS:
-                del row[rem]
-
-            if (int(row['year']), int(row['month'])) >= start_year_month:
-                writer.writerow(row)
-        except ValueError:
-            pass
-
-main()
@@ -1,35 +0,0 @@
-#!/usr/bin/env python3
-
-import csv
-import sys
-
-REMOVE_COLUMNS = [
-    'record_created',
-    'record_modified',
-    'user_modified',
-]
-
-BOM = "\N{bom}"
-
-def main():
-    bom = sys.stdin.read(1)  # first code point
-    if not bom:
-        # empty file -> empty file
-        return
-    assert bom == BOM
-    sys.stdout.write(BOM)
-
-    reader = csv.DictReader(sys.stdin)
-    outnames = ['owner_org'] + [f for f in reader.fieldnames
-        if f not in REMOVE_COLUMNS and f != 'owner_org']
-    writer = csv.DictWriter(sys.stdout, outnames)
-    writer.writeheader()
-    for row in reader:
-        try:
-            for rem in REMOVE_COLUMNS:
-                del row[rem]
-            writer.writerow(row)
-        except ValueError:
-            pass
-
-main()
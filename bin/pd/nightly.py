@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Runs the nightly stages of the PD Makefile for every PD type in
+parallel, instead of make nightly:
+
+    dump -> filter -> upload -> rebuild     for each PD type
+    dump of every PD type -> backup
+
+PD types come from the Makefile targets and their resources from the
+ckanext/canada/tables yaml files. A stage that still fails after the
+retries skips the remaining stages of its PD type without stopping the
+other types, and the backup is skipped when a dump failed. The backup
+is also skipped when only some PD types are given: backup-all would dump
+every other type one at a time. Times and file sizes are reported for
+every stage.
+
+The make processes running at the same time share the workdir but not
+their targets: the dump, filter, upload and rebuild targets of a PD type
+only depend on the csv files of its own resources, and backup-all only
+starts once every dump is finished, when the dumped files it depends on
+are up to date. The filtered directory is created before any stage.
+
+With --manifest the sha256 digests of the files of each PD type are
+kept after it is published, and the upload and rebuild stages are
+skipped when the files have not changed since. Use --report to list
+the manifest.
+
+Uses the same environment variables as the Makefile, run with
+$REGISTRY_PYTHON_COMMAND.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import yaml
+
+from ckanext.canada.filters import FILTERS
+
+MAKEFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Makefile')
+TABLES_DIR = os.path.join(
+    os.path.dirname(MAKEFILE), '..', '..', 'ckanext', 'canada', 'tables')
+
+STAGES = ['dump', 'filter', 'upload', 'rebuild']
+
+
+def make(workdir, targets, log=None):
+    """
+    Run the Makefile targets in workdir, returns the make output when
+    log is None, otherwise writes it to the log file object
+    """
+    command = ['make', '-f', MAKEFILE, '--no-print-directory',
+               'workdir=' + workdir] + targets
+    if log is None:
+        return subprocess.check_output(command, universal_newlines=True)
+    log.write(' '.join(command) + '\n')
+    log.flush()
+    return subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+
+
+def pd_types(workdir):
+    """
+    Return [(dataset type, [resource name, ...]), ...] for the Makefile
+    targets, in Makefile order
+    """
+    resources = {}
+    for name in sorted(os.listdir(TABLES_DIR)):
+        if not name.endswith('.yaml'):
+            continue
+        with open(os.path.join(TABLES_DIR, name)) as f:
+            geno = yaml.safe_load(f)
+        resources[geno['dataset_type']] = [
+            r['resource_name'] for r in geno['resources']]
+    return [
+        (t, resources.get(t, []))
+        for t in make(workdir, ['list-targets']).split()]
+
+
+def stage_targets(workdir, stage, resource_names):
+    """
+    Return the Makefile targets for a stage of a PD type
+    """
+    if stage == 'dump':
+        return [os.path.join(workdir, r + '.csv') for r in resource_names]
+    if stage == 'filter':
+        return [
+            os.path.join(workdir, 'filtered', r + '.filtered')
+            for r in resource_names if r + '.csv' in FILTERS]
+    return []
+
+
+def stage_paths(workdir, stage, resource_names):
+    """
+    Return the paths of the files written by a stage of a PD type
+    """
+    if stage == 'dump':
+        return [os.path.join(workdir, r + '.csv') for r in resource_names]
+    if stage == 'filter':
+        return [
+            os.path.join(workdir, 'filtered', spec['output'])
+            for r in resource_names
+            for spec in FILTERS.get(r + '.csv', [])]
+    return []
+
+
+def stage_bytes(workdir, stage, resource_names):
+    """
+    Return the size of the files written by a stage, or None
+    """
+    if stage not in ('dump', 'filter'):
+        return None
+    return sum(
+        os.path.getsize(p)
+        for p in stage_paths(workdir, stage, resource_names)
+        if os.path.exists(p))
+
+
+def file_digests(workdir, paths):
+    """
+    Return {path relative to workdir: {"sha256": hex digest, "bytes": size}}
+    for paths
+    """
+    digests = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        digests[os.path.relpath(path, workdir)] = {
+            'sha256': sha.hexdigest(),
+            'bytes': os.path.getsize(path),
+        }
+    return digests
+
+
+class Manifest(object):
+    """
+    Digests of the dumped and filtered files of each PD type when it was
+    last published, kept in a json file between nightly runs
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+        self.lock = threading.Lock()
+
+    def unchanged(self, pd_type, files):
+        entry = self.entries.get(pd_type)
+        return bool(self.path and entry and entry['files'] == files)
+
+    def published(self, pd_type, files):
+        if not self.path:
+            return
+        with self.lock:
+            self.entries[pd_type] = {
+                'files': files,
+                'published': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(self.path + '.tmp', self.path)
+
+    def report(self):
+        for pd_type in sorted(self.entries):
+            entry = self.entries[pd_type]
+            print('{0:16s} published {1}'.format(pd_type, entry['published']))
+            for name in sorted(entry['files']):
+                print('    {0:36s} {1[bytes]:>12d} bytes  {1[sha256]}'.format(
+                    name, entry['files'][name]))
+
+
+class Nightly(object):
+    def __init__(self, workdir, log_dir, retries, retry_delay,
+                 manifest, force=False):
+        self.workdir = workdir
+        self.manifest = manifest
+        self.force = force
+        self.log_dir = log_dir
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.results = []
+        self.lock = threading.Lock()
+
+    def run_stage(self, name, stage, targets, resource_names=()):
+        """
+        Run targets for stage, retrying when they fail
+
+        :returns: True when the stage succeeded
+        """
+        start = time.time()
+        log_path = os.path.join(self.log_dir, '{0}-{1}.log'.format(
+            name, stage))
+        with open(log_path, 'w') as log:
+            for attempt in range(1, self.retries + 2):
+                if attempt > 1:
+                    time.sleep(self.retry_delay)
+                if not make(self.workdir, targets, log):
+                    status = 'ok'
+                    break
+            else:
+                status = 'failed'
+        self.report(name, stage, status, time.time() - start,
+                    stage_bytes(self.workdir, stage, resource_names),
+                    attempt)
+        if status == 'failed':
+            with open(log_path) as log:
+                sys.stderr.write('{0} {1} failed:\n{2}'.format(
+                    name, stage, ''.join(log.readlines()[-20:])))
+        return status == 'ok'
+
+    def run_type(self, pd_type, resource_names, dumped):
+        """
+        Run all the stages of a PD type, set dumped after the dump stage
+        """
+        failed = False
+        unchanged = False
+        stage = STAGES[0]
+        try:
+            for stage in STAGES:
+                if stage == 'upload' and not failed:
+                    files = file_digests(
+                        self.workdir,
+                        stage_paths(self.workdir, 'dump', resource_names) +
+                        stage_paths(self.workdir, 'filter', resource_names))
+                    unchanged = not self.force and self.manifest.unchanged(
+                        pd_type, files)
+                if failed:
+                    self.report(pd_type, stage, 'skipped')
+                elif unchanged:
+                    self.report(pd_type, stage, 'unchanged')
+                else:
+                    targets = stage_targets(
+                        self.workdir, stage, resource_names) or (
+                        [stage + '-' + pd_type]
+                        if stage in ('upload', 'rebuild') else [])
+                    if targets:
+                        failed = not self.run_stage(
+                            pd_type, stage, targets, resource_names)
+                if stage == 'dump':
+                    dumped.set()
+            if not failed and not unchanged:
+                self.manifest.published(pd_type, files)
+        except Exception:
+            self.report(pd_type, stage, 'failed')
+            raise
+        finally:
+            # never leave the backup waiting
+            dumped.set()
+
+    def run_backup(self, dumped):
+        """
+        Run backup-all once all the dump stages are finished, unless one
+        of them failed: make would otherwise run the failed dump again
+        """
+        for event in dumped:
+            event.wait()
+        with self.lock:
+            dump_failed = any(
+                r['stage'] == 'dump' and r['status'] == 'failed'
+                for r in self.results)
+        if dump_failed:
+            self.report('all', 'backup', 'skipped')
+            return
+        try:
+            self.run_stage('all', 'backup', ['backup-all'])
+        except Exception:
+            traceback.print_exc()
+            self.report('all', 'backup', 'failed')
+
+    def report(self, name, stage, status, seconds=0.0, size=None,
+               attempts=0):
+        with self.lock:
+            self.results.append({
+                'type': name,
+                'stage': stage,
+                'status': status,
+                'seconds': round(seconds, 3),
+                'bytes': size,
+                'attempts': attempts,
+            })
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the nightly PD Makefile stages for all PD types "
+        "in parallel.")
+    parser.add_argument('types', nargs='*', help="PD types, default: all")
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help="PD types run at the same time, default: 4")
+    parser.add_argument('--retries', type=int, default=1,
+                        help="retries for a failed stage, default: 1")
+    parser.add_argument('--retry-delay', type=float, default=60,
+                        help="seconds before a retry, default: 60")
+    parser.add_argument('--staging', action='store_true',
+                        help="skip the backup, like nightly-staging, "
+                        "also skipped when PD types are given")
+    parser.add_argument('--workdir', help="working directory, default: "
+                        "a new temporary directory removed when finished")
+    parser.add_argument('--log-dir', help="stage logs directory, "
+                        "default: WORKDIR/logs")
+    parser.add_argument('--json', help="write the stage results to a file")
+    parser.add_argument('--manifest',
+                        default=os.environ.get('PD_MANIFEST_FILE'),
+                        help="digests of the published files, skip "
+                        "unchanged types, default: $PD_MANIFEST_FILE")
+    parser.add_argument('--force', action='store_true',
+                        help="upload and rebuild unchanged types too")
+    parser.add_argument('--report', action='store_true',
+                        help="list the manifest and exit")
+    args = parser.parse_args()
+
+    manifest = Manifest(args.manifest)
+    if args.report:
+        if not args.manifest:
+            parser.error('--report requires --manifest')
+        manifest.report()
+        return
+
+    workdir = args.workdir
+    if not workdir:
+        workdir = tempfile.mkdtemp(
+            prefix='pdnightly.',
+            dir=os.environ.get('PD_TMP_DIRECTORY') or None)
+    log_dir = args.log_dir or os.path.join(workdir, 'logs')
+    for directory in (log_dir, os.path.join(workdir, 'filtered')):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    start = time.time()
+    try:
+        all_types = pd_types(workdir)
+        types = all_types
+        if args.types:
+            types = [(t, r) for t, r in types if t in args.types]
+        nightly = Nightly(workdir, log_dir, args.retries, args.retry_delay,
+                          manifest, args.force)
+        dumped = [threading.Event() for t in types]
+
+        backup = None
+        if len(types) < len(all_types) and not args.staging:
+            # backup-all depends on the dumps of every PD type
+            nightly.report('all', 'backup', 'skipped')
+        elif not args.staging:
+            backup = threading.Thread(
+                target=nightly.run_backup, args=(dumped,))
+            backup.start()
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [
+                pool.submit(nightly.run_type, pd_type, resource_names, event)
+                for (pd_type, resource_names), event in zip(types, dumped)]
+        for (pd_type, resource_names), future in zip(types, futures):
+            try:
+                future.result()
+            except Exception:
+                # the failed stage was reported by run_type
+                sys.stderr.write('{0} failed:\n'.format(pd_type))
+                traceback.print_exc()
+        if backup:
+            backup.join()
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    order = STAGES + ['backup']
+    nightly.results.sort(key=lambda r: (
+        r['type'] == 'all', r['type'], order.index(r['stage'])))
+    for r in nightly.results:
+        print('{type:16s} {stage:8s} {status:9s} {seconds:9.1f}s {size}'.format(
+            size='' if r['bytes'] is None else '{0} bytes'.format(r['bytes']),
+            **r))
+    print('total {0:.1f}s'.format(time.time() - start))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(nightly.results, f, indent=2)
+    if any(r['status'] == 'failed' for r in nightly.results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,8 +15,8 @@ def get_fieldnames(fields):
 
 def csv_to_dict(csv_file, primary_keys):
     csv_dict = {}
-    with open(csv_file) as f:
-        hashcsv = csv.DictReader(codecs.EncodedFile(f, 'utf-8', 'utf-8-sig'), delimiter=",")
+    with open(csv_file, encoding='utf-8-sig') as f:
+        hashcsv = csv.DictReader(f, delimiter=",")
         for row in hashcsv:
             primary_fields = [str(row[t]) for t in primary_keys]
             uid = '-'.join(primary_fields)
@@ -35,7 +35,7 @@ def compare_dicts(prev, curr):
             added_keys.append(key)
         else:
             for field in curr[key]:
-                if curr[key][field] != prev[key][field]:
+                if curr[key][field] != prev[key].get(field):
                     modified_keys.append(key)
                     break
     return removed_keys, added_keys, modified_keys
@@ -64,41 +64,42 @@ def add_metadata_fields(prev, curr, rkeys, akeys, mkeys, date):
     return results, result_keys
 
 
-prev_csv, current_csv, endpoint, datestamp, outfile = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5]
+def get_field_info(endpoint):
+    return requests.get(endpoint, timeout=100, verify=False).json()
 
-field_info = requests.get(endpoint, timeout=100, verify=False).json()
 
+def diff_csv(prev_csv, current_csv, field_info, datestamp, outfile):
+    # Grab the primary key fields from the datatype reference endpoint
+    current_csv_resource = os.path.basename(current_csv).split('_')[-1].replace('.csv','')
+    pk_fields = [f['primary_key'][0] for f in field_info['resources'] if current_csv_resource == f['resource_name']]
+    fields = [f['fields'] for f in field_info['resources'] if current_csv_resource == f['resource_name']]
+    fieldnames = get_fieldnames(fields[0]).split(",")
 
-# Grab the primary key fields from the datatype reference endpoint
-current_csv_resource = current_csv.split('_')[-1].replace('.csv','')
-pk_fields = [f['primary_key'][0] for f in field_info['resources'] if current_csv_resource == f['resource_name']]
-fields = [f['fields'] for f in field_info['resources'] if current_csv_resource == f['resource_name']]
-fieldnames = get_fieldnames(fields[0]).split(",")
+    pk_fields.append('owner_org')
 
-pk_fields.append('owner_org')
+    old_csv_dict = csv_to_dict(prev_csv, pk_fields)
+    new_csv_dict = csv_to_dict(current_csv, pk_fields)
 
-old_csv_dict = csv_to_dict(prev_csv, pk_fields)
-new_csv_dict = csv_to_dict(current_csv, pk_fields)
+    removed_keys, added_keys, modified_keys = compare_dicts(old_csv_dict, new_csv_dict)
 
-removed_keys, added_keys, modified_keys = compare_dicts(old_csv_dict, new_csv_dict)
+    result_rows, result_keys = add_metadata_fields(old_csv_dict,new_csv_dict,removed_keys,added_keys,modified_keys,datestamp)
 
-result_rows, result_keys = add_metadata_fields(old_csv_dict,new_csv_dict,removed_keys,added_keys,modified_keys,datestamp)
+    exists_flag = 0
+    if os.path.isfile(outfile):
+        exists_flag=1
+    if result_rows:
+        print("writing")
+        with open(outfile, 'a') as f:
+            warehouse = csv.DictWriter(f, fieldnames=fieldnames, delimiter=',', restval='', extrasaction='ignore')
+            if exists_flag == 0:
+                warehouse.writeheader()
+            for row in result_keys:
+                warehouse.writerow(result_rows[row])
 
-exists_flag = 0
-if os.path.isfile(outfile):
-    exists_flag=1
-if result_rows:
-    print("writing")
-    with open(outfile, 'a') as f:
-        warehouse = csv.DictWriter(f, fieldnames=fieldnames, delimiter=',', restval='')
-        if exists_flag == 0:
-            warehouse.writeheader()
-        for row in result_keys:
-            for key in result_rows[row].keys():
-                if not key in fieldnames:
-                    result_rows[row].pop(key)
-            warehouse.writerow(result_rows[row])
-        f.close()
+    else:
+        print("No changes detected between files")
 
-else:
-    print("No changes detected between files")
\ No newline at end of file
+
+if __name__ == '__main__':
+    prev_csv, current_csv, endpoint, datestamp, outfile = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5]
+    diff_csv(prev_csv, current_csv, get_field_info(endpoint), datestamp, outfile)
@@ -5,108 +5,215 @@ Creates Warehouse for all PD-Types found in archived backups.
 Arguments:
 fname - directory of archived backups
 operation - '-d' to compare last 2 backups (default), '-a' to compare all backups.
+
+CSV files are streamed out of the backup archives through their
+migration scripts and the migrated files are cached per backup, so each
+backup is migrated once. Consecutive backups are compared once each and
+compared pairs are recorded, running the script again resumes after the
+last pair written to warehouse_reports. The size of each warehouse CSV is
+recorded before the differences are appended to it, and an interrupted
+append is truncated back to that size when the run resumes, so the same
+differences are never appended twice.
 """
+import codecs
 import tarfile
-import sys
 import os
 import subprocess
 import shutil
-import tempfile
 from datetime import datetime
 import argparse
 
+from migrate_all import migration_scripts
+from csv_diff import get_field_info, diff_csv
+
+SCHEMA_URL = 'http://open.canada.ca/data/en/recombinant-schema/{0}.json'
+REPORTS_DIR = 'warehouse_reports'
+PROGRESS_FILE = os.path.join(REPORTS_DIR, '.compared')
+# exit code of a migration script that does not apply to the csv file
+MIGRATION_NOT_NEEDED = 85
+
+
+def get_base(tfile):
+    base = os.path.basename(tfile)
+    pd_name = os.path.splitext(os.path.splitext(base)[0])[0]
+    return pd_name
+
+
+def run_migrations(tar, member, outpath):
+    """
+    Stream a csv file from a backup archive through its migration scripts
+    into outpath, dropping the first script while it exits with
+    MIGRATION_NOT_NEEDED like migrate_all.py
+    """
+    pd_type = os.path.splitext(os.path.basename(member.name))[0]
+    matching_files = migration_scripts(pd_type)
+    tmppath = outpath + '.tmp'
+
+    while matching_files:
+        with open(tmppath, 'wb') as outfile:
+            proc_array = []
+            for matching_file in matching_files:
+                last = matching_file == matching_files[-1]
+                proc_array.append(subprocess.Popen(
+                    ['python', matching_file, 'warehouse'],
+                    stdin=proc_array[-1].stdout if proc_array else subprocess.PIPE,
+                    stdout=outfile if last else subprocess.PIPE))
+                if len(proc_array) > 1:
+                    # only the next script reads this pipe
+                    proc_array[-2].stdout.close()
+
+            infile = tar.extractfile(member)
+            try:
+                # Check if the input csv has a byte order marks
+                start = infile.read(3)
+                if start != codecs.BOM_UTF8:
+                    proc_array[0].stdin.write(codecs.BOM_UTF8)
+                proc_array[0].stdin.write(start)
+                shutil.copyfileobj(infile, proc_array[0].stdin)
+                proc_array[0].stdin.close()
+            except BrokenPipeError:
+                # script exited before reading everything
+                pass
+            returncodes = [p.wait() for p in proc_array]
+
+        if returncodes[0] == MIGRATION_NOT_NEEDED:
+            matching_files = matching_files[1:]
+            continue
+        if any(returncodes):
+            raise Exception('migration of {0} failed: {1}'.format(
+                member.name, dict(zip(matching_files, returncodes))))
+        break
+    # if there are no migration scripts to run, write the csv file to output file
+    else:
+        with open(tmppath, 'wb') as outfile:
+            shutil.copyfileobj(tar.extractfile(member), outfile)
+
+    os.rename(tmppath, outpath)
+
+
+def migrate_backup(fname, tfile, cache_dir):
+    """
+    Migrate all the CSVs in the backup archive tfile of directory fname
+    once, returns the directory of the cached migrated CSVs
+    """
+    migrated_dir = os.path.join(cache_dir, get_base(tfile))
+    if not os.path.exists(migrated_dir):
+        os.makedirs(migrated_dir)
+
+    with tarfile.open(os.path.join(fname, tfile)) as tar:
+        for member in tar:
+            csvfile = os.path.basename(member.name)
+            if not member.isfile() or not csvfile.endswith('.csv'):
+                continue
+            outpath = os.path.join(migrated_dir, csvfile)
+            if os.path.exists(outpath):
+                continue
+            print("Migrating {0} from archive {1}".format(csvfile, tfile))
+            run_migrations(tar, member, outpath)
+    return migrated_dir
+
+
+schemas = {}
+
+
+def get_schema(schema):
+    if schema not in schemas:
+        schemas[schema] = get_field_info(SCHEMA_URL.format(schema))
+    return schemas[schema]
+
+
+def record_progress(*names):
+    with open(PROGRESS_FILE, 'a') as f:
+        f.write(' '.join(str(n) for n in names) + '\n')
+
+
+def read_progress():
+    """
+    Return the set of (prev, curr) and (prev, curr, pd type) recorded as
+    compared and {(prev, curr, pd type): warehouse CSV size} for the
+    appends started
+    """
+    compared = set()
+    started = {}
+    if os.path.exists(PROGRESS_FILE):
+        with open(PROGRESS_FILE) as f:
+            for line in f:
+                names = line.split()
+                if len(names) == 4:
+                    started[tuple(names[:3])] = int(names[3])
+                elif names:
+                    compared.add(tuple(names))
+    return compared, started
+
+
+def compare_backups(prev, curr, prev_dir, curr_dir, compared, started):
+    """
+    Append the differences between the migrated CSVs of backups prev and
+    curr to the warehouse CSVs, skipping the PD types already recorded
+    in compared and truncating the ones interrupted in started
+    """
+    dt_string = datetime.now().strftime("%Y-%m-%d")
+
+    for curr_csv in sorted(os.listdir(curr_dir)):
+        if not curr_csv.endswith('.csv'):
+            continue
+        prev_csv = os.path.join(prev_dir, curr_csv)
+        if not os.path.exists(prev_csv):
+            continue
+        pdtype = curr_csv.split('.')[0]
+        key = (prev, curr, pdtype)
+        if key in compared:
+            continue
+        schema = pdtype
+        if 'nil' in pdtype or 'std' in pdtype:
+            schema = schema.split('-')[0]
+        outfile = os.path.join(REPORTS_DIR, '{0}_warehouse.csv'.format(pdtype))
+        if key in started and os.path.exists(outfile):
+            # drop the differences of the interrupted append
+            if started[key]:
+                with open(outfile, 'r+b') as f:
+                    f.truncate(started[key])
+            else:
+                os.remove(outfile)
+        record_progress(prev, curr, pdtype, os.path.getsize(outfile)
+                        if os.path.exists(outfile) else 0)
+        print("Getting difference between {0} and {1}".format(
+            prev_csv, os.path.join(curr_dir, curr_csv)))
+        diff_csv(prev_csv, os.path.join(curr_dir, curr_csv),
+                 get_schema(schema), dt_string, outfile)
+        record_progress(prev, curr, pdtype)
 
 
 parser = argparse.ArgumentParser(description="Run warehouse script. By default, it runs on the last 2 backups.")
 parser.add_argument("fname", help="directory of archived backups")
 parser.add_argument("-a", "--all", action='store_true', help="compare all backups.")
+parser.add_argument("--cache", default='warehouse_cache',
+                    help="directory for migrated CSVs, default: warehouse_cache")
+parser.add_argument("--keep-cache", action='store_true',
+                    help="keep the migrated CSVs of compared backups.")
 args = parser.parse_args()
 
 tar_array = sorted(os.listdir(args.fname))
 if args.all == False:
     tar_array = tar_array[-2:]
 
-prev = ''
-curr = ''
+if not os.path.exists(REPORTS_DIR):
+    os.mkdir(REPORTS_DIR)
 
-def get_base(tfile):
-    base = os.path.basename(tfile)
-    pd_name = os.path.splitext(os.path.splitext(base)[0])[0]
-    return pd_name
+compared, started = read_progress()
 
-def extract(tfile, dest):
-    fpath = './' + dest
-    tar = tarfile.open(args.fname + tfile)
-    tar.extractall(path=fpath)
-    tar.close()
-    return fpath
-
-def run_migrations(fpath, temp_dir):
-
-    for csvfile in os.listdir(fpath):
-        print("Migrating {0} from directory {1}".format(csvfile, fpath))
-        proc = subprocess.Popen(['python', 'migrate_all.py', fpath+'/'+csvfile, temp_dir+'/'+fpath+'m_'+csvfile])
-        if proc.wait():
-            sys.exit(1)
-
-def csv_diff(prev_csv, curr_csv, endpoint, outfile):
-    now = datetime.now()
-    dt_string = now.strftime("%Y-%m-%d")
-
-    print("Getting difference between {0} and {1}".format(prev_csv, curr_csv))
-    proc = subprocess.Popen(['python', 'csv_diff.py', temp_dir+'/'+prev_csv, temp_dir+'/'+curr_csv, endpoint,
-                             dt_string, outfile])
-    if proc.wait():
-        sys.exit(1)
-
-
-if not os.path.exists('warehouse_reports'):
-    os.mkdir('warehouse_reports')
-
-while tar_array:
-    with tempfile.TemporaryDirectory() as temp_dir:
-        if tar_array == []:
-            break
-        if prev == '':
-            prev = tar_array.pop(0)
-            curr = tar_array.pop(0)
-        else:
-            prev = curr
-            curr = tar_array.pop(0)
-
-        prev_base = get_base(prev)
-        curr_base = get_base(curr)
-
-        # Extract zipped backups
-        prev_path = extract(prev, prev_base)
-        curr_path = extract(curr, curr_base)
-
-        # Migrate all CSVs
-        run_migrations(prev_path, temp_dir)
-        run_migrations(curr_path, temp_dir)
-
-        # Delete extracted directories
-        shutil.rmtree(prev_path)
-        shutil.rmtree(curr_path)
-
-        # Match Migrated CSVs
-        csv_array = sorted(os.listdir(temp_dir))
-        prev_array = [a for a in csv_array if prev_base in a]
-        curr_array = [a for a in csv_array if curr_base in a]
-
-        for curr_csv in curr_array:
-            now = datetime.now()
-            dt_string = now.strftime("%H:%M:%s")
-            print(dt_string,'\n')
-            pdfile = curr_csv.split('_')[1]
-            pdtype = pdfile.split('.')[0]
-            schema = pdtype
-            if 'nil' in pdtype or 'std' in pdtype:
-                schema = schema.split('-')[0]
-            prev_csv_matches = [string for string in prev_array if pdfile in string]
-            if prev_csv_matches:
-                csv_diff(prev_csv_matches[0], curr_csv,
-                    'http://open.canada.ca/data/en/recombinant-schema/{0}.json'.format(schema),
-                    'warehouse_reports/{0}_warehouse.csv'.format(pdtype))
+for prev, curr in zip(tar_array, tar_array[1:]):
+    if (prev, curr) not in compared:
+        compare_backups(
+            prev, curr,
+            migrate_backup(args.fname, prev, args.cache),
+            migrate_backup(args.fname, curr, args.cache),
+            compared, started)
+        record_progress(prev, curr)
 
+    # migrated CSVs of prev are not needed by the remaining pairs
+    if not args.keep_cache:
+        shutil.rmtree(os.path.join(args.cache, get_base(prev)), ignore_errors=True)
 
+if not args.keep_cache:
+    shutil.rmtree(args.cache, ignore_errors=True)
@@ -51,38 +51,48 @@ def run_scripts(infile, outfile, matching_files):
         pass
 
 
-inpath = sys.argv[1]
-outpath = sys.argv[2]
-infile = io.open(inpath, mode='rb')
-outfile = io.open(outpath, mode='wb')
-base = os.path.basename(inpath)
-pd_type = os.path.splitext(base)[0]
-proc_array = []
-
-# Check if the input csv file is a *-nil data type, and retrieve only the nil migration scripts
-if "nil" not in pd_type:
-    search_pd = '*_{0}_*'.format(pd_type)
-    matching_files = sorted([mf for mf in glob.glob('../migrate/'+search_pd) if "nil" not in mf])
+MIGRATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'migrate')
+
+
+def migration_scripts(pd_type):
+    """
+    Return the migration scripts for pd_type in the order they are run
+    """
+    # Check if the input csv file is a *-nil data type, and retrieve only the nil migration scripts
+    if "nil" not in pd_type:
+        search_pd = '*_{0}_*'.format(pd_type)
+        return sorted([mf for mf in glob.glob(os.path.join(MIGRATE_DIR, search_pd)) if "nil" not in os.path.basename(mf)])
 
-else:
     pd_type = pd_type.replace("-", "_")
     search_pd = '*_{0}_*'.format(pd_type)
-    matching_files = sorted(glob.glob('../migrate/' + search_pd))
+    return sorted(glob.glob(os.path.join(MIGRATE_DIR, search_pd)))
+
+
+if __name__ == '__main__':
+    inpath = sys.argv[1]
+    outpath = sys.argv[2]
+    infile = io.open(inpath, mode='rb')
+    outfile = io.open(outpath, mode='wb')
+    base = os.path.basename(inpath)
+    pd_type = os.path.splitext(base)[0]
+    proc_array = []
+
+    matching_files = migration_scripts(pd_type)
+
+    while matching_files:
+        try:
+            run_scripts(infile, outfile, matching_files)
+            break
+
+        except IOError:
+            if proc_array[0].poll() != 85:
+                raise
+            infile.seek(0)
+            outfile.seek(0)
+            matching_files = matching_files[1:]
+    # if there are no migration scripts to run, write the csv file to output file
+    else:
+        shutil.copyfile(inpath, outpath)
 
-while matching_files:
-    try:
-        run_scripts(infile, outfile, matching_files)
-        break
-
-    except IOError:
-        if proc_array[0].poll() != 85:
-            raise
-        infile.seek(0)
-        outfile.seek(0)
-        matching_files = matching_files[1:]
-# if there are no migration scripts to run, write the csv file to output file
-else:
-    shutil.copyfile(inpath, outpath)
-
-infile.close()
-outfile.close()
+    infile.close()
+    outfile.close()
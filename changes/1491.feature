@@ -0,0 +1 @@
+Added a `--stream` option to the `portal-update` command that copies packages to the Portal while the next changed packages are retrieved from the Registry, checkpointing the activity date after every copied package.
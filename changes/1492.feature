@@ -0,0 +1 @@
+The `copy-datasets` worker used by `portal-update` now stores a digest of every package it copies and leaves packages with an unchanged digest alone without comparing them to the Portal. Use `--ignore-digests` to compare every package, e.g. to undo changes made directly on the Portal. Run `ckan canada init-db` on the Portal once to create the digest table.
@@ -0,0 +1 @@
+Added a `--delta-sync` option to the `portal-update` and `copy-datasets` commands that updates only the inserted, changed and deleted rows of Portal DataStore tables in a single transaction when their Data Dictionary has not changed, instead of deleting and reloading the whole table.
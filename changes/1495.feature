@@ -0,0 +1 @@
+Added a `--shadow-swap` option to the `portal-update` and `copy-datasets` commands that reloads Portal DataStore tables into a shadow table and swaps it in once loaded and indexed, so the existing table stays readable during the copy.
@@ -0,0 +1 @@
+Added `--processes`, `--solr-writers` and `--batch-size` options to the `pd rebuild` command to build SOLR records in a pool of processes and send them from concurrent SOLR writers.
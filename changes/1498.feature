@@ -0,0 +1 @@
+Added a `pd update` command that sends only the added, changed and deleted SOLR records since the last update, used by the nightly PD Makefile instead of `pd rebuild`. Run `ckan canada init-db` once to create the table of SOLR record digests, kept for each SOLR core.
@@ -0,0 +1 @@
+Added a `canada benchmark-triggers` command that times upserting rows into a scratch copy of each PD table with no triggers, with the table trigger as written and with its error checks grouped. Table trigger functions now have their error checks grouped into fewer statements when they are created and by `canada update-triggers`, and the simple `*_error` trigger helper functions are now inlinable SQL functions.
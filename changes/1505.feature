@@ -0,0 +1 @@
+Sysadmin DataStore upserts may set `canada_bulk_load` in the action context so that the PD record created/modified trigger reads the user state once and skips comparing updated rows, for faster restores and migrations. The new `canada load-csv` command loads PD CSV files this way, and `make restore-all load=1` uses it to load the restored backup.
@@ -0,0 +1 @@
+The PD datatable preview now pages to the next and previous pages by primary key instead of by offset when sorted by primary key columns, so deep pages load as quickly as the first.
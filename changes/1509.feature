@@ -0,0 +1 @@
+Added a `ckanext.canada.datatable_trigram_search` option. When it is set, `canada update-triggers` creates trigram indexes on the primary key and free text fields of PD tables when the `pg_trgm` extension is installed, and PD datatable searches on tables with a valid index match those fields with `ILIKE` instead of DataStore full-text search. Tables without an index yet keep using full-text search.
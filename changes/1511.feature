@@ -0,0 +1 @@
+New `canada export-filtered` command writes the filtered PD CSV files straight from the DataStore with the filters applied in SQL. Run `make filter-all export=1` to use it instead of dumping and filtering.
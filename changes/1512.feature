@@ -0,0 +1 @@
+New `bin/pd/nightly.py` runs the nightly dump, filter, upload, rebuild and backup stages for each PD type in parallel. It retries failed stages, skips the rest of a failed type without stopping the others, and reports the time and size of each stage.
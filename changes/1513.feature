@@ -0,0 +1 @@
+`bin/pd/nightly.py --manifest` keeps the sha256 digests of each PD type's files after it is published. It skips the upload and rebuild stages for types whose files have not changed, and `--report` lists the manifest.
@@ -1,12 +1,16 @@
+import os
 import re
 import csv
 import json
 import io
 import time
 import sys
-import subprocess
+import queue
+import threading
 import click
+import hashlib
 import traceback
+import sqlalchemy
 from io import StringIO
 
 from contextlib import contextmanager
@@ -34,7 +38,8 @@ from ckanapi.cli.utils import completion_stats
 
 import ckanext.datastore.backend.postgres as datastore
 
-from ckanext.canada import triggers
+from ckanext.canada import triggers, datastore_copy
+from ckanext.canada import model as canada_model
 
 PAST_RE = (
     r'^'
@@ -71,6 +76,11 @@ RESOURCE_TRIM_FIELDS = ['package_id', 'revision_id',
                 'mimetype', 'cache_url', 'created', 'webstore_url',
                 'position', 'metadata_modified']
 
+# number of changed packages retrieved together for portal-update
+PREFETCH_BATCH_SIZE = 100
+# number of retrieved packages waiting for a worker in portal-update --stream
+STREAM_QUEUE_SIZE = 1000
+
 
 class PortalUpdater(object):
     """
@@ -85,7 +95,13 @@ class PortalUpdater(object):
                  log,
                  tries,
                  delay,
-                 verbose):
+                 verbose,
+                 stream=False,
+                 queue_size=STREAM_QUEUE_SIZE,
+                 ignore_digests=False,
+                 delta_sync=False,
+                 shadow_swap=False,
+                 checksum=False):
         self.portal_ini = portal_ini
         self.ckan_user = ckan_user
         self.last_activity_date = last_activity_date
@@ -97,6 +113,12 @@ class PortalUpdater(object):
         self._portal_update_activity_date = None
         self._portal_update_completed = False
         self.verbose = verbose
+        self.stream = stream
+        self.queue_size = queue_size
+        self.ignore_digests = ignore_digests
+        self.delta_sync = delta_sync
+        self.shadow_swap = shadow_swap
+        self.checksum = checksum
 
     def portal_update(self):
         """
@@ -166,17 +188,14 @@ class PortalUpdater(object):
             cmd.append('-m')
         if self.verbose:
             cmd.append('-v')
-
-        pool = worker_pool(
-            cmd,
-            self.processes,
-            [],
-            stop_when_jobs_done=False,
-            stop_on_keyboard_interrupt=False,
-            )
-
-        # Advance generator so we may call send() below
-        next(pool)
+        if self.ignore_digests:
+            cmd.append('--ignore-digests')
+        if self.delta_sync:
+            cmd.append('--delta-sync')
+        if self.shadow_swap:
+            cmd.append('--shadow-swap')
+        if self.checksum:
+            cmd.append('--checksum')
 
         def append_log(finished, package_id, action, reason):
             if not log:
@@ -190,6 +209,29 @@ class PortalUpdater(object):
                 ]) + '\n')
             log.flush()
 
+        if self.stream:
+            with _quiet_int_pipe():
+                append_log(
+                    None,
+                    None,
+                    "started streaming updates from:",
+                    activity_date.isoformat()
+                )
+                self._stream_portal_update(
+                    registry, activity_date, cmd, append_log)
+            return
+
+        pool = worker_pool(
+            cmd,
+            self.processes,
+            [],
+            stop_when_jobs_done=False,
+            stop_on_keyboard_interrupt=False,
+            )
+
+        # Advance generator so we may call send() below
+        next(pool)
+
         with _quiet_int_pipe():
             append_log(
                 None,
@@ -225,6 +267,129 @@ class PortalUpdater(object):
                 self._portal_update_activity_date = next_date.isoformat()
             self._portal_update_completed = True
 
+    def _stream_portal_update(self, registry, activity_date, cmd, append_log):
+        """
+        Query the registry for changed packages in this thread while
+        another thread feeds them to the copy workers through a bounded
+        queue, so fetching and copying overlap.
+
+        _portal_update_activity_date is advanced as soon as every package
+        up to an activity timestamp has been copied, so a failure only
+        loses the packages that were in flight.
+        """
+        jobs = queue.Queue(maxsize=self.queue_size)
+        produced_all = threading.Event()
+        consumer_errors = []
+
+        def checkpoint(timestamp):
+            if self._portal_update_activity_date == timestamp.isoformat():
+                return
+            self._portal_update_activity_date = timestamp.isoformat()
+            print(" --- checkpoint at: " + timestamp.isoformat())
+            append_log(None, None, "checkpoint at:", timestamp.isoformat())
+
+        def consume():
+            # activity timestamps by job id, in activity order
+            timestamps = []
+            finished_jobs = set()
+            # all jobs before this one are finished
+            low_water = 0
+
+            def finish(job_id):
+                nonlocal low_water
+                finished_jobs.add(job_id)
+                while low_water in finished_jobs:
+                    finished_jobs.remove(low_water)
+                    low_water += 1
+                # packages can share a timestamp, only checkpoint once
+                # the next package is known to have a later one
+                if 0 < low_water < len(timestamps) and \
+                        timestamps[low_water] > timestamps[low_water - 1]:
+                    checkpoint(timestamps[low_water - 1])
+
+            def job_iter():
+                while True:
+                    job = jobs.get()
+                    if job is None:
+                        return
+                    timestamp, package = job
+                    job_id = len(timestamps)
+                    timestamps.append(timestamp)
+                    if package is None:
+                        # not found on registry, nothing to copy
+                        finish(job_id)
+                        continue
+                    yield job_id, package
+
+            try:
+                pool = worker_pool(
+                    cmd,
+                    self.processes,
+                    job_iter(),
+                    stop_when_jobs_done=True,
+                    stop_on_keyboard_interrupt=False,
+                    )
+                stats = completion_stats(self.processes)
+                for job_ids, finished, result in pool:
+                    if result is None:
+                        continue
+                    try:
+                        package_id, action, reason = json.loads(result)
+                    except Exception as e:
+                        if self.verbose:
+                            print("Worker proccess failed on:")
+                            print(result)
+                        raise Exception(e)
+                    print(job_ids, next(stats), finished, package_id, \
+                        action, reason)
+                    append_log(finished, package_id, action, reason)
+                    finish(finished)
+                if produced_all.is_set() and timestamps:
+                    checkpoint(timestamps[-1])
+            except Exception as e:
+                consumer_errors.append(e)
+
+        consumer = threading.Thread(target=consume)
+        consumer.daemon = True
+        consumer.start()
+
+        def put(job):
+            while consumer.is_alive():
+                try:
+                    jobs.put(job, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        start_date = activity_date
+        try:
+            while True:
+                data = registry.action.changed_packages_activity_timestamp_since(
+                    since_time=start_date.isoformat())
+                if not data:
+                    produced_all.set()
+                    break
+                timestamps = dict(
+                    (r['package_id'], isodate(r['timestamp'], None))
+                    for r in data)
+                for package_id, package in _prefetch_packages(
+                        registry,
+                        [r['package_id'] for r in data],
+                        verbose=self.verbose):
+                    if not put((timestamps[package_id], package)):
+                        break
+                if not consumer.is_alive():
+                    break
+                start_date = isodate(data[-1]['timestamp'], None)
+        finally:
+            put(None)
+            consumer.join()
+
+        if consumer_errors:
+            raise consumer_errors[0]
+        self._portal_update_completed = produced_all.is_set()
+
 
 def _changed_packages_since(registry, since_time, ids_only=False, verbose=False):
     """
@@ -252,20 +417,25 @@ def _changed_packages_since(registry, since_time, ids_only=False, verbose=False)
             print("Only retrieving changed package IDs...", file=sys.stderr)
         else:
             print("Retrieving changed package dicts, resource views, and resource dictionaries...", file=sys.stderr)
-    for result in data:
-        package_id = result['package_id']
-        try:
-            source_package = registry.action.package_show(id=package_id)
-        except NotFound:
-            print(package_id + " not found in database.", file=sys.stderr)
-        else:
-            if ids_only:
-                # ckanapi workers are expecting bytes
-                packages.append(source_package['id'].encode('utf-8'))
+    if ids_only:
+        for result in data:
+            package_id = result['package_id']
+            try:
+                source_package = registry.action.package_show(id=package_id)
+            except NotFound:
+                print(package_id + " not found in database.", file=sys.stderr)
             else:
-                source_package = get_datastore_and_views(source_package, registry, verbose=verbose)
                 # ckanapi workers are expecting bytes
-                packages.append(json.dumps(source_package).encode('utf-8'))
+                packages.append(source_package['id'].encode('utf-8'))
+    else:
+        # retrieved lazily in batches so the workers can start on
+        # the first batch while the next ones are being retrieved
+        packages = (
+            package for _package_id, package in _prefetch_packages(
+                registry,
+                [result['package_id'] for result in data],
+                verbose=verbose)
+            if package is not None)
 
     if data:
         since_time = isodate(data[-1]['timestamp'], None)
@@ -273,13 +443,173 @@ def _changed_packages_since(registry, since_time, ids_only=False, verbose=False)
     return packages, since_time
 
 
-def _copy_datasets(source, user, mirror=False, verbose=False):
+def _prefetch_packages(registry, package_ids, batch_size=PREFETCH_BATCH_SIZE,
+                       verbose=False):
+    """
+    Generator of source packages with their resource views and data
+    dictionaries attached, the same as get_datastore_and_views would
+    return them. Each batch of package_ids is retrieved with a single
+    package_search, resource view query and DataStore dictionary query
+    instead of a few action calls per package and resource. Packages
+    whose search index copy is older than the database, or missing from
+    the index, are read with package_show.
+
+    registry - LocalCKAN instance
+    package_ids - list of package ids to retrieve
+
+    yields (package_id, package) in the order of package_ids, package
+    being json encoded as bytes for the ckanapi workers or None when
+    the package was not found
+    """
+    for i in range(0, len(package_ids), batch_size):
+        batch_ids = package_ids[i:i + batch_size]
+        if verbose:
+            print("Retrieving batch of %s changed packages..." % len(batch_ids), file=sys.stderr)
+        modified = dict(model.Session.query(
+            model.Package.id, model.Package.metadata_modified).filter(
+                model.Package.id.in_(batch_ids)))
+        found = {}
+        for source_package in registry.action.package_search(
+                fq='id:(%s)' % ' OR '.join('"%s"' % i for i in batch_ids),
+                rows=len(batch_ids),
+                include_private=True,
+                include_drafts=True)['results']:
+            db_modified = modified.get(source_package['id'])
+            if db_modified and (source_package.get('metadata_modified') ==
+                                db_modified.isoformat()):
+                found[source_package['id']] = source_package
+        for package_id in batch_ids:
+            if package_id in found:
+                continue
+            # deleted packages are not in the search index and a failed
+            # index update leaves an old copy of the package there
+            if verbose and package_id in modified:
+                print("  Reading %s from the database..." % package_id, file=sys.stderr)
+            try:
+                found[package_id] = registry.action.package_show(id=package_id)
+            except NotFound:
+                print(package_id + " not found in database.", file=sys.stderr)
+
+        resource_ids = []
+        datastore_ids = []
+        for source_package in found.values():
+            for resource in source_package.get('resources', []):
+                resource_ids.append(resource['id'])
+                if resource['datastore_active']:
+                    datastore_ids.append(resource['id'])
+        resource_views = _resource_views_batch(resource_ids)
+        data_dicts = _datastore_dictionaries_batch(datastore_ids)
+
+        for package_id in batch_ids:
+            if package_id not in found:
+                yield package_id, None
+                continue
+            source_package = found[package_id]
+            for resource in source_package.get('resources', []):
+                res_id = resource['id']
+                if resource['datastore_active']:
+                    if res_id not in data_dicts:
+                        if verbose:
+                            print("  WARNING: Did not find DataStore fields for %s..." % res_id, file=sys.stderr)
+                        continue
+                    # add hash, views and data dictionary
+                    source_package[res_id] = {
+                        "hash": resource.get('hash'),
+                        "views": resource_views.get(res_id, []),
+                        "data_dict": data_dicts[res_id],
+                    }
+                elif resource_views.get(res_id):
+                    source_package[res_id] = {
+                        "views": resource_views[res_id]}
+            # ckanapi workers are expecting bytes
+            yield package_id, json.dumps(source_package).encode('utf-8')
+
+
+def _resource_views_batch(resource_ids):
+    """
+    Return {resource_id: views} for resource_ids in the same
+    form as resource_view_list, using a single query.
+    """
+    from ckan.lib import datapreview
+    from ckan.lib.dictization import model_dictize
+
+    if not resource_ids:
+        return {}
+    resource_views = {}
+    q = model.Session.query(model.ResourceView).filter(
+        model.ResourceView.resource_id.in_(resource_ids)).order_by(
+            model.ResourceView.resource_id, model.ResourceView.order)
+    for resource_view in q:
+        if datapreview.get_view_plugin(resource_view.view_type):
+            resource_views.setdefault(
+                resource_view.resource_id, []).append(resource_view)
+    context = {'model': model, 'session': model.Session}
+    return dict(
+        (res_id, model_dictize.resource_view_list_dictize(views, context))
+        for res_id, views in resource_views.items())
+
+
+def _datastore_dictionaries_batch(resource_ids):
+    """
+    Return {resource_id: data dictionary} for the resource_ids that
+    have a DataStore table, in the same form as _datastore_dictionary,
+    using a single query on the DataStore database.
+    """
+    if not resource_ids:
+        return {}
+    data_dicts = {}
+    with datastore.get_read_engine().connect() as connection:
+        results = connection.execute(sqlalchemy.text(u'''
+            SELECT c.relname, a.attname, t.typname, d.description
+            FROM pg_class c
+            JOIN pg_attribute a ON a.attrelid = c.oid
+            JOIN pg_type t ON t.oid = a.atttypid
+            LEFT JOIN pg_description d
+                ON d.objoid = c.oid AND d.objsubid = a.attnum
+            WHERE c.relname = ANY(:resource_ids)
+                AND c.relnamespace = 'public'::regnamespace
+                AND a.attnum > 0 AND NOT a.attisdropped
+            ORDER BY c.relname, a.attnum
+            '''), resource_ids=list(resource_ids))
+        for res_id, name, type_name, description in results:
+            fields = data_dicts.setdefault(res_id, [])
+            if name.startswith(u'_'):
+                continue
+            field = {u'id': name, u'type': type_name}
+            if description:
+                try:
+                    field[u'info'] = json.loads(description)
+                except ValueError:
+                    # don't die on non-json comments
+                    pass
+            fields.append(field)
+    return data_dicts
+
+
+def _copy_datasets(source, user, mirror=False, verbose=False,
+                   ignore_digests=False, delta_sync=False, shadow_swap=False,
+                   checksum=False):
     """
     A process that accepts packages on stdin which are compared
     to the local version of the same package.  The local package is
     then created, updated, deleted or left unchanged.  This process
     outputs that action as a string 'created', 'updated', 'deleted'
     or 'unchanged'
+
+    Packages with the same digest as the last one copied are left
+    unchanged without retrieving the local version, unless
+    ignore_digests is set. The digests only follow the source packages,
+    use ignore_digests to undo changes made directly on the local
+    packages.
+
+    With delta_sync, DataStore tables with an unchanged data dictionary
+    are updated row by row instead of being deleted and reloaded.
+
+    With shadow_swap, DataStore tables are reloaded into a shadow table
+    that replaces the existing one once loaded, so they stay readable.
+
+    With checksum, the rows of the copied DataStore tables are compared
+    with the source using checksums, not only counted.
     """
     with _quiet_int_pipe():
         portal = LocalCKAN(username = user)
@@ -302,6 +632,7 @@ def _copy_datasets(source, user, mirror=False, verbose=False):
             _trim_package(source_pkg)
 
             action = None
+            loaded = True
             if source_pkg and not mirror:
                 if source_pkg.get('ready_to_publish') == 'false':
                     source_pkg = None
@@ -316,6 +647,13 @@ def _copy_datasets(source, user, mirror=False, verbose=False):
                     # portal packages published public
                     source_pkg['private'] = False
 
+            source_digest = None
+            if source_pkg:
+                source_digest = _package_digest(source_pkg)
+                if not ignore_digests and \
+                        source_digest == _get_package_digest(package_id):
+                    action = 'skip'
+
             target_pkg = None
             if action != 'skip':
                 try:
@@ -343,7 +681,8 @@ def _copy_datasets(source, user, mirror=False, verbose=False):
             target_hash = {}
 
             if action == 'skip':
-                pass
+                action = 'unchanged'
+                reason = 'same digest as last copy'
             elif target_pkg is None and source_pkg is None:
                 action = 'unchanged'
                 reason = reason or 'deleted on registry'
@@ -353,14 +692,21 @@ def _copy_datasets(source, user, mirror=False, verbose=False):
                 portal.action.package_update(**source_pkg)
                 for r in source_pkg['resources']:
                     target_hash[r['id']] = r.get('hash')
-                action += _add_datastore_and_views(source_pkg, portal, target_hash, source, verbose=verbose)
+                added, loaded = _add_datastore_and_views(source_pkg, portal, target_hash, source, verbose=verbose,
+                                                         delta_sync=delta_sync, shadow_swap=shadow_swap,
+                                                         checksum=checksum)
+                action += added
             elif target_pkg is None:
                 action = 'created'
                 portal.action.package_create(**source_pkg)
-                action += _add_datastore_and_views(source_pkg, portal, target_hash, source, verbose=verbose)
+                added, loaded = _add_datastore_and_views(source_pkg, portal, target_hash, source, verbose=verbose,
+                                                         delta_sync=delta_sync, shadow_swap=shadow_swap,
+                                                         checksum=checksum)
+                action += added
             elif source_pkg is None:
                 action = 'deleted'
                 portal.action.package_delete(id=package_id)
+                _delete_package_digest(package_id)
             elif source_pkg == target_pkg:
                 action = 'unchanged'
                 reason = 'no difference found'
@@ -369,12 +715,53 @@ def _copy_datasets(source, user, mirror=False, verbose=False):
                 for r in target_pkg['resources']:
                     target_hash[r['id']] = r.get('hash')
                 portal.action.package_update(**source_pkg)
-                action += _add_datastore_and_views(source_pkg, portal, target_hash, source, verbose=verbose)
+                added, loaded = _add_datastore_and_views(source_pkg, portal, target_hash, source, verbose=verbose,
+                                                         delta_sync=delta_sync, shadow_swap=shadow_swap,
+                                                         checksum=checksum)
+                action += added
+
+            # copy again next time when the DataStore was not loaded
+            if source_digest and loaded:
+                _set_package_digest(package_id, source_digest)
 
             sys.stdout.write(json.dumps([package_id, action, reason]) + '\n')
             sys.stdout.flush()
 
 
+def _package_digest(pkg):
+    """
+    Return a digest of a trimmed package including the resource views
+    and data dictionaries added by get_datastore_and_views
+    """
+    return hashlib.sha256(json.dumps(
+        pkg, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def _get_package_digest(package_id):
+    row = model.Session.execute(
+        u"SELECT digest FROM canada_package_digest WHERE package_id = :id;",
+        {'id': package_id}).fetchone()
+    return row[0] if row else None
+
+
+def _set_package_digest(package_id, digest):
+    model.Session.execute(
+        u"INSERT INTO canada_package_digest (package_id, digest) "
+        "VALUES (:id, :digest) "
+        "ON CONFLICT (package_id) DO UPDATE "
+        "SET digest = EXCLUDED.digest, "
+        "modified = now() at time zone 'utc';",
+        {'id': package_id, 'digest': digest})
+    model.Session.commit()
+
+
+def _delete_package_digest(package_id):
+    model.Session.execute(
+        u"DELETE FROM canada_package_digest WHERE package_id = :id;",
+        {'id': package_id})
+    model.Session.commit()
+
+
 def _changed_datasets(since_date, server, brief):
     """
     Produce a list of dataset ids and requested dates. Each package
@@ -694,17 +1081,24 @@ def _trim_package(pkg):
             pkg[k] = ''
 
 
-def _add_datastore_and_views(package, portal, res_hash, ds, verbose=False):
-    # create datastore table and views for each resource of the package
+def _add_datastore_and_views(package, portal, res_hash, ds, verbose=False,
+                             delta_sync=False, shadow_swap=False, checksum=False):
+    # create datastore table and views for each resource of the package,
+    # returns the actions and whether all the datastore tables were loaded
     action = ''
+    loaded = True
     for resource in package['resources']:
         res_id = resource['id']
         if res_id in package.keys():
             if 'data_dict' in package[res_id].keys():
-                action += _add_to_datastore(portal, resource, package[res_id], res_hash, ds, verbose=verbose)
+                added, resource_loaded = _add_to_datastore(
+                    portal, resource, package[res_id], res_hash, ds, verbose=verbose,
+                    delta_sync=delta_sync, shadow_swap=shadow_swap, checksum=checksum)
+                action += added
+                loaded = loaded and resource_loaded
             if 'views' in package[res_id].keys():
                 action += _add_views(portal, resource, package[res_id], verbose=verbose)
-    return action
+    return action, loaded
 
 
 def _delete_datastore_and_views(package, portal):
@@ -725,19 +1119,51 @@ def _delete_datastore_and_views(package, portal):
     return action
 
 
-def _add_to_datastore(portal, resource, resource_details, t_hash, source_ds_url, verbose=False):
+def _add_to_datastore(portal, resource, resource_details, t_hash, source_ds_url, verbose=False,
+                      delta_sync=False, shadow_swap=False, checksum=False):
     action = ''
     try:
         portal.call_action('datastore_search', {'resource_id': resource['id'], 'limit': 0})
+        same_dictionary = _datastore_dictionary(portal, resource['id']) == resource_details['data_dict']
         if t_hash.get(resource['id']) \
                 and t_hash.get(resource['id']) == resource.get('hash')\
-                and _datastore_dictionary(portal, resource['id']) == resource_details['data_dict']:
+                and same_dictionary:
             if verbose:
                 action += '\n  File hash and Data Dictionary has not changed, skipping DataStore for %s...' % resource['id']
-            return action
-        else:
-            portal.call_action('datastore_delete', {"id": resource['id'], "force": True})
-            action += '\n  datastore-deleted for ' + resource['id']
+            return action, True
+        if delta_sync and same_dictionary:
+            # only the rows changed, update them in place
+            try:
+                inserted, updated, deleted = datastore_copy.sync_table(
+                    source_ds_url, resource['id'], resource_details['data_dict'],
+                    checksum=checksum)
+            except datastore_copy.DataStoreCopyError as e:
+                action += '\n  datastore-sync-failed for %s: %s' % (resource['id'], e)
+                if verbose:
+                    action += '\n    Falling back to reloading all the rows...'
+            else:
+                action += '\n  datastore-synced for ' + resource['id']
+                if verbose:
+                    action += '\n    %s rows inserted, %s updated, %s deleted' % (
+                        inserted, updated, deleted)
+                return action, True
+        if shadow_swap:
+            # keep the existing table readable until the new one is loaded
+            try:
+                count = datastore_copy.swap_table(
+                    source_ds_url, resource['id'], resource_details['data_dict'],
+                    checksum=checksum)
+            except datastore_copy.DataStoreCopyError as e:
+                action += '\n  datastore-swap-failed for %s: %s' % (resource['id'], e)
+                if verbose:
+                    action += '\n    Falling back to deleting and reloading the table...'
+            else:
+                action += '\n  datastore-swapped for ' + resource['id']
+                if verbose:
+                    action += '\n    Copied %s rows' % count
+                return action, True
+        portal.call_action('datastore_delete', {"id": resource['id'], "force": True})
+        action += '\n  datastore-deleted for ' + resource['id']
     except NotFound:
         # not an issue, resource does not exist in datastore
         if verbose:
@@ -752,11 +1178,18 @@ def _add_to_datastore(portal, resource, resource_details, t_hash, source_ds_url,
     action += '\n  datastore-created for ' + resource['id']
 
     # load data
-    target_ds_url = str(datastore.get_write_engine().url)
-    cmd1 = subprocess.Popen(['pg_dump', source_ds_url, '-a', '-t', resource['id']], stdout=subprocess.PIPE)
-    cmd2 = subprocess.Popen(['psql', target_ds_url], stdin=cmd1.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = cmd2.communicate()
-    action += ' data-loaded' if not err else ' data-load-failed'
+    loaded = False
+    try:
+        count = datastore_copy.copy_table(
+            source_ds_url, resource['id'], resource_details['data_dict'],
+            checksum=checksum)
+    except datastore_copy.DataStoreCopyError as e:
+        action += ' data-load-failed: %s' % e
+    else:
+        loaded = True
+        action += ' data-loaded'
+        if verbose:
+            action += '\n    Copied %s rows' % count
     if verbose:
         if resource_details['data_dict']:
             action += '\n    Using DataStore fields:'
@@ -764,7 +1197,7 @@ def _add_to_datastore(portal, resource, resource_details, t_hash, source_ds_url,
                 action += '\n      %s' % field['id']
         else:
             action += '\n    There are no DataStore fields!!!'
-    return action
+    return action, loaded
 
 
 def _add_views(portal, resource, resource_details, verbose=False):
@@ -874,6 +1307,61 @@ def _update_inventory_votes(json_name):
                 records=update)
 
 
+def _load_csv(csv_files, user):
+    """
+    Upsert the records of PD CSV files into the DataStore tables of
+    their organizations with canada_bulk_load set
+
+    :returns: True when all the records were loaded
+    """
+    from ckanext.recombinant.tables import get_chromo
+    from ckanext.recombinant.errors import RecombinantException
+    from ckanext.recombinant.read_csv import csv_data_batch
+    from ckanext.canada.dataset import dataset_resources
+
+    lc = LocalCKAN(username=user)
+    loaded = True
+    for csv_file in csv_files:
+        resource_name = os.path.basename(csv_file)
+        assert resource_name.endswith('.csv'), csv_file
+        resource_name = resource_name[:-len('.csv')]
+        click.echo(resource_name)
+        try:
+            chromo = get_chromo(resource_name)
+        except RecombinantException as e:
+            click.echo('- {0}'.format(e), err=True)
+            loaded = False
+            continue
+        method = 'upsert' if chromo.get('datastore_primary_key') else 'insert'
+        list_fields = [
+            f['datastore_id'] for f in chromo['fields']
+            if f['datastore_type'] == '_text']
+        org_resources = dataset_resources(chromo['dataset_type'])
+
+        for org_id, records in csv_data_batch(csv_file, chromo):
+            org = model.Group.get(org_id)
+            resource_ids = [
+                res_id
+                for datasets in org_resources.get(org.id if org else None, [])
+                for res_id, res_name in datasets if res_name == resource_name]
+            if len(resource_ids) != 1:
+                click.echo('- {0} {1} resources found for {2}'.format(
+                    org_id, len(resource_ids), resource_name), err=True)
+                loaded = False
+                continue
+            for r in records:
+                for k in list_fields:
+                    r[k] = r[k].split(',') if r.get(k) else []
+            lc.call_action(
+                'datastore_upsert',
+                {'resource_id': resource_ids[0],
+                 'method': method,
+                 'records': records},
+                context={'canada_bulk_load': True})
+            click.echo('- {0} {1}'.format(org.name, len(records)))
+    return loaded
+
+
 def _datastore_dictionary(ckan_instance, resource_id):
     """
     Return the data dictionary info for a resource
@@ -965,6 +1453,38 @@ def canada():
     is_flag=True,
     help="Increase verbosity",
 )
+@click.option(
+    "-s",
+    "--stream",
+    is_flag=True,
+    help="Copy packages while the next changed packages are being retrieved",
+)
+@click.option(
+    "--queue-size",
+    default=STREAM_QUEUE_SIZE,
+    help="Number of retrieved packages to hold for the workers with --stream, default: %s" % STREAM_QUEUE_SIZE,
+)
+@click.option(
+    "--ignore-digests",
+    is_flag=True,
+    help="Compare all packages with the Portal, even when unchanged since the last copy, "
+         "to undo changes made directly on the Portal",
+)
+@click.option(
+    "--delta-sync",
+    is_flag=True,
+    help="Update only the changed DataStore rows when the Data Dictionary has not changed",
+)
+@click.option(
+    "--shadow-swap",
+    is_flag=True,
+    help="Reload DataStore tables into a shadow table and swap it in when loaded",
+)
+@click.option(
+    "--checksum",
+    is_flag=True,
+    help="Compare checksums of the copied DataStore rows with the source, not only row counts",
+)
 def portal_update(portal_ini,
                   ckan_user,
                   last_activity_date=None,
@@ -973,7 +1493,13 @@ def portal_update(portal_ini,
                   log=None,
                   tries=1,
                   delay=60,
-                  verbose=False):
+                  verbose=False,
+                  stream=False,
+                  queue_size=STREAM_QUEUE_SIZE,
+                  ignore_digests=False,
+                  delta_sync=False,
+                  shadow_swap=False,
+                  checksum=False):
     """
     Collect batches of packages modified at local CKAN since activity_date
     and apply the package updates to the portal instance for all
@@ -983,10 +1509,17 @@ def portal_update(portal_ini,
         canada portal-update <portal.ini> -u <user>\n
                              [<last activity date> | [<k>d][<k>h][<k>m]]\n
                              [-p <num>] [-m] [-l <log file>]\n
-                             [-t <num> [-d <seconds>]]
+                             [-t <num> [-d <seconds>]]\n
+                             [-s [--queue-size <num>]] [--ignore-digests]\n
+                             [--delta-sync] [--shadow-swap] [--checksum]
 
     <last activity date>: Last date for reading activites, default: 7 days ago\n
     <k> number of hours/minutes/seconds in the past for reading activities
+
+    Packages unchanged since their last copy are skipped without
+    comparing them with the Portal, so changes made directly on the
+    Portal are only undone with --ignore-digests. Run canada init-db on
+    the Portal first.
     """
     PortalUpdater(portal_ini,
                   ckan_user,
@@ -996,7 +1529,25 @@ def portal_update(portal_ini,
                   log,
                   tries,
                   delay,
-                  verbose).portal_update()
+                  verbose,
+                  stream,
+                  queue_size,
+                  ignore_digests,
+                  delta_sync,
+                  shadow_swap,
+                  checksum).portal_update()
+
+
+@canada.command(short_help="Creates the tables used by the canada commands.")
+def init_db():
+    """
+    Creates the tables used by the canada commands that do not exist yet.
+
+    Full Usage:\n
+        canada init-db
+    """
+    canada_model.create_tables()
+    click.echo('Canada tables created')
 
 
 @canada.command(short_help="Copy records from another source.")
@@ -1024,7 +1575,30 @@ def portal_update(portal_ini,
     is_flag=True,
     help="Increase verbosity",
 )
-def copy_datasets(mirror=False, ckan_user=None, source=None, verbose=False):
+@click.option(
+    "--ignore-digests",
+    is_flag=True,
+    help="Compare all packages with the local ones, even when unchanged since the last copy, "
+         "to undo changes made directly on the local ones",
+)
+@click.option(
+    "--delta-sync",
+    is_flag=True,
+    help="Update only the changed DataStore rows when the Data Dictionary has not changed",
+)
+@click.option(
+    "--shadow-swap",
+    is_flag=True,
+    help="Reload DataStore tables into a shadow table and swap it in when loaded",
+)
+@click.option(
+    "--checksum",
+    is_flag=True,
+    help="Compare checksums of the copied DataStore rows with the source, not only row counts",
+)
+def copy_datasets(mirror=False, ckan_user=None, source=None, verbose=False,
+                  ignore_digests=False, delta_sync=False, shadow_swap=False,
+                  checksum=False):
     """
     A process that accepts packages on stdin which are compared
     to the local version of the same package.  The local package is
@@ -1033,12 +1607,20 @@ def copy_datasets(mirror=False, ckan_user=None, source=None, verbose=False):
     or 'unchanged'
 
     Full Usage:\n
-        canada copy-datasets [-m] [-o <source url>]
+        canada copy-datasets [-m] [-o <source url>] [--ignore-digests]\n
+                             [--delta-sync] [--shadow-swap] [--checksum]
     """
+    if not canada_model.tables_exist():
+        raise click.ClickException(
+            'The canada tables do not exist, run: ckan canada init-db')
     _copy_datasets(source,
                    _get_user(ckan_user),
                    mirror,
-                   verbose)
+                   verbose,
+                   ignore_digests,
+                   delta_sync,
+                   shadow_swap,
+                   checksum)
 
 
 
@@ -1089,11 +1671,121 @@ def load_suggested(suggested_datasets_csv, use_created_date=False):
 
 
 @canada.command(short_help="Updates/creates database triggers.")
-def update_triggers():
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Only list the functions and choices that would change",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Also list unchanged functions")
+def update_triggers(dry_run=False, verbose=False):
+    """
+    Create/update triggers used by PD tables, replacing only the functions
+    that changed in a single transaction
+
+    Full Usage:\n
+        canada update-triggers [--dry-run] [-v]
+    """
+    report = triggers.update_triggers(dry_run=dry_run)
+    functions = changed = 0
+    for name, change in report:
+        if change in ('new', 'changed', 'unchanged'):
+            functions += 1
+        if change == 'unchanged' and not verbose:
+            continue
+        if change in ('new', 'changed'):
+            changed += 1
+        click.echo('{0:48s} {1}'.format(name, change))
+    click.echo('{0} {1} of {2} functions'.format(
+        'Would update' if dry_run else 'Updated',
+        changed,
+        functions))
+
+
+@canada.command(short_help="Times PD table triggers.")
+@click.argument("resource_names", nargs=-1)
+@click.option(
+    "-n",
+    "--rows",
+    default=1000,
+    help="Number of rows upserted for each table, default: 1000",
+)
+def benchmark_triggers(resource_names, rows=1000):
+    """
+    Times DataStore upserts of synthetic rows into a scratch table of
+    each PD resource without triggers, with its trigger functions as
+    written in the schema and with their error checks grouped, without
+    changing any data.
+
+    Full Usage:\n
+        canada benchmark-triggers [-n <rows>] [<resource name> ...]
     """
-    Create/update triggers used by PD tables
+    from ckanext.recombinant.tables import get_chromo, get_dataset_types, get_geno
+    if not resource_names:
+        resource_names = [
+            c['resource_name']
+            for dataset_type in get_dataset_types()
+            for c in get_geno(dataset_type)['resources']]
+    chromos = [get_chromo(r) for r in resource_names]
+
+    def rate(value):
+        return '{0:10s}'.format('-') if value is None else '{0:10.0f}'.format(value)
+
+    click.echo('{0:24s} {1:>10s} {2:>10s} {3:>10s}  rows/s'.format(
+        'resource', 'no trigger', 'as written', 'grouped'))
+    for resource_name, base, written, grouped, error in triggers.benchmark_triggers(
+            chromos, rows):
+        click.echo('{0:24s} {1} {2} {3}  {4}'.format(
+            resource_name, rate(base), rate(written), rate(grouped),
+            error or ''))
+
+
+@canada.command(short_help="Exports PD tables to filtered CSV files.")
+@click.argument("workdir")
+@click.argument("source_names", nargs=-1)
+def export_filtered(workdir, source_names):
+    """
+    Write the filtered CSV files of PD source CSV files (e.g. ati.csv)
+    to WORKDIR/filtered straight from the DataStore, applying the same
+    filters as bin/filter/filter_all.py in SQL
+
+    Full Usage:\n
+        canada export-filtered <workdir> [<source csv> ...]
+    """
+    from ckanext.canada.datastore_export import export_source
+    from ckanext.canada.filters import FILTERS
+
+    filtered = os.path.join(workdir, 'filtered')
+    if not os.path.isdir(filtered):
+        os.makedirs(filtered)
+    for source_name in source_names or sorted(FILTERS):
+        if source_name not in FILTERS:
+            raise click.ClickException(
+                'no filters for {0}'.format(source_name))
+        for output, rows in export_source(workdir, source_name):
+            click.echo('{0:36s} {1} rows'.format(output, rows))
+
+
+@canada.command(short_help="Loads PD CSV files keeping their record dates.")
+@click.argument("csv_files", nargs=-1, required=True)
+@click.option(
+    "-u",
+    "--ckan-user",
+    default=None,
+    help="Sysadmin loading the records, default: ckan system user",
+)
+def load_csv(csv_files, ckan_user=None):
+    """
+    Load PD CSV files (e.g. ati.csv) into the DataStore like recombinant
+    load-csv, as a sysadmin bulk load: the record_created,
+    record_modified and user_modified values of the files are kept and
+    updated rows are not compared with the existing ones. Used to restore
+    backups and to load migrated files.
+
+    Full Usage:\n
+        canada load-csv <csv file> [<csv file> ...] [-u <user>]
     """
-    triggers.update_triggers()
+    if not _load_csv(csv_files, _get_user(ckan_user)):
+        raise click.ClickException('Some records were not loaded')
 
 
 @canada.command(short_help="Load Inventory Votes from a CSV file.")
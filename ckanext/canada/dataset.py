@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import sys
+import json
 from ckan.plugins.toolkit import config
 
 BATCH_SIZE = 1000
@@ -44,7 +45,7 @@ def solr_connection(ini_prefix, solr_url=None):
         return Solr(url, http_user=user, http_pass=password)
     return Solr(url)
 
-def data_batch(org_id, lc, dataset_type):
+def data_batch(org_id, lc, dataset_type, org_resources=None):
     """
     Generator of dataset dicts for organization with name org
 
@@ -54,32 +55,104 @@ def data_batch(org_id, lc, dataset_type):
     :ptype lc: obj
     :param dataset_type: e.g., 'ati', 'pd', etc.
     :ptype dataset_type: str
+    :param org_resources: as returned by dataset_resources for
+        dataset_type, loaded for org_id when not given
+    :ptype org_resources: dict
 
     generates (resource name, batch of records) tuples
     """
-    result = lc.action.package_search(
-        q="type:{0:s} owner_org:{1:s}".format(dataset_type, org_id),
-        rows=2)['results']
+    if org_resources is None:
+        org_resources = dataset_resources(dataset_type, org_id)
 
-    if not result:
+    datasets = org_resources.get(org_id)
+    if not datasets:
         return
-    if len(result) != 1:
+    if len(datasets) != 1:
        sys.stderr.write('1 record expected for %s %s, found %d' %
-            (dataset_type, org_id, len(result)))
+            (dataset_type, org_id, len(datasets)))
 
-    dataset = result[0]
-    for resource in dataset['resources']:
-        offset = 0
+    for resource_id, resource_name in datasets[0]:
+        for records in datastore_records(resource_id):
+            yield (resource_name, records)
+
+
+def dataset_resources(dataset_type, org_id=None):
+    """
+    Return the (resource id, resource name) lists of the active datasets
+    of dataset_type by organization id, in resource order, from a single
+    query
+
+    :param dataset_type: e.g., 'ati', 'pd', etc.
+    :ptype dataset_type: str
+    :param org_id: limit to the datasets of this organization id
+    :ptype org_id: str
+
+    :return {org id: [[(resource id, resource name), ...], ...]}
+    :rtype dict
+    """
+    from ckan import model
+    query = model.Session.query(
+        model.Package.owner_org,
+        model.Package.id,
+        model.Resource.id,
+        model.Resource.name,
+    ).join(
+        model.Resource, model.Resource.package_id == model.Package.id
+    ).filter(
+        model.Package.type == dataset_type,
+        model.Package.state == 'active',
+        model.Resource.state == 'active',
+    )
+    if org_id:
+        query = query.filter(model.Package.owner_org == org_id)
+
+    org_resources = {}
+    packages = {}
+    for owner_org, package_id, resource_id, resource_name in query.order_by(
+            model.Package.owner_org,
+            model.Package.metadata_created,
+            model.Resource.position):
+        if package_id not in packages:
+            packages[package_id] = []
+            org_resources.setdefault(owner_org, []).append(packages[package_id])
+        packages[package_id].append((resource_id, resource_name))
+    return org_resources
+
+
+def datastore_records(resource_id, batch_size=BATCH_SIZE):
+    """
+    Generator of batches of records of a DataStore table in _id order,
+    using keyset pagination so each batch costs the same however far
+    into the table it is. Records are in the same form as the records
+    returned by datastore_search.
+
+    :param resource_id: DataStore table to read
+    :ptype resource_id: str
+    :param batch_size: number of records per batch
+    :ptype batch_size: int
+
+    generates lists of record dicts
+    """
+    from ckanext.datastore.backend.postgres import get_read_engine, identifier
+    engine = get_read_engine()
+    sql = (
+        u'SELECT _id, (to_jsonb(t) - \'_full_text\')::text FROM {table} t '
+        u'WHERE _id > %s ORDER BY _id LIMIT %s'.format(
+            table=identifier(resource_id)))
+
+    with engine.connect() as connection:
+        exists = connection.execute(
+            u'SELECT to_regclass(%s)', identifier(resource_id)).scalar()
+        if not exists:
+            return
+        last_id = 0
         while True:
-            rval = lc.action.datastore_search(
-                resource_id=resource['id'],
-                limit=BATCH_SIZE,
-                offset=offset)
-            records = rval['records']
-            if not records:
+            rows = connection.execute(sql, last_id, batch_size).fetchall()
+            if not rows:
                 break
-            offset += len(records)
-            yield (resource['name'], records)
+            last_id = rows[-1][0]
+            yield [json.loads(r[1]) for r in rows]
+
 
 _REMOVE_CONTROL_CODES = dict((x, None) for x in range(32) if x != 10 and x != 13)
 
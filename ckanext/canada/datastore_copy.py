@@ -0,0 +1,388 @@
+"""
+Copy DataStore tables from another DataStore database, used by
+portal-update to copy Registry tables to the Portal
+"""
+import os
+import threading
+
+import sqlalchemy
+
+import ckanext.datastore.backend.postgres as datastore
+from ckanext.datastore.backend.postgres import identifier
+
+# pooled engines for source databases, by url
+_source_engines = {}
+
+# added to the table name while a replacement table is being loaded
+SHADOW_SUFFIX = u'_shadow'
+
+
+class DataStoreCopyError(Exception):
+    pass
+
+
+def source_engine(source_url):
+    """
+    Return a pooled engine for the source DataStore database url
+    """
+    if source_url not in _source_engines:
+        _source_engines[source_url] = sqlalchemy.create_engine(source_url)
+    return _source_engines[source_url]
+
+
+def table_columns(fields):
+    """
+    Return the DataStore table columns for data dictionary fields
+    as returned by datastore_search
+    """
+    return [u'_id', u'_full_text'] + [f['id'] for f in fields]
+
+
+def copy_table(source_url, resource_id, fields, checksum=False):
+    """
+    Copy all the rows of the resource_id DataStore table in the source_url
+    database into the empty table of the same name in the local DataStore
+    database, streaming a binary COPY from one to the other.
+
+    :param source_url: source DataStore database url
+    :param resource_id: DataStore table to copy
+    :param fields: data dictionary fields, the same on both tables
+    :param checksum: also compare checksums of all the rows after the
+        copy, not only the row counts
+
+    :returns: number of rows copied
+    :raises DataStoreCopyError: when the copy failed or does not match
+        the source, the local table is left unchanged
+    """
+    table = identifier(resource_id)
+    columns = u', '.join(identifier(c) for c in table_columns(fields))
+
+    source = source_engine(source_url).raw_connection()
+    target = datastore.get_write_engine().raw_connection()
+    try:
+        _copy_rows(
+            source,
+            u'COPY (SELECT {columns} FROM {table}) TO STDOUT '
+            u'(FORMAT binary)'.format(columns=columns, table=table),
+            target,
+            u'COPY {table} ({columns}) FROM STDIN '
+            u'(FORMAT binary)'.format(columns=columns, table=table))
+
+        with target.cursor() as cur:
+            # same as the setval pg_dump would have produced
+            cur.execute(
+                u'SELECT setval(pg_get_serial_sequence(%s, %s), max(_id)) '
+                u'FROM {table}'.format(table=table),
+                (table, u'_id'))
+
+        count = _verify(source, target, table, columns, u'_id', checksum)
+        target.commit()
+        return count
+    except DataStoreCopyError:
+        target.rollback()
+        raise
+    except Exception as e:
+        target.rollback()
+        raise DataStoreCopyError(str(e).strip())
+    finally:
+        source.rollback()
+        source.close()
+        target.close()
+
+
+def _copy_rows(source, copy_to_sql, target, copy_from_sql):
+    """
+    Stream COPY TO STDOUT output on source into COPY FROM STDIN on target
+    """
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def dump():
+        try:
+            with os.fdopen(write_fd, 'wb') as out:
+                with source.cursor() as cur:
+                    cur.copy_expert(copy_to_sql, out)
+        except Exception as e:
+            errors.append(e)
+
+    dumper = threading.Thread(target=dump)
+    dumper.start()
+    try:
+        with os.fdopen(read_fd, 'rb') as inp:
+            with target.cursor() as cur:
+                cur.copy_expert(copy_from_sql, inp)
+    finally:
+        dumper.join()
+    if errors:
+        raise errors[0]
+
+
+def sync_table(source_url, resource_id, fields, checksum=False):
+    """
+    Bring the resource_id DataStore table in the local DataStore database
+    up to date with the table of the same name and data dictionary in the
+    source_url database by only inserting, updating and deleting the rows
+    that differ, in a single transaction.
+
+    Rows are matched on the primary key of the source table when it has
+    one (e.g. Recombinant tables) or on _id otherwise.
+
+    :param source_url: source DataStore database url
+    :param resource_id: DataStore table to update
+    :param fields: data dictionary fields, the same on both tables
+    :param checksum: also compare checksums of all the rows after the
+        update, not only the row counts
+
+    :returns: (rows inserted, rows updated, rows deleted)
+    :raises DataStoreCopyError: when the update failed or does not match
+        the source, the local table is left unchanged
+    """
+    table = identifier(resource_id)
+    source = source_engine(source_url).raw_connection()
+    target = datastore.get_write_engine().raw_connection()
+    try:
+        key = _primary_key(source, table) or [u'_id']
+        # _id values are only kept in sync when rows are matched on them
+        names = [c for c in table_columns(fields)
+                 if c != u'_id' or key == [u'_id']]
+        columns = u', '.join(identifier(c) for c in names)
+        key_match = u' AND '.join(
+            u't.{c} = s.{c}'.format(c=identifier(c)) for c in key)
+        changed = [c for c in names if c not in key]
+
+        with target.cursor() as cur:
+            # only the copied columns, without the constraints of table
+            cur.execute(
+                u'CREATE TEMP TABLE sync_rows ON COMMIT DROP AS '
+                u'SELECT {columns} FROM {table} WITH NO DATA'.format(
+                    columns=columns, table=table))
+        _copy_rows(
+            source,
+            u'COPY (SELECT {columns} FROM {table}) TO STDOUT '
+            u'(FORMAT binary)'.format(columns=columns, table=table),
+            target,
+            u'COPY sync_rows ({columns}) FROM STDIN '
+            u'(FORMAT binary)'.format(columns=columns))
+
+        with target.cursor() as cur:
+            cur.execute(u'ANALYZE sync_rows')
+            cur.execute(
+                u'DELETE FROM {table} t WHERE NOT EXISTS ('
+                u'SELECT 1 FROM sync_rows s WHERE {key_match})'.format(
+                    table=table, key_match=key_match))
+            deleted = cur.rowcount
+            updated = 0
+            if changed:
+                cur.execute(
+                    u'UPDATE {table} t SET {assign} FROM sync_rows s '
+                    u'WHERE {key_match} AND ROW({t_changed})::text '
+                    u'IS DISTINCT FROM ROW({s_changed})::text'.format(
+                        table=table,
+                        assign=u', '.join(
+                            u'{c} = s.{c}'.format(c=identifier(c))
+                            for c in changed),
+                        key_match=key_match,
+                        t_changed=u', '.join(
+                            u't.' + identifier(c) for c in changed),
+                        s_changed=u', '.join(
+                            u's.' + identifier(c) for c in changed)))
+                updated = cur.rowcount
+            cur.execute(
+                u'INSERT INTO {table} ({columns}) '
+                u'SELECT {columns} FROM sync_rows s WHERE NOT EXISTS ('
+                u'SELECT 1 FROM {table} t WHERE {key_match})'.format(
+                    table=table, columns=columns, key_match=key_match))
+            inserted = cur.rowcount
+            if key == [u'_id']:
+                cur.execute(
+                    u'SELECT setval(pg_get_serial_sequence(%s, %s), '
+                    u'max(_id)) FROM {table}'.format(table=table),
+                    (table, u'_id'))
+
+        _verify(source, target, table, columns,
+                u', '.join(identifier(c) for c in key), checksum)
+        target.commit()
+        return inserted, updated, deleted
+    except DataStoreCopyError:
+        target.rollback()
+        raise
+    except Exception as e:
+        target.rollback()
+        raise DataStoreCopyError(str(e).strip())
+    finally:
+        source.rollback()
+        source.close()
+        target.close()
+
+
+def swap_table(source_url, resource_id, fields, checksum=False):
+    """
+    Replace the resource_id DataStore table in the local DataStore
+    database with a copy of the table of the same name in the source_url
+    database without leaving it empty or missing while the rows are
+    copied: the copy is loaded and indexed in a shadow table that is
+    renamed over the existing table in the same transaction. The
+    constraint, indexes and sequence of the shadow table are renamed to
+    the names datastore_create would have used and the DataStore aliases
+    of the existing table are created again for the new table.
+
+    :param source_url: source DataStore database url
+    :param resource_id: DataStore table to replace
+    :param fields: data dictionary fields of the source table, may be
+        different from the fields of the existing table
+    :param checksum: also compare checksums of all the rows before the
+        swap, not only the row counts
+
+    :returns: number of rows copied
+    :raises DataStoreCopyError: when the copy failed or does not match
+        the source, the local table is left unchanged
+    """
+    table = identifier(resource_id)
+    shadow_id = resource_id + SHADOW_SUFFIX
+    shadow = identifier(shadow_id)
+    columns = u', '.join(identifier(c) for c in table_columns(fields))
+
+    source = source_engine(source_url).raw_connection()
+    target = datastore.get_write_engine().connect()
+    trans = target.begin()
+    try:
+        # same table and indexes as datastore_create would create
+        context = {u'connection': target}
+        shadow_dict = {u'resource_id': shadow_id, u'fields': fields}
+        datastore.create_table(context, shadow_dict)
+        # keeps _full_text up to date after the swap like create() does
+        datastore._create_fulltext_trigger(target, shadow_id)
+
+        _copy_rows(
+            source,
+            u'COPY (SELECT {columns} FROM {table}) TO STDOUT '
+            u'(FORMAT binary)'.format(columns=columns, table=table),
+            target.connection,
+            u'COPY {shadow} ({columns}) FROM STDIN '
+            u'(FORMAT binary)'.format(columns=columns, shadow=shadow))
+
+        datastore.create_indexes(context, shadow_dict)
+        sequence = target.execute(
+            u'SELECT pg_get_serial_sequence(%s, %s)',
+            (shadow, u'_id')).scalar()
+        target.execute(
+            u'SELECT setval(%s, max(_id)) FROM {shadow}'.format(
+                shadow=shadow),
+            (sequence,))
+
+        count = _verify(source, target.connection, table, columns, u'_id',
+                        checksum, target_table=shadow)
+
+        indexes = _shadow_index_names(target, shadow_dict, resource_id)
+        aliases = datastore._get_aliases(context, {u'resource_id': resource_id})
+
+        # readers use the existing table until the commit
+        target.execute(u'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE'.format(
+            table=table))
+        # aliases are views of the existing table
+        target.execute(u'DROP TABLE {table} CASCADE'.format(table=table))
+        target.execute(u'ALTER TABLE {shadow} RENAME TO {table}'.format(
+            shadow=shadow, table=table))
+        target.execute(u'ALTER SEQUENCE {sequence} RENAME TO {name}'.format(
+            sequence=sequence, name=identifier(resource_id + u'__id_seq')))
+        target.execute(
+            u'ALTER TABLE {table} RENAME CONSTRAINT {shadow_pkey} '
+            u'TO {pkey}'.format(
+                table=table,
+                shadow_pkey=identifier(shadow_id + u'_pkey'),
+                pkey=identifier(resource_id + u'_pkey')))
+        for shadow_index, index in indexes:
+            target.execute(
+                u'ALTER INDEX IF EXISTS {shadow_index} RENAME TO {index}'.format(
+                    shadow_index=identifier(shadow_index),
+                    index=identifier(index)))
+        if aliases:
+            datastore.create_alias(context, {
+                u'resource_id': resource_id, u'aliases': aliases})
+        trans.commit()
+        return count
+    except DataStoreCopyError:
+        trans.rollback()
+        raise
+    except Exception as e:
+        trans.rollback()
+        raise DataStoreCopyError(str(e).strip())
+    finally:
+        source.rollback()
+        source.close()
+        target.close()
+
+
+def _shadow_index_names(connection, shadow_dict, resource_id):
+    """
+    Return [(shadow table index name, resource_id index name), ...] for
+    the full text indexes created by create_indexes on the shadow table,
+    named after a hash of the table name and indexed expression
+    """
+    expressions = datastore._build_fts_indexes(
+        shadow_dict, u'{fields}',
+        datastore._get_fields(connection, shadow_dict[u'resource_id']))
+    return [
+        (datastore._generate_index_name(shadow_dict[u'resource_id'], e),
+         datastore._generate_index_name(resource_id, e))
+        for e in expressions]
+
+
+def _primary_key(connection, table):
+    """
+    Return the list of primary key columns set with datastore_create
+    for table on connection, or None
+    """
+    with connection.cursor() as cur:
+        cur.execute(
+            u'SELECT array_agg(a.attname::text ORDER BY k.n) '
+            u'FROM pg_index i '
+            u'CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, n) '
+            u'JOIN pg_attribute a '
+            u'ON a.attrelid = i.indrelid AND a.attnum = k.attnum '
+            u'WHERE i.indrelid = %s::regclass '
+            u'AND i.indisunique AND NOT i.indisprimary '
+            u'GROUP BY i.indexrelid ORDER BY i.indexrelid LIMIT 1',
+            (table,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _verify(source, target, table, columns, order_by, checksum=False,
+            target_table=None):
+    """
+    Compare the row counts and optionally the checksums of table on the
+    source and target connections, or target_table on the target
+    connection when given
+
+    :returns: number of rows
+    :raises DataStoreCopyError: when they do not match
+    """
+    target_count, target_checksum = _count_and_checksum(
+        target, target_table or table, columns, order_by, checksum)
+    source_count, source_checksum = _count_and_checksum(
+        source, table, columns, order_by, checksum)
+    if target_count != source_count:
+        raise DataStoreCopyError(
+            u'copied %d rows, source has %d rows' % (
+                target_count, source_count))
+    if target_checksum != source_checksum:
+        raise DataStoreCopyError(u'checksum does not match source')
+    return target_count
+
+
+def _count_and_checksum(connection, table, columns, order_by, checksum=False):
+    """
+    Return (row count, checksum of all the rows or None) for table
+    """
+    with connection.cursor() as cur:
+        if not checksum:
+            cur.execute(u'SELECT count(*), NULL FROM {table}'.format(
+                table=table))
+        else:
+            cur.execute(
+                u'SELECT count(*), md5(string_agg('
+                u'md5(ROW({columns})::text), \'\' ORDER BY {order_by})) '
+                u'FROM {table}'.format(
+                    columns=columns, order_by=order_by, table=table))
+        return cur.fetchone()
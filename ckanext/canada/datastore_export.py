@@ -0,0 +1,233 @@
+"""
+Export PD DataStore tables straight to the filtered CSV files written
+by bin/filter/filter_all.py, with the ckanext.canada.filters specs
+applied in SQL, used by export-filtered
+"""
+import csv
+import io
+import os
+
+from ckan import model
+
+from ckanext.recombinant.tables import get_chromo, get_dataset_types
+
+import ckanext.datastore.backend.postgres as datastore
+from ckanext.datastore.backend.postgres import identifier, literal_string
+
+from ckanext.canada.filters import (
+    FILTERS, BOM, output_fieldnames, nap5_indicator_choices, TRANSFORMS)
+
+# org columns added after the table columns by recombinant combine
+ORG_COLUMNS = [u'owner_org', u'owner_org_title']
+
+
+def _year_month_from(year_column, month_column, year, month):
+    return u'({0}, {1}) >= ({2:d}, {3:d})'.format(
+        identifier(year_column), identifier(month_column), year, month)
+
+
+def _equals(column, value):
+    return u'{0} = {1}'.format(identifier(column), literal_string(value))
+
+
+def _date_after_days_ago(column, days):
+    return u'{0} > current_date - {1:d}'.format(identifier(column), days)
+
+
+# same names and arguments as filters.PREDICATES, returning SQL conditions
+SQL_PREDICATES = {
+    'year_month_from': _year_month_from,
+    'equals': _equals,
+    'date_after_days_ago': _date_after_days_ago,
+}
+
+
+def _truncate(values, column, length):
+    values[column] = u'left({0}, {1:d})'.format(values[column], length)
+
+
+def _fill_empty(values, columns, value):
+    for c in columns:
+        if c in values:
+            values[c] = u"coalesce(nullif({0}, ''), {1})".format(
+                values[c], literal_string(value))
+
+
+def _service_performance(values):
+    def integer(column):
+        return u"{0}::text ~ '^ *[-+]?[0-9]+ *$'".format(identifier(column))
+
+    quarters = [
+        (integer(q + '_performance_result') + u' AND ' +
+            integer(q + '_business_volume'),
+            identifier(q + '_performance_result'),
+            identifier(q + '_business_volume'))
+        for q in ('q1', 'q2', 'q3', 'q4')]
+    num = u' + '.join(
+        u'CASE WHEN {0} THEN {1}::text::bigint ELSE 0 END'.format(c, r)
+        for c, r, v in quarters)
+    den = u' + '.join(
+        u'CASE WHEN {0} THEN {2}::text::bigint ELSE 0 END'.format(c, r, v)
+        for c, r, v in quarters)
+    values['performance'] = (
+        u"CASE WHEN {den} = 0 THEN 'ND' "
+        u"ELSE round(({num})::numeric / ({den}), 5)::text END").format(
+            num=num, den=den)
+
+
+def _nap5_indicators(values):
+    # apply the python transform to each choice to get the same values
+    nap5_indicators = TRANSFORMS['nap5_indicators']()
+    rows = []
+    for code in nap5_indicator_choices():
+        row = {'indicators': code}
+        nap5_indicators(row)
+        rows.append(row)
+    for column in rows[0]:
+        if column == 'indicators':
+            continue
+        values[column] = u'CASE {0} {1} END'.format(
+            identifier('indicators'),
+            u' '.join(
+                u'WHEN {0} THEN {1}'.format(
+                    literal_string(row['indicators']),
+                    literal_string(
+                        u'' if row[column] is None else str(row[column])))
+                for row in rows))
+
+
+# same names and arguments as filters.TRANSFORMS, updating the SQL
+# expressions of the output columns
+SQL_TRANSFORMS = {
+    'truncate': _truncate,
+    'fill_empty': _fill_empty,
+    'service_performance': _service_performance,
+    'nap5_indicators': _nap5_indicators,
+}
+
+
+def _column_value(field):
+    """
+    Return the SQL text expression for a DataStore column, formatted
+    the same way as the recombinant combine csv files written from
+    datastore_search results
+    """
+    column = identifier(field['datastore_id'])
+    if field['datastore_type'] == 'text':
+        return column
+    if field['datastore_type'] == '_text':
+        return u"array_to_string({0}, ',')".format(column)
+    if field['datastore_type'] == 'numeric':
+        # numbers with decimals are python floats in the combine files
+        return (u"CASE WHEN scale({0}) > 0 THEN regexp_replace("
+                u"{0}::float8::text, '^(-?[0-9]+)$', '\\1.0') "
+                u"ELSE {0}::text END").format(column)
+    if field['datastore_type'] == 'date':
+        return u"to_char({0}, 'YYYY-MM-DD')".format(column)
+    if field['datastore_type'] == 'timestamp':
+        return u"to_char({0}, 'YYYY-MM-DD\"T\"HH24:MI:SS')".format(column)
+    return u"to_json({0}) #>> '{{}}'".format(column)
+
+
+def _pd_resources(chromo):
+    """
+    Return [(resource id, org name, org title, {org extra: value}), ...]
+    for the active PD resources of chromo, sorted by org name
+    """
+    extras = chromo.get('csv_org_extras', [])
+    rows = model.Session.execute(
+        u"SELECT r.id, g.name, g.title, e.key, e.value "
+        "FROM resource r "
+        "JOIN package p ON p.id = r.package_id "
+        "JOIN \"group\" g ON g.id = p.owner_org "
+        "LEFT JOIN group_extra e "
+        "ON e.group_id = g.id AND e.state = 'active' AND e.key = ANY(:keys) "
+        "WHERE r.name = :resource_name AND r.state = 'active' "
+        "AND p.type = ANY(:types) AND p.state = 'active' "
+        "ORDER BY g.name, r.id;",
+        {'keys': extras, 'resource_name': chromo['resource_name'],
+         'types': list(get_dataset_types())})
+
+    resources = []
+    for resource_id, name, title, key, value in rows:
+        if not resources or resources[-1][0] != resource_id:
+            resources.append((resource_id, name, title, {}))
+        if key:
+            resources[-1][3][key] = value
+    return resources
+
+
+def export_source(workdir, source_name):
+    """
+    Write all the filtered files of source_name to workdir/filtered
+    directly from the DataStore tables, one COPY per output and table
+    in a single read only snapshot.
+
+    Rows are streamed by COPY so they end with LF instead of the CRLF
+    written by filter_all.py, the values and quoting are the same.
+
+    :returns: [(output name, number of rows), ...]
+    """
+    chromo = get_chromo(source_name[:-len('.csv')])
+    specs = FILTERS[source_name]
+    fields = {f['datastore_id']: f for f in chromo['fields']}
+    org_extras = chromo.get('csv_org_extras', [])
+    fieldnames = list(fields) + ORG_COLUMNS + org_extras
+    resources = _pd_resources(chromo)
+
+    connection = datastore.get_read_engine().raw_connection()
+    try:
+        with connection.cursor() as cur:
+            cur.execute(u'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ '
+                        u'READ ONLY')
+            cur.execute(
+                u'SELECT unnest(%s::text[]) '
+                u'INTERSECT SELECT relname::text FROM pg_class',
+                ([r[0] for r in resources],))
+            tables = set(r[0] for r in cur.fetchall())
+
+        report = []
+        for spec in specs:
+            output = output_fieldnames(spec, fieldnames)
+            where = [SQL_PREDICATES[p[0]](*p[1:])
+                     for p in spec.get('where', [])]
+            count = 0
+            with open(os.path.join(workdir, 'filtered', spec['output']),
+                      'wb') as out:
+                # same line endings as the COPY rows that follow
+                header = io.StringIO()
+                csv.writer(header, lineterminator='\n').writerow(output)
+                out.write((BOM + header.getvalue()).encode('utf-8'))
+
+                for resource_id, name, title, extras in resources:
+                    if resource_id not in tables:
+                        continue
+                    values = dict(
+                        (f, _column_value(fields[f])) for f in fields)
+                    values[u'owner_org'] = literal_string(name)
+                    values[u'owner_org_title'] = literal_string(title)
+                    for e in org_extras:
+                        values[e] = literal_string(extras.get(e, u''))
+                    for t in spec.get('transform', []):
+                        SQL_TRANSFORMS[t[0]](values, *t[1:])
+
+                    # NULL for empty strings so they are written unquoted
+                    # like the csv module does
+                    with connection.cursor() as cur:
+                        cur.copy_expert(
+                            u'COPY (SELECT {columns} FROM {table} {where} '
+                            u'ORDER BY _id) TO STDOUT (FORMAT csv)'.format(
+                                columns=u', '.join(
+                                    u"nullif({0}, '')".format(
+                                        values.get(c, u'NULL'))
+                                    for c in output),
+                                table=identifier(resource_id),
+                                where=u'WHERE ' + u' AND '.join(where)
+                                if where else u''),
+                            out)
+                        count += cur.rowcount
+            report.append((spec['output'], count))
+        return report
+    finally:
+        connection.rollback()
+        connection.close()
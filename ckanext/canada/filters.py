@@ -0,0 +1,364 @@
+"""
+Declarative filters for the nightly PD CSV files and a single pass
+engine that writes every filtered file of a source file while reading it
+once, used by bin/filter/filter_all.py
+
+Each output spec is a dict with:
+
+output
+    filtered file name
+remove
+    columns removed from the output
+first
+    columns moved to the start of the output
+add
+    columns added to the end of the output by the transforms
+where
+    list of predicates, all must match for a row to be included
+transform
+    list of transforms applied to included rows
+
+Predicates and transforms are tuples of a name from PREDICATES or
+TRANSFORMS followed by its arguments.
+"""
+import csv
+import os
+import sys
+from datetime import datetime, timedelta
+
+BOM = u"\N{bom}"
+
+MODIFIED_CREATED = [
+    'record_created',
+    'record_modified',
+    'user_modified',
+]
+
+CONSULTATIONS_REMOVE = [
+    'publishable',
+    'contact_email',
+    'high_profile',
+    'policy_program_lead_email',
+    'rationale',
+    'remarks_en',
+    'remarks_fr',
+    'record_created',
+    'record_modified',
+    'target_participants_and_audience',
+    'user_modified',
+]
+
+# publicly accessible ATI records
+ATI_START = ('year_month_from', 'year', 'month', 2020, 1)
+CONSULTATIONS_PUBLISHABLE = ('equals', 'publishable', 'Y')
+# consultations ended in the past two years
+CONSULTATIONS_CURRENT = ('date_after_days_ago', 'end_date', 365 * 2)
+# truncate status to remove "closed" reason
+CONSULTATIONS_STATUS = ('truncate', 'status', 1)
+
+NAP5_INDICATORS = [
+    'en',  # en/fr description
+    'fr',
+    'due_date',
+    'deadline_en',
+    'deadline_fr',
+    'lead_dept',
+    's4d',
+]
+
+# these fields need some kind of value
+# or drupal search won't work at all
+TRAVELA_DRUPAL_SEARCH_HACK = [
+    'operational_activities_kdollars',
+    'key_stakeholders_kdollars',
+    'training_kdollars',
+    'other_kdollars',
+    'internal_governance_kdollars',
+]
+
+
+def _modified_created(output):
+    return {'output': output, 'remove': MODIFIED_CREATED}
+
+
+# source file: [output spec, ...]
+FILTERS = {
+    'ati.csv': [
+        {'output': 'ati.csv', 'remove': MODIFIED_CREATED,
+         'where': [ATI_START]},
+        _modified_created('ati-all.csv'),
+    ],
+    'ati-nil.csv': [
+        {'output': 'ati-nil.csv', 'remove': MODIFIED_CREATED,
+         'where': [ATI_START]},
+    ],
+    'briefingt.csv': [_modified_created('briefingt.csv')],
+    'briefingt-nil.csv': [_modified_created('briefingt-nil.csv')],
+    'qpnotes.csv': [_modified_created('qpnotes.csv')],
+    'qpnotes-nil.csv': [_modified_created('qpnotes-nil.csv')],
+    'contracts.csv': [_modified_created('contracts.csv')],
+    'contracts-nil.csv': [_modified_created('contracts-nil.csv')],
+    'contractsa.csv': [_modified_created('contractsa.csv')],
+    'consultations.csv': [
+        {'output': 'consultations.csv', 'remove': CONSULTATIONS_REMOVE,
+         'where': [CONSULTATIONS_PUBLISHABLE],
+         'transform': [CONSULTATIONS_STATUS]},
+        {'output': 'current_consultations.csv',
+         'where': [CONSULTATIONS_CURRENT]},
+        {'output': 'current_consultations_open.csv',
+         'remove': CONSULTATIONS_REMOVE,
+         'where': [CONSULTATIONS_PUBLISHABLE, CONSULTATIONS_CURRENT],
+         'transform': [CONSULTATIONS_STATUS]},
+    ],
+    'dac.csv': [_modified_created('dac.csv')],
+    'experiment.csv': [_modified_created('experiment.csv')],
+    'grants.csv': [_modified_created('grants.csv')],
+    'grants-nil.csv': [_modified_created('grants-nil.csv')],
+    'hospitalityq.csv': [_modified_created('hospitalityq.csv')],
+    'hospitalityq-nil.csv': [_modified_created('hospitalityq-nil.csv')],
+    'nap5.csv': [
+        {'output': 'nap5.csv', 'remove': MODIFIED_CREATED,
+         'add': ['indicator_' + ind for ind in NAP5_INDICATORS],
+         'transform': [('nap5_indicators',)]},
+    ],
+    'reclassification.csv': [_modified_created('reclassification.csv')],
+    'reclassification-nil.csv': [
+        _modified_created('reclassification-nil.csv')],
+    'service.csv': [
+        {'output': 'service.csv', 'remove': MODIFIED_CREATED,
+         'first': ['owner_org']},
+    ],
+    'service-std.csv': [
+        {'output': 'service-std.csv', 'remove': MODIFIED_CREATED,
+         'first': ['owner_org'], 'add': ['performance'],
+         'transform': [('service_performance',)]},
+    ],
+    'travela.csv': [
+        {'output': 'travela.csv', 'remove': MODIFIED_CREATED,
+         'transform': [('fill_empty', TRAVELA_DRUPAL_SEARCH_HACK, '.')]},
+    ],
+    'travelq.csv': [_modified_created('travelq.csv')],
+    'travelq-nil.csv': [_modified_created('travelq-nil.csv')],
+    'wrongdoing.csv': [_modified_created('wrongdoing.csv')],
+    'adminaircraft.csv': [
+        {'output': 'adminaircraft.csv',
+         'remove': MODIFIED_CREATED + ['owner_org', 'owner_org_title']},
+    ],
+}
+
+
+def _year_month_from(year_column, month_column, year, month):
+    def year_month_from(row):
+        return (int(row[year_column]), int(row[month_column])) >= (year, month)
+    return year_month_from
+
+
+def _equals(column, value):
+    def equals(row):
+        return row[column] == value
+    return equals
+
+
+def _date_after_days_ago(column, days):
+    start = datetime.today() - timedelta(days)
+
+    def date_after_days_ago(row):
+        return datetime.strptime(row[column], '%Y-%m-%d') > start
+    return date_after_days_ago
+
+
+PREDICATES = {
+    'year_month_from': _year_month_from,
+    'equals': _equals,
+    'date_after_days_ago': _date_after_days_ago,
+}
+
+
+def _truncate(column, length):
+    def truncate(row):
+        row[column] = row[column][:length]
+    return truncate
+
+
+def _fill_empty(columns, value):
+    def fill_empty(row):
+        for c in columns:
+            if c in row and not row[c]:
+                row[c] = value
+    return fill_empty
+
+
+def _service_performance():
+    def service_performance(row):
+        num = 0
+        den = 0
+        for q in ('q1', 'q2', 'q3', 'q4'):
+            try:
+                num, den = (
+                    num + int(row[q + '_performance_result']),
+                    den + int(row[q + '_business_volume']))
+            except ValueError:
+                pass
+        if not den:
+            row['performance'] = 'ND'
+        else:
+            row['performance'] = '%0.5f' % (float(num) / den)
+    return service_performance
+
+
+def nap5_indicator_choices():
+    """
+    Return the nap5 indicators choices from the table yaml
+    """
+    import yaml
+    table_yaml = os.path.join(
+        os.path.dirname(__file__), 'tables', 'nap5.yaml')
+    with open(table_yaml, 'r') as f:
+        table = yaml.safe_load(f)
+    for field in table['resources'][0]['fields']:
+        if field['datastore_id'] == 'indicators':
+            return field['choices']
+    raise Exception('indicators field not found in ' + table_yaml)
+
+
+def _nap5_indicators():
+    indicators = nap5_indicator_choices()
+
+    def nap5_indicators(row):
+        ind_src = indicators[row['indicators']]
+        for ind in NAP5_INDICATORS:
+            if ind.startswith('deadline_'):
+                # special case, this one has an en/fr sub-dict
+                row['indicator_' + ind] = ind_src.get(
+                    'deadline', {}).get(ind.split('_')[1], '')
+            elif isinstance(ind_src.get(ind), bool):
+                row['indicator_' + ind] = 'true' if ind_src.get(ind) else 'false'
+            else:
+                row['indicator_' + ind] = ind_src.get(ind, '')
+    return nap5_indicators
+
+
+TRANSFORMS = {
+    'truncate': _truncate,
+    'fill_empty': _fill_empty,
+    'service_performance': _service_performance,
+    'nap5_indicators': _nap5_indicators,
+}
+
+
+def output_fieldnames(spec, fieldnames):
+    """
+    Return the columns of the output spec for source columns fieldnames
+    """
+    remove = set(spec.get('remove', []))
+    first = [f for f in spec.get('first', []) if f in fieldnames]
+    return first + [
+        f for f in fieldnames if f not in remove and f not in first
+    ] + spec.get('add', [])
+
+
+class _Output(object):
+    """
+    Compiled output spec writing to a file object
+    """
+    def __init__(self, spec, fieldnames, out, bom):
+        self.fieldnames = output_fieldnames(spec, fieldnames)
+        self.where = [PREDICATES[p[0]](*p[1:]) for p in spec.get('where', [])]
+        self.transform = [
+            TRANSFORMS[t[0]](*t[1:]) for t in spec.get('transform', [])]
+        if bom:
+            out.write(BOM)
+        self.writer = csv.DictWriter(
+            out, self.fieldnames, extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write(self, row):
+        try:
+            if not all(w(row) for w in self.where):
+                return
+            if self.transform:
+                # transforms must not change the row for other outputs
+                row = dict(row)
+                for t in self.transform:
+                    t(row)
+            self.writer.writerow(row)
+        except ValueError:
+            pass
+
+
+def filter_csv(source, specs, outputs):
+    """
+    Write the rows of the source csv file object to all the outputs
+    in one pass
+
+    :param source: csv file object, may start with a BOM
+    :param specs: list of output specs
+    :param outputs: list of file objects to write, one for each spec
+    """
+    first_line = source.readline()
+    if not first_line:
+        # empty file -> empty files
+        return
+    bom = first_line.startswith(BOM)
+    if bom:
+        first_line = first_line[len(BOM):]
+
+    def lines():
+        yield first_line
+        for line in source:
+            yield line
+
+    reader = csv.DictReader(lines())
+    compiled = [
+        _Output(spec, reader.fieldnames, out, bom)
+        for spec, out in zip(specs, outputs)]
+    for row in reader:
+        for c in compiled:
+            c.write(row)
+
+
+def filter_source(workdir, source_name):
+    """
+    Write all the filtered files of source_name in workdir to
+    workdir/filtered
+    """
+    specs = FILTERS[source_name]
+    outputs = [
+        open(os.path.join(workdir, 'filtered', spec['output']), 'w',
+             encoding='utf-8', newline='')
+        for spec in specs]
+    try:
+        with open(os.path.join(workdir, source_name), 'r',
+                  encoding='utf-8', newline='') as source:
+            filter_csv(source, specs, outputs)
+    finally:
+        for out in outputs:
+            out.close()
+
+
+def main(argv=None):
+    """
+    filter_all.py WORKDIR [SOURCE.csv ...]
+    filter_all.py --output FILTERED.csv < SOURCE.csv > FILTERED.csv
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) == 2 and argv[0] == '--output':
+        for specs in FILTERS.values():
+            for spec in specs:
+                if spec['output'] == argv[1]:
+                    source = open(sys.stdin.fileno(), 'r', encoding='utf-8',
+                                  newline='', closefd=False)
+                    out = open(sys.stdout.fileno(), 'w', encoding='utf-8',
+                               newline='', closefd=False)
+                    filter_csv(source, [spec], [out])
+                    out.flush()
+                    return
+        sys.exit('unknown output: ' + argv[1])
+    if not argv or argv[0].startswith('-'):
+        sys.exit(main.__doc__)
+
+    workdir = argv[0]
+    if not os.path.isdir(os.path.join(workdir, 'filtered')):
+        os.makedirs(os.path.join(workdir, 'filtered'))
+    for source_name in argv[1:] or sorted(FILTERS):
+        filter_source(workdir, source_name)
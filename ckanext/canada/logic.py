@@ -230,7 +230,12 @@ def datastore_create_temp_user_table(context, drop_on_commit=True):
     a temporary user table.
 
     The table is to pass the current username and sysadmin
-    state to our triggers for marking modified rows
+    state to our triggers for marking modified rows.
+
+    Sysadmins may set context['canada_bulk_load'] for restores and
+    migrations, then the triggers keep the record_created, record_modified
+    and user_modified values given without comparing updated rows to
+    the existing rows
     """
     # __enter__ of context manager
 
@@ -239,18 +244,22 @@ def datastore_create_temp_user_table(context, drop_on_commit=True):
     else:
         from ckanext.datastore.backend.postgres import literal_string
         username = context['user']
+        sysadmin = is_sysadmin(username)
+        bulk_load = sysadmin and asbool(context.get('canada_bulk_load'))
         context['connection'].execute(u'''
             CREATE TEMP TABLE datastore_user (
                 username text NOT NULL,
-                sysadmin boolean NOT NULL
+                sysadmin boolean NOT NULL,
+                bulk_load boolean NOT NULL
                 ){drop_statement};
             INSERT INTO datastore_user VALUES (
-                {username}, {sysadmin}
+                {username}, {sysadmin}, {bulk_load}
                 );
             '''.format(
                 drop_statement=' ON COMMIT DROP' if drop_on_commit else '',
                 username=literal_string(username),
-                sysadmin='TRUE' if is_sysadmin(username) else 'FALSE'))
+                sysadmin='TRUE' if sysadmin else 'FALSE',
+                bulk_load='TRUE' if bulk_load else 'FALSE'))
         yield
 
     # __exit__ of context manager
@@ -529,3 +538,24 @@ def canada_datastore_run_triggers(up_func, context, data_dict):
         context['connection'] = backend._get_write_engine().connect()
     with datastore_create_temp_user_table(context, drop_on_commit=False):
         return up_func(context, data_dict)
+
+
+@chained_action
+def canada_datastore_function_create(up_func, context, data_dict):
+    """
+    Creates PD table trigger functions with their error checks grouped,
+    keeping the source as written in the function comment.
+    """
+    from ckanext.canada import triggers
+    definition = data_dict.get('definition')
+    if data_dict.get('rettype') != 'trigger' or not definition:
+        return up_func(context, data_dict)
+    grouped = triggers.group_error_checks(definition)
+    if grouped == definition:
+        return up_func(context, data_dict)
+    result = up_func(context, dict(data_dict, definition=grouped))
+    backend = DatastoreBackend.get_active_backend()
+    with backend._get_write_engine().begin() as connection:
+        triggers.set_ungrouped_source(
+            connection, data_dict['name'], definition)
+    return result
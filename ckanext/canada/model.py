@@ -0,0 +1,44 @@
+"""
+Tables used by the canada commands, created once with:
+
+    ckan canada init-db
+"""
+from ckan import model
+
+TABLES = [
+    # digest of the last copy of each package by portal-update
+    (u'canada_package_digest',
+     u"CREATE TABLE IF NOT EXISTS canada_package_digest ("
+     "package_id text PRIMARY KEY, "
+     "digest text NOT NULL, "
+     "modified timestamp NOT NULL DEFAULT (now() at time zone 'utc'));"),
+    # digest of each solr record sent to a solr core by pd update
+    (u'canada_pd_index_digest',
+     u"CREATE TABLE IF NOT EXISTS canada_pd_index_digest ("
+     "core text NOT NULL, "
+     "pd_type text NOT NULL, "
+     "id text NOT NULL, "
+     "digest text NOT NULL, "
+     "PRIMARY KEY (core, pd_type, id));"),
+]
+
+
+def tables_exist():
+    """
+    Return True when all the canada tables exist
+    """
+    names = [t[0] for t in TABLES]
+    count = model.Session.execute(
+        u"SELECT count(*) FROM pg_tables "
+        "WHERE schemaname = current_schema() AND tablename = ANY(:names);",
+        {'names': names}).scalar()
+    return count == len(names)
+
+
+def create_tables():
+    """
+    Create the canada tables that do not exist yet
+    """
+    for name, sql in TABLES:
+        model.Session.execute(sql)
+    model.Session.commit()
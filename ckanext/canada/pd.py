@@ -1,11 +1,20 @@
 import click
 import os
+import json
 import hashlib
 import calendar
+import functools
 import time
+import threading
+import multiprocessing
+import sqlite3
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from babel.numbers import format_currency, format_decimal
 
-from ckanapi import LocalCKAN, NotFound
+from ckanapi import LocalCKAN
+from ckan import model
 
 from ckanext.recombinant.tables import (
     get_geno,
@@ -16,14 +25,18 @@ from ckanext.recombinant.read_csv import csv_data_batch
 from ckanext.recombinant.helpers import (
     recombinant_choice_fields,
     recombinant_language_text)
+from ckanext.fluent.validators import fluent_text_output
 
 from ckanext.canada.dataset import (
     MONTHS_FR,
     solr_connection,
     data_batch,
+    dataset_resources,
     safe_for_solr)
+from ckanext.canada import model as canada_model
 
 SOLR_MAX_UTF8_LENGTH = 28000
+SOLR_BATCH_SIZE = 1000
 
 
 def get_commands():
@@ -81,12 +94,32 @@ def clear(pd_type):
      is_flag=True,
     help="If the PD Type is a NIL type.",
 )
-def rebuild(pd_type, files=None, solr_url=None, lenient=False, has_nil=False):
+@click.option(
+    "-p",
+    "--processes",
+    default=1,
+    help="Number of processes building SOLR records, default: 1",
+)
+@click.option(
+    "-w",
+    "--solr-writers",
+    default=1,
+    help="Number of concurrent SOLR writers, default: 1",
+)
+@click.option(
+    "-b",
+    "--batch-size",
+    default=SOLR_BATCH_SIZE,
+    help="Number of SOLR records sent per request, default: %s" % SOLR_BATCH_SIZE,
+)
+def rebuild(pd_type, files=None, solr_url=None, lenient=False, has_nil=False,
+            processes=1, solr_writers=1, batch_size=SOLR_BATCH_SIZE):
     """
     Rebuilds and reindexes all SOLR records.
 
     Full Usage:\n
-        pd <pd-type> rebuild [--lenient] [-f <file>] [-s <solr-url>]
+        pd <pd-type> rebuild [--lenient] [-f <file>] [-s <solr-url>]\n
+                             [-p <num>] [-w <num>] [-b <num>]
 
     For NIL:\n
         pd <pd-type> rebuild [--lenient] [-f <file> <file>] [-s <solr-url>]
@@ -103,20 +136,156 @@ def rebuild(pd_type, files=None, solr_url=None, lenient=False, has_nil=False):
     rebuild(pd_type,
             files,
             solr_url,
-            strict)
+            strict,
+            processes,
+            solr_writers,
+            batch_size)
+
+
+@pd.command(short_help="Updates the SOLR records that changed since the last update.")
+@click.argument("pd_type")
+@click.option(
+    "--lenient",
+    is_flag=True,
+    help="Allow update from csv files without checking that columns match expected columns.",
+)
+@click.option(
+    "-f",
+    "--files",
+    default=None,
+    multiple=True,
+    help="CSV file(s) to use as input (or default CKAN DB). Use PD and PD-nil files for NIL types.",
+)
+@click.option(
+    "-s",
+    "--solr-url",
+    default=None,
+    help="Solr URL for output.",
+)
+@click.option(
+    "-n",
+    "--has-nil",
+     is_flag=True,
+    help="If the PD Type is a NIL type.",
+)
+@click.option(
+    "-b",
+    "--batch-size",
+    default=SOLR_BATCH_SIZE,
+    help="Number of SOLR records sent per request, default: %s" % SOLR_BATCH_SIZE,
+)
+def update(pd_type, files=None, solr_url=None, lenient=False, has_nil=False,
+           batch_size=SOLR_BATCH_SIZE):
+    """
+    Sends only the added, changed and deleted SOLR records since the last
+    update, or rebuilds all SOLR records when there was no previous update.
+
+    Full Usage:\n
+        pd <pd-type> update [--lenient] [-f <file>] [-s <solr-url>] [-b <num>]
+
+    For NIL:\n
+        pd <pd-type> update [--lenient] [-f <file> <file>] [-s <solr-url>]
+    """
+    _check_pd_type(pd_type)
+    if files:
+        if not has_nil and len(files) >= 2:
+            raise ValueError('You may only supply one file for non NIL types')
+        if len(files) > 2:
+            raise ValueError('You may only supply up to two files')
+    if not canada_model.tables_exist():
+        raise click.ClickException(
+            'The canada tables do not exist, run: ckan canada init-db')
+    update(pd_type,
+           files,
+           solr_url,
+           not lenient,
+           batch_size)
+
+
+@pd.command(short_help="Time building SOLR records without sending them.")
+@click.argument("resource_name")
+@click.option(
+    "-f",
+    "--file",
+    "csv_file",
+    default=None,
+    help="CSV file to use as input, default: the example record",
+)
+@click.option(
+    "-n",
+    "--records",
+    default=100000,
+    help="Number of records to build, default: 100000",
+)
+def benchmark(resource_name, csv_file=None, records=100000):
+    """
+    Time building SOLR records for a resource, e.g. contracts, with the
+    field plan and with the field options looked up for every record
+    like before field plans
+
+    Full Usage:\n
+        pd benchmark <resource-name> [-f <file>] [-n <num>]
+    """
+    chromo = get_chromo(resource_name)
+    if csv_file:
+        batch = []
+        for org_id, rows in csv_data_batch(csv_file, chromo, strict=False):
+            batch.extend(dict((k, safe_for_solr(v)) for k, v in
+                         row_dict.items()) for row_dict in rows)
+            if len(batch) >= records:
+                break
+        if not batch:
+            raise click.ClickException('No records in %s' % csv_file)
+    else:
+        example = dict(
+            (k, ','.join(v) if isinstance(v, list) else str(v))
+            for k, v in chromo['examples']['record'].items())
+        batch = [example]
+    batch = (batch * (records // len(batch) + 1))[:records]
+    org_detail = {
+        'name': 'benchmark',
+        'title_translated': {'en': 'Benchmark', 'fr': 'Banc d\'essai'}}
+
+    start = time.time()
+    plan = _field_plan(resource_name)
+    click.echo('field plan: {0:.4f}s'.format(time.time() - start))
+
+    timings = []
+    for name, field_plan in [
+            ('interpreted', _interpreted_field_plan(resource_name)),
+            ('planned', plan)]:
+        start = time.time()
+        for solrrec in _iter_solr_records(
+                batch, org_detail, resource_name, _NO_COMPARE, field_plan):
+            pass
+        elapsed = max(time.time() - start, 1e-6)
+        timings.append(elapsed)
+        click.echo('{0:12s} {1} records: {2:.2f}s, {3:.0f} records/second'.format(
+            name, len(batch), elapsed, len(batch) / elapsed))
+    click.echo('speedup: {0:.2f}x'.format(timings[0] / timings[1]))
 
 
 def clear_index(pd_type, solr_url=None, commit=True):
     conn = solr_connection(pd_type, solr_url)
     conn.delete(q="*:*", commit=commit)
+    # the next update needs to send all the records
+    if canada_model.tables_exist():
+        _delete_index_digests(pd_type, conn.url)
 
 
-def rebuild(pd_type, csv_files=None, solr_url=None, strict=True):
+def rebuild(pd_type, csv_files=None, solr_url=None, strict=True,
+            processes=1, solr_writers=1, batch_size=SOLR_BATCH_SIZE):
     """
     Implement rebuild command
 
     :param csv_file: path to .csv file for input
     :type csv_file: str
+    :param processes: number of processes building solr records
+    :type processes: int
+    :param solr_writers: number of threads sending records to solr
+    :type solr_writers: int
+    :param batch_size: number of records sent per solr request
+    :type batch_size: int
 
     :return: Nothing
     :rtype: None
@@ -125,46 +294,404 @@ def rebuild(pd_type, csv_files=None, solr_url=None, strict=True):
 
     conn = solr_connection(pd_type, solr_url)
     lc = LocalCKAN()
+    org_details = _org_details(pd_type)
+    if processes > 1 or solr_writers > 1:
+        _parallel_rebuild(
+            _rebuild_jobs(pd_type, lc, csv_files, strict, org_details),
+            lambda: solr_connection(pd_type, solr_url),
+            processes,
+            solr_writers,
+            batch_size)
+    else:
+        _add_records_windowed(
+            conn,
+            _stream_solr_records(pd_type, lc, csv_files, strict, org_details),
+            batch_size)
+
+    print("commit")
+    conn.commit()
+
+
+def update(pd_type, csv_files=None, solr_url=None, strict=True,
+           batch_size=SOLR_BATCH_SIZE):
+    """
+    Implement update command, comparing the digest of each solr record
+    with the one stored for the last update
+
+    :param csv_files: paths to .csv files for input
+    :type csv_files: list
+    :param batch_size: number of records sent per solr request
+    :type batch_size: int
+
+    :return: Nothing
+    :rtype: None
+    """
+    conn = solr_connection(pd_type, solr_url)
+    previous = _get_index_digests(pd_type, conn.url)
+    if not previous:
+        # records indexed before the first update are unknown
+        print("no previous update, clearing index")
+        clear_index(pd_type, solr_url, False)
+
+    lc = LocalCKAN()
+    digests = {}
+    pending = []
+    added = changed = unchanged = 0
+    for solrrec in _stream_solr_records(pd_type, lc, csv_files, strict):
+        digest = _solr_record_digest(solrrec)
+        old = previous.pop(solrrec['id'], None)
+        if old == digest:
+            unchanged += 1
+            continue
+        if old is None:
+            added += 1
+        else:
+            changed += 1
+        digests[solrrec['id']] = digest
+        pending.append(solrrec)
+        if len(pending) >= batch_size:
+            _add_records(conn, pending)
+            pending = []
+    _add_records(conn, pending)
+
+    # records left in previous are no longer in the input
+    deleted = list(previous)
+    for i in range(0, len(deleted), batch_size):
+        conn.delete(id=deleted[i:i + batch_size], commit=False)
+
+    print("added {0}, changed {1}, deleted {2}, unchanged {3}".format(
+        added, changed, len(deleted), unchanged))
+    print("commit")
+    conn.commit()
+    _set_index_digests(pd_type, conn.url, digests, deleted)
+
+
+def _solr_record_digest(solrrec):
+    return hashlib.md5(json.dumps(
+        solrrec, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _get_index_digests(pd_type, core):
+    """
+    Return {solr record id: digest} for pd_type in the solr core url
+    """
+    return dict(model.Session.execute(
+        u"SELECT id, digest FROM canada_pd_index_digest "
+        "WHERE core = :core AND pd_type = :pd_type;",
+        {'core': core, 'pd_type': pd_type}).fetchall())
+
+
+def _set_index_digests(pd_type, core, digests, deleted_ids):
+    """
+    Store the digests of the records sent and remove the deleted ones
+    """
+    if digests:
+        model.Session.execute(
+            u"INSERT INTO canada_pd_index_digest (core, pd_type, id, digest) "
+            "VALUES (:core, :pd_type, :id, :digest) "
+            "ON CONFLICT (core, pd_type, id) DO UPDATE "
+            "SET digest = EXCLUDED.digest;",
+            [{'core': core, 'pd_type': pd_type, 'id': i, 'digest': d}
+             for i, d in digests.items()])
+    if deleted_ids:
+        model.Session.execute(
+            u"DELETE FROM canada_pd_index_digest "
+            "WHERE core = :core AND pd_type = :pd_type AND id = ANY(:ids);",
+            {'core': core, 'pd_type': pd_type, 'ids': deleted_ids})
+    model.Session.commit()
+
+
+def _delete_index_digests(pd_type, core):
+    model.Session.execute(
+        u"DELETE FROM canada_pd_index_digest "
+        "WHERE core = :core AND pd_type = :pd_type;",
+        {'core': core, 'pd_type': pd_type})
+    model.Session.commit()
+
+
+def _org_details(pd_type):
+    """
+    Return the active organizations sorted by name, loaded with a single
+    query, with only the fields used to build solr records: id, name,
+    title_translated and the solr_org_fields of pd_type
+    """
+    org_fields = set()
+    for chromo in get_geno(pd_type)['resources']:
+        org_fields.update(chromo.get('solr_org_fields', []))
+
+    rows = model.Session.execute(
+        u"SELECT g.id, g.name, g.title, e.key, e.value "
+        "FROM \"group\" g LEFT JOIN group_extra e "
+        "ON e.group_id = g.id AND e.state = 'active' AND e.key = ANY(:keys) "
+        "WHERE g.is_organization AND g.state = 'active' "
+        "ORDER BY g.name;",
+        {'keys': ['title_translated'] + sorted(org_fields)})
+
+    org_details = []
+    for org_id, name, title, key, value in rows:
+        if not org_details or org_details[-1]['id'] != org_id:
+            en, _sep, fr = title.partition(u' | ')
+            org_details.append({
+                'id': org_id,
+                'name': name,
+                'title_translated': {'en': en, 'fr': fr or en}})
+        if key == 'title_translated':
+            org_details[-1][key] = fluent_text_output(value)
+        elif key:
+            org_details[-1][key] = value
+    return org_details
+
+
+def _org_lookup(org_details):
+    """
+    Return {org id or name: org detail} for org_details
+    """
+    orgs = {}
+    for org_detail in org_details:
+        orgs[org_detail['id']] = org_detail
+        orgs[org_detail['name']] = org_detail
+    return orgs
+
+
+def _rebuild_jobs(pd_type, lc, csv_files=None, strict=True, org_details=None):
+    """
+    Generate (resource_name, org_detail, records) rebuild jobs, one for
+    every input batch
+    """
+    if org_details is None:
+        org_details = _org_details(pd_type)
     if csv_files:
+        orgs = _org_lookup(org_details)
         for csv_file in csv_files:
             print(csv_file + ':')
-            prev_org = None
-            unmatched = None
             firstpart, filename = os.path.split(csv_file)
             assert filename.endswith('.csv')
             resource_name = filename[:-4]
 
             chromo = get_chromo(resource_name)
-            geno = get_geno(chromo['dataset_type'])
-
             for org_id, records in csv_data_batch(csv_file, chromo, strict=strict):
+                org_detail = orgs.get(org_id)
+                if not org_detail:
+                    continue
                 records = [dict((k, safe_for_solr(v)) for k, v in
                             row_dict.items()) for row_dict in records]
-                if org_id != prev_org:
-                    unmatched = None
-                try:
-                    org_detail = lc.action.organization_show(id=org_id)
-                except NotFound:
-                    continue
-                print("    {0:s} {1}".format(org_id, len(records)))
-                unmatched = _update_records(
-                    records, org_detail, conn, resource_name, unmatched)
+                yield resource_name, org_detail, records
     else:
-        for org in lc.action.organization_list():
-            count = 0
-            org_detail = lc.action.organization_show(id=org)
-            unmatched = None
-            for resource_name, records in data_batch(org_detail['id'], lc, pd_type):
-                unmatched = _update_records(
-                    records, org_detail, conn, resource_name, unmatched)
-                count += len(records)
-            print(org, count)
+        org_resources = dataset_resources(pd_type)
+        for org_detail in org_details:
+            for resource_name, records in data_batch(
+                    org_detail['id'], lc, pd_type, org_resources):
+                yield resource_name, org_detail, records
 
-    print("commit")
-    conn.commit()
+
+def _stream_solr_records(pd_type, lc, csv_files=None, strict=True, org_details=None):
+    """
+    Generate the solr records for rebuild one record at a time, reading
+    the input one batch at a time. Records with solr_compare_previous_year
+    fields are generated last, once all the previous years are known.
+    """
+    if org_details is None:
+        org_details = _org_details(pd_type)
+    compare_indexes = {}
+    try:
+        if csv_files:
+            orgs = _org_lookup(org_details)
+            for csv_file in csv_files:
+                print(csv_file + ':')
+                firstpart, filename = os.path.split(csv_file)
+                assert filename.endswith('.csv')
+                resource_name = filename[:-4]
+
+                chromo = get_chromo(resource_name)
+                compare_index = _compare_index(compare_indexes, chromo)
+                for org_id, records in csv_data_batch(csv_file, chromo, strict=strict):
+                    org_detail = orgs.get(org_id)
+                    if not org_detail:
+                        continue
+                    print("    {0:s} {1}".format(org_id, len(records)))
+                    yield from _iter_solr_records(
+                        (dict((k, safe_for_solr(v)) for k, v in row_dict.items())
+                         for row_dict in records),
+                        org_detail, resource_name, compare_index)
+        else:
+            org_resources = dataset_resources(pd_type)
+            for org_detail in org_details:
+                count = 0
+                for resource_name, records in data_batch(
+                        org_detail['id'], lc, pd_type, org_resources):
+                    yield from _iter_solr_records(
+                        records, org_detail, resource_name,
+                        _compare_index(compare_indexes, get_chromo(resource_name)))
+                    count += len(records)
+                print(org_detail['name'], count)
+
+        for compare_index in compare_indexes.values():
+            yield from compare_index.solr_records()
+    finally:
+        for compare_index in compare_indexes.values():
+            compare_index.close()
+
+
+def _add_records_windowed(conn, solr_records, batch_size=SOLR_BATCH_SIZE):
+    """
+    Send solr records to solr core batch_size records at a time
+    """
+    window = []
+    for solrrec in solr_records:
+        window.append(solrrec)
+        if len(window) >= batch_size:
+            _add_records(conn, window)
+            window = []
+    _add_records(conn, window)
 
 
-def _update_records(records, org_detail, conn, resource_name, unmatched, retry=True):
+def _compare_previous_year(chromo):
+    return any('solr_compare_previous_year' in f for f in chromo['fields'])
+
+
+def _compare_index(compare_indexes, chromo):
+    """
+    Return the PreviousYearIndex for chromo from compare_indexes,
+    creating it if required, or None when chromo has no
+    solr_compare_previous_year fields
+    """
+    if not _compare_previous_year(chromo):
+        return None
+    if chromo['resource_name'] not in compare_indexes:
+        compare_indexes[chromo['resource_name']] = PreviousYearIndex(chromo)
+    return compare_indexes[chromo['resource_name']]
+
+
+class PreviousYearIndex(object):
+    """
+    SQLite side table of solr records keyed on organization and year,
+    used to add the solr_compare_previous_year fields to each record
+    from the record of the previous year, whatever the input order
+    """
+    def __init__(self, chromo):
+        self.chromo = chromo
+        self._dbfile = tempfile.NamedTemporaryFile(suffix='.sqlite')
+        self._conn = sqlite3.connect(self._dbfile.name)
+        self._conn.execute(
+            'CREATE TABLE records ('
+            'org text,'
+            'year integer,'
+            'solrrec text,'
+            'PRIMARY KEY (org, year))')
+
+    def add(self, solrrec):
+        """
+        Store solrrec, replacing any record for the same org and year
+        """
+        self._conn.execute(
+            'INSERT OR REPLACE INTO records VALUES (?,?,?)',
+            (solrrec['org_name_code'], int(solrrec['year']),
+             json.dumps(solrrec)))
+
+    def solr_records(self):
+        """
+        Generate all the stored records with the compare fields added
+        for records that have a previous year record
+        """
+        self._conn.commit()
+        rows = self._conn.execute(
+            'SELECT r.solrrec, p.solrrec FROM records r '
+            'LEFT JOIN records p ON p.org = r.org AND p.year = r.year - 1 '
+            'ORDER BY r.org, r.year')
+        for solrrec, prev_solrrec in rows:
+            solrrec = json.loads(solrrec)
+            if prev_solrrec:
+                yield compare_output(json.loads(prev_solrrec), solrrec, self.chromo)
+            else:
+                yield solrrec
+
+    def close(self):
+        self._conn.close()
+        self._dbfile.close()
+
+
+def _build_job_docs(resource_name, org_detail, records):
+    """
+    Return the solr records for a rebuild job, run in a worker process.
+    Records with solr_compare_previous_year fields are returned without
+    the compare fields.
+    """
+    return list(_iter_solr_records(
+        records, org_detail, resource_name, _NO_COMPARE))
+
+
+def _parallel_rebuild(jobs, connection, processes, solr_writers, batch_size):
+    """
+    Build solr records for jobs in a pool of processes and send them in
+    batches from a pool of solr writer threads, keeping a limited number
+    of jobs and batches in flight. Records with solr_compare_previous_year
+    fields are collected in a PreviousYearIndex and sent last.
+
+    :param jobs: (resource_name, org_detail, records) tuples
+    :param connection: function returning a new solr connection
+    """
+    # fork the workers before any threads are started
+    pool = multiprocessing.get_context('fork').Pool(processes)
+    local = threading.local()
+    compare_indexes = {}
+
+    def write(docs):
+        if not hasattr(local, 'conn'):
+            local.conn = connection()
+        _add_records(local.conn, docs)
+
+    building = deque()
+    writing = set()
+
+    def send_window(docs):
+        while len(writing) >= solr_writers * 2:
+            done, pending = wait(writing, return_when=FIRST_COMPLETED)
+            for f in done:
+                f.result()
+            writing.difference_update(done)
+        writing.add(writers.submit(write, docs))
+
+    def send(label, resource_name, result):
+        docs = result.get()
+        print("    {0} {1}".format(label, len(docs)))
+        compare_index = _compare_index(
+            compare_indexes, get_chromo(resource_name))
+        if compare_index:
+            for solrrec in docs:
+                compare_index.add(solrrec)
+            return
+        for i in range(0, len(docs), batch_size):
+            send_window(docs[i:i + batch_size])
+
+    try:
+        with ThreadPoolExecutor(solr_writers) as writers:
+            for resource_name, org_detail, records in jobs:
+                label = '{0:s} {1:s}'.format(org_detail['name'], resource_name)
+                building.append((label, resource_name, pool.apply_async(
+                    _build_job_docs, (resource_name, org_detail, records))))
+                while len(building) > processes * 2:
+                    send(*building.popleft())
+            while building:
+                send(*building.popleft())
+            for compare_index in compare_indexes.values():
+                window = []
+                for solrrec in compare_index.solr_records():
+                    window.append(solrrec)
+                    if len(window) >= batch_size:
+                        send_window(window)
+                        window = []
+                if window:
+                    send_window(window)
+            for f in writing:
+                f.result()
+    finally:
+        pool.terminate()
+        pool.join()
+        for compare_index in compare_indexes.values():
+            compare_index.close()
+
+
+def _update_records(records, org_detail, conn, resource_name, retry=True):
     """
     Update records on solr core
 
@@ -172,9 +699,51 @@ def _update_records(records, org_detail, conn, resource_name, unmatched, retry=T
     :param org_detail: org structure as returned via local CKAN
     :param conn: solr connection
     :param resource_name: type being updated
-    :param unmatched: yet-unmatched values for comparing prev/next year
+    """
+    _add_records(conn, _solr_records(records, org_detail, resource_name), retry)
+
+
+def _solr_records(records, org_detail, resource_name):
+    """
+    Build solr records, matching previous years only within records
+
+    :param records: record dicts
+    :param org_detail: org structure as returned via local CKAN
+    :param resource_name: type being updated
+
+    :returns: list of solr records
+    """
+    compare_indexes = {}
+    try:
+        compare_index = _compare_index(
+            compare_indexes, get_chromo(resource_name))
+        out = list(_iter_solr_records(
+            records, org_detail, resource_name, compare_index))
+        if compare_index:
+            out.extend(compare_index.solr_records())
+        return out
+    finally:
+        for compare_index in compare_indexes.values():
+            compare_index.close()
+
+
+# passed as compare_index to build records without compare fields
+_NO_COMPARE = object()
+
+
+def _iter_solr_records(records, org_detail, resource_name, compare_index=None,
+                       plan=None):
+    """
+    Generate solr records for records. Records with
+    solr_compare_previous_year fields are added to compare_index
+    instead of being generated.
 
-    :returns: new unmatched for next call for same org+resource_name
+    :param records: iterable of record dicts
+    :param org_detail: org structure as returned via local CKAN
+    :param resource_name: type being updated
+    :param compare_index: PreviousYearIndex for resource_name, or
+        _NO_COMPARE to generate records without the compare fields
+    :param plan: field plan, default: _field_plan(resource_name)
     """
     chromo = get_chromo(resource_name)
     pk = chromo.get('datastore_primary_key', [])
@@ -196,32 +765,19 @@ def _update_records(records, org_detail, conn, resource_name, unmatched, retry=T
                 p += u'|' + str(r[k])
         return s, f, p
 
-    out = []
-
-    choice_fields = recombinant_choice_fields(resource_name, all_languages=True)
-
-    if any('solr_compare_previous_year' in f for f in chromo['fields']):
-        if not unmatched:
-            # previous years, next years
-            unmatched = ({}, {})
-    else:
-        unmatched = None
+    if plan is None:
+        plan = _field_plan(resource_name)
 
     # track failed choice fields for debugging
     # and cleaning up old data.
     failed_choices = {}
 
-    def _record_failed_choice(_key, _value):
-        if _key not in failed_choices:
-            failed_choices[_key] = {}
-        if _value not in failed_choices[_key]:
-            failed_choices[_key][_value] = 1
-        else:
-            failed_choices[_key][_value] += 1
+    legacy_ati_ids = chromo.get('solr_legacy_ati_ids', False)
+    org_fields = chromo.get('solr_org_fields')
 
     for r in records:
         unique, friendly, partial = unique_id(r)
-        if chromo.get('solr_legacy_ati_ids', False):
+        if legacy_ati_ids:
             # for compatibility with existing urls
             unique = hashlib.md5((orghash
                 + r.get('request_number', repr((int(r['year']), int(r['month'])))
@@ -236,92 +792,15 @@ def _update_records(records, org_detail, conn, resource_name, unmatched, retry=T
             'org_name_fr': org_detail['title_translated']['fr'],
             }
 
-        org_fields = chromo.get('solr_org_fields')
         if org_fields:
             for e in org_fields:
                 if e in org_detail:
                     solrrec[e] = org_detail[e]
 
-        for f in chromo['fields']:
-            key = f['datastore_id']
+        for key, steps in plan:
             value = r.get(key, '')
-
-            facet_range = f.get('solr_dollar_range_facet')
-            if facet_range:
-                try:
-                    float_value = float(value.replace('$','').replace(',',''))
-                except ValueError:
-                    pass
-                else:
-                    solrrec.update(dollar_range_facet(
-                        key,
-                        facet_range,
-                        float_value))
-
-            sum_to = list_or_none(f.get('solr_sum_to_field'))
-            if sum_to:
-                for fname in sum_to:
-                    sum_to_field(solrrec, fname, value)
-
-            if f.get('datastore_type') == 'date':
-                try:
-                    value = date2zulu(value)
-                    # CM: If this only applies to PD types this should be accurate
-                    # CM: This should only apply if valid (as per date2zulu) else NULL
-                    if f.get('extract_date_year'):
-                        solrrec['date_year'] = value.split('-', 1)[0]
-                    if f.get('extract_date_month'):
-                        solrrec['date_month'] = value.split('-')[1]
-                    if f.get('extract_date_clean'):
-                        solrrec['date_clean'] = value
-                except ValueError:
-                    pass
-            elif f.get('extract_date_year'):
-                if f.get('datastore_type') == 'year':
-                    solrrec['date_year'] = value
-                else:
-                    try:
-                        solrrec['date_year'] = int(value.split('-', 1)[0])
-                    except ValueError:
-                        pass
-            if f.get('extract_double_sortable'):
-                try:
-                    solrrec['doubl_' + key] = float(value)
-                except ValueError:
-                    pass
-
-            # limit text values to 28kB for indexing. Solr max 32kB minus a threshold for synonym replacements.
-            solrrec[key] = value.encode('utf-8')[:SOLR_MAX_UTF8_LENGTH].decode() if (f.get('datastore_type') == 'text' and len(value.encode('utf-8')) > SOLR_MAX_UTF8_LENGTH) else value
-
-            choices = choice_fields.get(f['datastore_id'])
-            if choices:
-                if key.endswith('_code'):
-                    key = key[:-5]
-                if f.get('datastore_type') == '_text':
-                    # special handling for _text types, joining the multiple choices with semicolons (;)
-                    english_choices = []
-                    french_choices = []
-                    for v in value.split(','):
-                        choice = dict(choices).get(v)
-                        if (not choice and v) or (not v and (f.get('form_required') or f.get('excel_required'))):
-                            # not a valid choice, or empty value on a required field
-                            _record_failed_choice(key, v)
-                        if choice:
-                            english_choices.append(recombinant_language_text(choice, 'en'))
-                            french_choices.append(recombinant_language_text(choice, 'fr'))
-                    solrrec[key + '_en'] = '; '.join(english_choices)
-                    solrrec[key + '_fr'] = '; '.join(french_choices)
-                else:
-                    choice = dict(choices).get(value, {})
-                    if (not choice and value) or (not value and (f.get('form_required') or f.get('excel_required'))):
-                        # not a valid choice, or empty value on a required field
-                        _record_failed_choice(key, value)
-                    _add_choice(solrrec, key, r, choice, f)
-
-            if f.get('solr_month_names', False):
-                solrrec[key] = str(value).zfill(2)
-                solrrec[key + '_name_en'] = calendar.month_name[int(value)]
-                solrrec[key + '_name_fr'] = MONTHS_FR[int(value)]
+            for step in steps:
+                value = step(solrrec, r, value, failed_choices)
 
         solrrec['text'] = u' '.join(str(v) for v in solrrec.values())
 
@@ -337,10 +816,10 @@ def _update_records(records, org_detail, conn, resource_name, unmatched, retry=T
                 ssrf['facet_values'],
                 float_value))
 
-        if unmatched:
-            match_compare_output(solrrec, out, unmatched, chromo)
+        if compare_index and compare_index is not _NO_COMPARE:
+            compare_index.add(solrrec)
         else:
-            out.append(solrrec)
+            yield solrrec
 
     if failed_choices:
         for _key, _values in failed_choices.items():
@@ -350,9 +829,12 @@ def _update_records(records, org_detail, conn, resource_name, unmatched, retry=T
                                                                             _value,
                                                                             _count))
 
-    if unmatched:
-        out.extend(unmatched[1].values())
 
+def _add_records(conn, out, retry=True):
+    """
+    Send solr records to solr core without committing, waiting and
+    retrying when solr is not responding
+    """
     import pysolr
     for a in reversed(range(10)):
         try:
@@ -363,10 +845,271 @@ def _update_records(records, org_detail, conn, resource_name, unmatched, retry=T
             if not a or not retry:
                 raise
             print("waiting...")
-            import time
             time.sleep((10-a) * 5)
             print("retrying...")
-    return unmatched
+
+
+def _field_plan(resource_name):
+    """
+    Return the (datastore_id, steps) list used to add the solr fields of
+    each field of resource_name to a solr record, built once per
+    resource_name. Each step is called as
+    step(solrrec, record, value, failed_choices) and returns the value
+    for the next step.
+    """
+    plan = _field_plans.get(resource_name)
+    if plan is None:
+        chromo = get_chromo(resource_name)
+        choice_fields = recombinant_choice_fields(
+            resource_name, all_languages=True)
+        plan = _field_plans[resource_name] = [
+            (f['datastore_id'],
+             _field_steps(f, choice_fields.get(f['datastore_id'])))
+            for f in chromo['fields']]
+    return plan
+
+
+_field_plans = {}
+
+
+def _field_steps(f, choices):
+    """
+    Return the steps for field f, with only the transforms it uses
+    """
+    key = f['datastore_id']
+    datastore_type = f.get('datastore_type')
+    steps = []
+
+    facet_range = f.get('solr_dollar_range_facet')
+    if facet_range:
+        def dollar_range(solrrec, r, value, failed_choices):
+            try:
+                float_value = float(value.replace('$','').replace(',',''))
+            except ValueError:
+                pass
+            else:
+                solrrec.update(dollar_range_facet(
+                    key,
+                    facet_range,
+                    float_value))
+            return value
+        steps.append(dollar_range)
+
+    sum_to = list_or_none(f.get('solr_sum_to_field'))
+    if sum_to:
+        def sum_to_fields(solrrec, r, value, failed_choices):
+            for fname in sum_to:
+                sum_to_field(solrrec, fname, value)
+            return value
+        steps.append(sum_to_fields)
+
+    extract_year = f.get('extract_date_year')
+    if datastore_type == 'date':
+        extract_month = f.get('extract_date_month')
+        extract_clean = f.get('extract_date_clean')
+
+        def date(solrrec, r, value, failed_choices):
+            try:
+                value = date2zulu(value)
+                # CM: If this only applies to PD types this should be accurate
+                # CM: This should only apply if valid (as per date2zulu) else NULL
+                if extract_year:
+                    solrrec['date_year'] = value.split('-', 1)[0]
+                if extract_month:
+                    solrrec['date_month'] = value.split('-')[1]
+                if extract_clean:
+                    solrrec['date_clean'] = value
+            except ValueError:
+                pass
+            return value
+        steps.append(date)
+    elif extract_year and datastore_type == 'year':
+        def date_year(solrrec, r, value, failed_choices):
+            solrrec['date_year'] = value
+            return value
+        steps.append(date_year)
+    elif extract_year:
+        def date_year(solrrec, r, value, failed_choices):
+            try:
+                solrrec['date_year'] = int(value.split('-', 1)[0])
+            except ValueError:
+                pass
+            return value
+        steps.append(date_year)
+
+    if f.get('extract_double_sortable'):
+        double_key = 'doubl_' + key
+
+        def double_sortable(solrrec, r, value, failed_choices):
+            try:
+                solrrec[double_key] = float(value)
+            except ValueError:
+                pass
+            return value
+        steps.append(double_sortable)
+
+    if datastore_type == 'text':
+        def text(solrrec, r, value, failed_choices):
+            # limit text values to 28kB for indexing. Solr max 32kB minus a threshold for synonym replacements.
+            if len(value) * 4 > SOLR_MAX_UTF8_LENGTH:
+                encoded = value.encode('utf-8')
+                if len(encoded) > SOLR_MAX_UTF8_LENGTH:
+                    solrrec[key] = encoded[:SOLR_MAX_UTF8_LENGTH].decode()
+                    return value
+            solrrec[key] = value
+            return value
+        steps.append(text)
+    else:
+        def store(solrrec, r, value, failed_choices):
+            solrrec[key] = value
+            return value
+        steps.append(store)
+
+    solr_key = key
+    if choices:
+        if solr_key.endswith('_code'):
+            solr_key = solr_key[:-5]
+        key_en = solr_key + '_en'
+        key_fr = solr_key + '_fr'
+        choice_dict = dict(choices)
+        required = f.get('form_required') or f.get('excel_required')
+
+        if datastore_type == '_text':
+            def multiple_choice(solrrec, r, value, failed_choices):
+                # special handling for _text types, joining the multiple choices with semicolons (;)
+                english_choices = []
+                french_choices = []
+                for v in value.split(','):
+                    choice = choice_dict.get(v)
+                    if (not choice and v) or (not v and required):
+                        # not a valid choice, or empty value on a required field
+                        _record_failed_choice(failed_choices, solr_key, v)
+                    if choice:
+                        english_choices.append(recombinant_language_text(choice, 'en'))
+                        french_choices.append(recombinant_language_text(choice, 'fr'))
+                solrrec[key_en] = '; '.join(english_choices)
+                solrrec[key_fr] = '; '.join(french_choices)
+                return value
+            steps.append(multiple_choice)
+        else:
+            def single_choice(solrrec, r, value, failed_choices):
+                choice = choice_dict.get(value, {})
+                if (not choice and value) or (not value and required):
+                    # not a valid choice, or empty value on a required field
+                    _record_failed_choice(failed_choices, solr_key, value)
+                _add_choice(solrrec, solr_key, r, choice, f)
+                return value
+            steps.append(single_choice)
+
+    if f.get('solr_month_names', False):
+        def month_names(solrrec, r, value, failed_choices):
+            solrrec[solr_key] = str(value).zfill(2)
+            solrrec[solr_key + '_name_en'] = calendar.month_name[int(value)]
+            solrrec[solr_key + '_name_fr'] = MONTHS_FR[int(value)]
+            return value
+        steps.append(month_names)
+
+    return steps
+
+
+def _interpreted_field_plan(resource_name):
+    """
+    Return a plan for the same solr fields as _field_plan with a single
+    step per field looking up all the field options for every record,
+    the way records were built before field plans. Used by pd benchmark
+    to compare both.
+    """
+    chromo = get_chromo(resource_name)
+    choice_fields = recombinant_choice_fields(resource_name, all_languages=True)
+    return [
+        (f['datastore_id'],
+         [functools.partial(_interpret_field, f, choice_fields)])
+        for f in chromo['fields']]
+
+
+def _interpret_field(f, choice_fields, solrrec, r, value, failed_choices):
+    key = f['datastore_id']
+
+    facet_range = f.get('solr_dollar_range_facet')
+    if facet_range:
+        try:
+            float_value = float(value.replace('$','').replace(',',''))
+        except ValueError:
+            pass
+        else:
+            solrrec.update(dollar_range_facet(
+                key,
+                facet_range,
+                float_value))
+
+    sum_to = list_or_none(f.get('solr_sum_to_field'))
+    if sum_to:
+        for fname in sum_to:
+            sum_to_field(solrrec, fname, value)
+
+    if f.get('datastore_type') == 'date':
+        try:
+            value = date2zulu(value)
+            if f.get('extract_date_year'):
+                solrrec['date_year'] = value.split('-', 1)[0]
+            if f.get('extract_date_month'):
+                solrrec['date_month'] = value.split('-')[1]
+            if f.get('extract_date_clean'):
+                solrrec['date_clean'] = value
+        except ValueError:
+            pass
+    elif f.get('extract_date_year'):
+        if f.get('datastore_type') == 'year':
+            solrrec['date_year'] = value
+        else:
+            try:
+                solrrec['date_year'] = int(value.split('-', 1)[0])
+            except ValueError:
+                pass
+    if f.get('extract_double_sortable'):
+        try:
+            solrrec['doubl_' + key] = float(value)
+        except ValueError:
+            pass
+
+    solrrec[key] = value.encode('utf-8')[:SOLR_MAX_UTF8_LENGTH].decode() if (f.get('datastore_type') == 'text' and len(value.encode('utf-8')) > SOLR_MAX_UTF8_LENGTH) else value
+
+    choices = choice_fields.get(f['datastore_id'])
+    if choices:
+        if key.endswith('_code'):
+            key = key[:-5]
+        if f.get('datastore_type') == '_text':
+            english_choices = []
+            french_choices = []
+            for v in value.split(','):
+                choice = dict(choices).get(v)
+                if (not choice and v) or (not v and (f.get('form_required') or f.get('excel_required'))):
+                    _record_failed_choice(failed_choices, key, v)
+                if choice:
+                    english_choices.append(recombinant_language_text(choice, 'en'))
+                    french_choices.append(recombinant_language_text(choice, 'fr'))
+            solrrec[key + '_en'] = '; '.join(english_choices)
+            solrrec[key + '_fr'] = '; '.join(french_choices)
+        else:
+            choice = dict(choices).get(value, {})
+            if (not choice and value) or (not value and (f.get('form_required') or f.get('excel_required'))):
+                _record_failed_choice(failed_choices, key, value)
+            _add_choice(solrrec, key, r, choice, f)
+
+    if f.get('solr_month_names', False):
+        solrrec[key] = str(value).zfill(2)
+        solrrec[key + '_name_en'] = calendar.month_name[int(value)]
+        solrrec[key + '_name_fr'] = MONTHS_FR[int(value)]
+    return value
+
+
+def _record_failed_choice(failed_choices, key, value):
+    if key not in failed_choices:
+        failed_choices[key] = {}
+    if value not in failed_choices[key]:
+        failed_choices[key][value] = 1
+    else:
+        failed_choices[key][value] += 1
 
 
 def _add_choice(solrrec, key, record, choice, field):
@@ -515,25 +1258,6 @@ def sum_to_field(solrrec, key, value):
         pass # None can stay as None
 
 
-def match_compare_output(solrrec, out, unmatched, chromo):
-    """
-    pop matching prev/next records from unmatched, create compare fields
-    and append on out
-    """
-    year = int(solrrec['year'])
-    prev_years, next_years = unmatched
-    p_rec = prev_years.pop(year - 1, None)
-    if p_rec:
-        out.append(compare_output(p_rec, solrrec, chromo))
-    else:
-        next_years[year] = solrrec
-    n_rec = next_years.pop(year + 1, None)
-    if n_rec:
-        out.append(compare_output(solrrec, n_rec, chromo))
-    else:
-        prev_years[year] = solrrec
-
-
 def compare_output(prev_solrrec, solrrec, chromo):
     """
     process solr_compare_previous_year fields and return solrrec with
@@ -5,6 +5,10 @@ from ckanext.validation.model import (
     tables_exist as validation_tables_exist
 )
 from ckanext.security.model import db_setup as security_db_setup
+from ckanext.canada.model import (
+    create_tables as canada_create_tables,
+    tables_exist as canada_tables_exist
+)
 
 class CanadaTestBase(object):
     @classmethod
@@ -17,3 +21,5 @@ class CanadaTestBase(object):
         if not validation_tables_exist():
             validation_create_tables()
         security_db_setup()
+        if not canada_tables_exist():
+            canada_create_tables()
@@ -0,0 +1,254 @@
+# -*- coding: UTF-8 -*-
+import pytest
+
+from ckan.plugins.toolkit import config
+from ckanapi import LocalCKAN
+
+from ckanext.canada.tests import CanadaTestBase
+from ckanext.canada.tests.factories import (
+    CanadaResource as Resource,
+)
+from ckanext.datastore.backend.postgres import get_write_engine, identifier
+
+from ckanext.canada import datastore_copy
+
+# the source tables are created in this schema of the DataStore database
+SOURCE_SCHEMA = u'copy_source'
+
+FIELDS = [
+    {'id': 'name', 'type': 'text'},
+    {'id': 'n', 'type': 'int'},
+]
+
+
+class TestDataStoreCopy(CanadaTestBase):
+    @classmethod
+    def setup_method(self, method):
+        """Method is called at class level before EACH test methods of the class are called.
+        Setup any state specific to the execution of the given class methods.
+        """
+        super(TestDataStoreCopy, self).setup_method(method)
+
+        self.action = LocalCKAN().action
+        self.resource_id = Resource()['id']
+        # the same database seen through another search_path
+        self.source_url = config['ckan.datastore.write_url'] + (
+            u'&' if u'?' in config['ckan.datastore.write_url'] else u'?'
+        ) + u'options=-csearch_path%3D' + SOURCE_SCHEMA
+        with get_write_engine().begin() as connection:
+            connection.execute(u'DROP SCHEMA IF EXISTS {0} CASCADE'.format(
+                SOURCE_SCHEMA))
+            connection.execute(u'CREATE SCHEMA {0}'.format(SOURCE_SCHEMA))
+
+
+    @classmethod
+    def teardown_method(self):
+        """Method is called at class level after EACH test methods of the class are called.
+        Close any state specific to the execution of the given class methods.
+        """
+        with get_write_engine().begin() as connection:
+            connection.execute(u'DROP SCHEMA IF EXISTS {0} CASCADE'.format(
+                SOURCE_SCHEMA))
+
+
+    def _create_target(self, records=None, fields=FIELDS, primary_key=None):
+        data_dict = {'resource_id': self.resource_id, 'fields': fields,
+                     'records': records or [], 'force': True}
+        if primary_key:
+            data_dict['primary_key'] = primary_key
+        self.action.datastore_create(**data_dict)
+        # the same _full_text as the source rows
+        with get_write_engine().begin() as connection:
+            connection.execute(u'UPDATE {0} SET _full_text = NULL'.format(
+                identifier(self.resource_id)))
+
+
+    def _create_source(self, rows, fields=FIELDS, primary_key=None):
+        """
+        Create the source table for rows of (_id, value, ...) in the
+        source schema, with a unique index on primary_key like
+        datastore_create
+        """
+        table = u'{0}.{1}'.format(SOURCE_SCHEMA, identifier(self.resource_id))
+        columns = u', '.join(
+            [u'_id'] + [identifier(f['id']) for f in fields])
+        with get_write_engine().begin() as connection:
+            connection.execute(
+                u'CREATE TABLE {table} (_id int PRIMARY KEY, '
+                u'_full_text tsvector, {columns})'.format(
+                    table=table,
+                    columns=u', '.join(
+                        u'{0} {1}'.format(identifier(f['id']), f['type'])
+                        for f in fields)))
+            for row in rows:
+                connection.execute(
+                    u'INSERT INTO {table} ({columns}) VALUES ({values})'.format(
+                        table=table, columns=columns,
+                        values=u', '.join([u'%s'] * len(row))),
+                    row)
+            if primary_key:
+                connection.execute(
+                    u'CREATE UNIQUE INDEX ON {table} ({columns})'.format(
+                        table=table,
+                        columns=u', '.join(identifier(c) for c in primary_key)))
+
+
+    def _target_rows(self):
+        with get_write_engine().begin() as connection:
+            return [tuple(r) for r in connection.execute(
+                u'SELECT _id, name, n FROM {0} ORDER BY _id'.format(
+                    identifier(self.resource_id)))]
+
+
+    def _insert_target(self, name):
+        with get_write_engine().begin() as connection:
+            return connection.execute(
+                u'INSERT INTO {0} (name) VALUES (%s) RETURNING _id'.format(
+                    identifier(self.resource_id)), name).scalar()
+
+
+    def test_copy_table(self):
+        self._create_target()
+        self._create_source([(1, 'a', 1), (2, 'b', 2), (5, 'c', None)])
+
+        assert datastore_copy.copy_table(
+            self.source_url, self.resource_id, FIELDS) == 3
+        assert self._target_rows() == [(1, 'a', 1), (2, 'b', 2), (5, 'c', None)]
+
+
+    def test_copy_table_sets_sequence(self):
+        self._create_target()
+        self._create_source([(1, 'a', 1), (7, 'b', 2)])
+
+        datastore_copy.copy_table(self.source_url, self.resource_id, FIELDS)
+        assert self._insert_target('new') == 8
+
+
+    def test_copy_table_checksum(self):
+        self._create_target()
+        self._create_source([(1, 'a', 1), (2, 'b', 2)])
+
+        assert datastore_copy.copy_table(
+            self.source_url, self.resource_id, FIELDS, checksum=True) == 2
+
+
+    def test_copy_table_rollback(self):
+        self._create_target(records=[{'name': 'existing', 'n': 0}])
+        # _id 1 is already used in the target table
+        self._create_source([(1, 'a', 1), (2, 'b', 2)])
+
+        with pytest.raises(datastore_copy.DataStoreCopyError):
+            datastore_copy.copy_table(
+                self.source_url, self.resource_id, FIELDS)
+        assert self._target_rows() == [(1, 'existing', 0)]
+
+
+    def test_count_and_checksum(self):
+        self._create_target(records=[{'name': 'a', 'n': 1}])
+        table = identifier(self.resource_id)
+        columns = u', '.join(
+            identifier(c) for c in datastore_copy.table_columns(FIELDS))
+        connection = get_write_engine().raw_connection()
+        try:
+            count, checksum = datastore_copy._count_and_checksum(
+                connection, table, columns, u'_id')
+            assert (count, checksum) == (1, None)
+            count, checksum = datastore_copy._count_and_checksum(
+                connection, table, columns, u'_id', checksum=True)
+            assert count == 1
+            assert checksum
+        finally:
+            connection.rollback()
+            connection.close()
+
+
+    def test_sync_table_by_id(self):
+        self._create_target(records=[
+            {'name': 'a', 'n': 1}, {'name': 'b', 'n': 2}, {'name': 'c', 'n': 3}])
+        self._create_source([(1, 'a', 1), (2, 'b', 22), (5, 'e', 5)])
+
+        assert datastore_copy.sync_table(
+            self.source_url, self.resource_id, FIELDS) == (1, 1, 1)
+        assert self._target_rows() == [(1, 'a', 1), (2, 'b', 22), (5, 'e', 5)]
+        assert self._insert_target('new') == 6
+
+
+    def test_sync_table_by_primary_key(self):
+        # portal tables have no primary key, the source table does
+        self._create_target(records=[
+            {'name': 'a', 'n': 1}, {'name': 'b', 'n': 2}, {'name': 'c', 'n': 3}])
+        self._create_source(
+            [(10, 'a', 1), (11, 'b', 22), (12, 'd', 4)], primary_key=['name'])
+
+        assert datastore_copy.sync_table(
+            self.source_url, self.resource_id, FIELDS,
+            checksum=True) == (1, 1, 1)
+        # _id values are left to the target sequence
+        assert self._target_rows() == [(1, 'a', 1), (2, 'b', 22), (4, 'd', 4)]
+
+
+    def test_sync_table_deletes(self):
+        self._create_target(records=[
+            {'name': 'a', 'n': 1}, {'name': 'b', 'n': 2}])
+        self._create_source([])
+
+        assert datastore_copy.sync_table(
+            self.source_url, self.resource_id, FIELDS) == (0, 0, 2)
+        assert self._target_rows() == []
+
+
+    def test_sync_table_unchanged(self):
+        self._create_target(records=[
+            {'name': 'a', 'n': 1}, {'name': 'b', 'n': 2}])
+        self._create_source([(1, 'a', 1), (2, 'b', 2)], primary_key=['name'])
+
+        assert datastore_copy.sync_table(
+            self.source_url, self.resource_id, FIELDS) == (0, 0, 0)
+        assert self._target_rows() == [(1, 'a', 1), (2, 'b', 2)]
+
+
+    def test_swap_table(self):
+        self._create_target(records=[{'name': 'old', 'n': 0}])
+        self._create_source([(1, 'a', 1), (4, 'b', 2)])
+
+        assert datastore_copy.swap_table(
+            self.source_url, self.resource_id, FIELDS, checksum=True) == 2
+        assert self._target_rows() == [(1, 'a', 1), (4, 'b', 2)]
+        assert self._insert_target('new') == 5
+
+        # the full text trigger of datastore_create is kept
+        with get_write_engine().begin() as connection:
+            assert connection.execute(
+                u'SELECT count(*) FROM pg_trigger '
+                u'WHERE tgrelid = %s::regclass AND tgname = %s',
+                identifier(self.resource_id), u'zfulltext').scalar() == 1
+
+
+    def test_swap_table_twice(self):
+        self._create_target(records=[{'name': 'old', 'n': 0}])
+        self._create_source([(1, 'a', 1), (2, 'b', 2)])
+
+        datastore_copy.swap_table(self.source_url, self.resource_id, FIELDS)
+        datastore_copy.swap_table(self.source_url, self.resource_id, FIELDS)
+        assert self._target_rows() == [(1, 'a', 1), (2, 'b', 2)]
+
+        # the names datastore_create would have used
+        with get_write_engine().begin() as connection:
+            names = set(r[0] for r in connection.execute(
+                u'SELECT relname FROM pg_class WHERE relname LIKE %s',
+                self.resource_id + u'%'))
+        assert names == set([
+            self.resource_id, self.resource_id + u'_pkey',
+            self.resource_id + u'__id_seq'])
+
+
+    def test_swap_table_alias(self):
+        self.action.datastore_create(
+            resource_id=self.resource_id, fields=FIELDS, aliases='swap_alias',
+            records=[{'name': 'old', 'n': 0}], force=True)
+        self._create_source([(1, 'a', 1)])
+
+        datastore_copy.swap_table(self.source_url, self.resource_id, FIELDS)
+        records = self.action.datastore_search(
+            resource_id='swap_alias')['records']
+        assert [r['name'] for r in records] == ['a']
@@ -0,0 +1,153 @@
+# -*- coding: UTF-8 -*-
+import csv
+import io
+import os
+import shutil
+from tempfile import mkdtemp
+
+from ckan.cli.cli import ckan
+from ckanext.canada.tests import CanadaTestBase
+from ckanapi import LocalCKAN
+
+from ckanext.canada.tests.factories import CanadaOrganization as Organization
+from ckanext.recombinant.tables import get_chromo
+
+from ckanext.canada.filters import FILTERS, BOM, filter_csv, filter_source
+from ckanext.canada.datastore_export import export_source
+
+
+def _filter(source_name, text):
+    specs = FILTERS[source_name]
+    outputs = [io.StringIO() for s in specs]
+    filter_csv(io.StringIO(text), specs, outputs)
+    return dict((s['output'], o.getvalue()) for s, o in zip(specs, outputs))
+
+
+def test_ati_outputs_in_one_pass():
+    out = _filter('ati.csv', BOM + (
+        'year,month,request_number,record_created,record_modified,user_modified\r\n'
+        '2019,12,A-1,a,b,c\r\n'
+        '2020,1,A-2,a,b,c\r\n'))
+
+    assert out['ati.csv'] == BOM + (
+        'year,month,request_number\r\n'
+        '2020,1,A-2\r\n')
+    assert out['ati-all.csv'] == BOM + (
+        'year,month,request_number\r\n'
+        '2019,12,A-1\r\n'
+        '2020,1,A-2\r\n')
+
+
+def test_consultations_transform_does_not_change_other_outputs():
+    out = _filter('consultations.csv', (
+        'publishable,status,end_date,contact_email\r\n'
+        'Y,CA,2099-01-01,a@example.com\r\n'
+        'N,O,2099-01-01,b@example.com\r\n'
+        'Y,O,2001-01-01,c@example.com\r\n'))
+
+    assert out['consultations.csv'] == (
+        'status,end_date\r\n'
+        'C,2099-01-01\r\n'
+        'O,2001-01-01\r\n')
+    assert out['current_consultations.csv'] == (
+        'publishable,status,end_date,contact_email\r\n'
+        'Y,CA,2099-01-01,a@example.com\r\n'
+        'N,O,2099-01-01,b@example.com\r\n')
+    assert out['current_consultations_open.csv'] == (
+        'status,end_date\r\n'
+        'C,2099-01-01\r\n')
+
+
+def test_service_std_performance():
+    out = _filter('service-std.csv', (
+        'service_id,owner_org,q1_performance_result,q1_business_volume,'
+        'q2_performance_result,q2_business_volume,'
+        'q3_performance_result,q3_business_volume,'
+        'q4_performance_result,q4_business_volume\r\n'
+        '1,org,1,2,1,2,,,,\r\n'
+        '2,org,,,,,,,,\r\n'))
+
+    assert out['service-std.csv'].splitlines()[1:] == [
+        'org,1,1,2,1,2,,,,,0.50000',
+        'org,2,,,,,,,,,ND',
+    ]
+
+
+def test_empty_source():
+    assert _filter('travela.csv', '') == {'travela.csv': ''}
+
+
+class TestExportFiltered(CanadaTestBase):
+    @classmethod
+    def setup_method(self, method):
+        """Method is called at class level before EACH test methods of the class are called.
+        Setup any state specific to the execution of the given class methods.
+        """
+        super(TestExportFiltered, self).setup_method(method)
+
+        self.org = Organization()
+        self.action = LocalCKAN().action
+        self.tmp_dir = mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, 'filtered'))
+
+    @classmethod
+    def teardown_method(self, method):
+        """Method is called at class level after EACH test methods of the class are called.
+        Remove any state specific to the execution of the given class methods.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_export_matches_filters(self):
+        self.action.recombinant_create(
+            dataset_type='ati', owner_org=self.org['name'])
+        rval = self.action.recombinant_show(
+            dataset_type='ati', owner_org=self.org['name'])
+        chromo = get_chromo('ati')
+        self.action.datastore_upsert(
+            resource_id=rval['resources'][0]['id'],
+            records=[chromo['examples']['record']])
+
+        report = export_source(self.tmp_dir, 'ati.csv')
+
+        assert report == [('ati.csv', 1), ('ati-all.csv', 1)]
+        with open(os.path.join(self.tmp_dir, 'filtered', 'ati.csv'),
+                  encoding='utf-8') as f:
+            assert f.read(1) == BOM
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 1
+        assert rows[0]['request_number'] == \
+            chromo['examples']['record']['request_number']
+        assert rows[0]['owner_org'] == self.org['name']
+        assert 'record_created' not in rows[0]
+
+    def test_export_matches_combine_and_filter(self, cli):
+        self.action.recombinant_create(
+            dataset_type='adminaircraft', owner_org=self.org['name'])
+        rval = self.action.recombinant_show(
+            dataset_type='adminaircraft', owner_org=self.org['name'])
+        record = get_chromo('adminaircraft')['examples']['record']
+        self.action.datastore_upsert(
+            resource_id=rval['resources'][0]['id'],
+            records=[
+                dict(record, reference_number='T-2019-Q3-00001'),
+                dict(record, reference_number='T-2019-Q3-00002',
+                     hours='12.50', end_date='2019-12-01'),
+                dict(record, reference_number='T-2019-Q3-00003', hours='12',
+                     purpose_en='Comma, "quotes"\nand a new line'),
+            ])
+        filtered = os.path.join(self.tmp_dir, 'filtered', 'adminaircraft.csv')
+
+        result = cli.invoke(ckan, [
+            'recombinant', 'combine', 'adminaircraft', '-d', self.tmp_dir])
+        assert not result.exit_code, result.output
+        filter_source(self.tmp_dir, 'adminaircraft.csv')
+        with open(filtered, 'rb') as f:
+            expected = f.read()
+
+        export_source(self.tmp_dir, 'adminaircraft.csv')
+        with open(filtered, 'rb') as f:
+            exported = f.read()
+
+        # COPY ends rows with LF, filter_all.py with CRLF
+        assert expected.count(b'\r\n') == 4
+        assert exported == expected.replace(b'\r\n', b'\n')
@@ -1,4 +1,6 @@
 # -*- coding: UTF-8 -*-
+import tracemalloc
+
 from ckanext.canada.pd import dollar_range_facet
 from ckanext.canada.tests import CanadaTestBase
 from ckanapi import LocalCKAN
@@ -7,6 +9,13 @@ from ckanext.canada.tests.factories import CanadaOrganization as Organization
 
 from ckanext.recombinant.tables import get_chromo
 from ckanext.canada.pd import _update_records, clear_index, solr_connection
+from ckanext.canada.pd import _rebuild_jobs, _build_job_docs, _solr_records
+from ckanext.canada.pd import _field_plan, _interpreted_field_plan, _NO_COMPARE
+from ckanext.canada.pd import update, _get_index_digests, _set_index_digests
+from ckanext.canada.pd import _org_details
+from ckanext.canada.pd import _iter_solr_records, _add_records_windowed
+from ckanext.canada.pd import PreviousYearIndex
+from ckanext.canada.dataset import datastore_records, dataset_resources
 
 
 class TestDollarRangeFacet(object):
@@ -39,6 +48,109 @@ class TestDollarRangeFacet(object):
             'foo_fr': u'B: 500,00\xa0$ - 999,99\xa0$'}
 
 
+class TestFieldPlan(CanadaTestBase):
+    def test_plan_fields(self):
+        chromo = get_chromo('contracts')
+        plan = _field_plan('contracts')
+
+        assert [k for k, steps in plan] == [f['datastore_id'] for f in chromo['fields']]
+        assert _field_plan('contracts') is plan
+
+
+    def test_plan_records(self):
+        record = dict(
+            (k, ','.join(v) if isinstance(v, list) else str(v))
+            for k, v in get_chromo('contracts')['examples']['record'].items())
+        org_detail = {'name': 'tbs-sct',
+                      'title_translated': {'en': 'TBS', 'fr': 'SCT'}}
+
+        out = _solr_records([record], org_detail, 'contracts')
+
+        assert out[0]['contract_value'] == '10000'
+        assert out[0]['date_year'] == '2017'
+        assert out[0]['trade_agreement_en']
+        assert out[0]['trade_agreement_fr']
+
+
+    def test_plan_matches_interpreted(self):
+        org_detail = {'name': 'tbs-sct',
+                      'title_translated': {'en': 'TBS', 'fr': 'SCT'}}
+        for resource_name in ('contracts', 'grants', 'ati', 'travelq'):
+            record = dict(
+                (k, ','.join(v) if isinstance(v, list) else str(v))
+                for k, v in get_chromo(resource_name)['examples']['record'].items())
+
+            planned = list(_iter_solr_records(
+                [record], org_detail, resource_name, _NO_COMPARE))
+            interpreted = list(_iter_solr_records(
+                [record], org_detail, resource_name, _NO_COMPARE,
+                _interpreted_field_plan(resource_name)))
+            assert planned == interpreted
+
+
+class TestStreamingRebuild(CanadaTestBase):
+    class DiscardConnection(object):
+        def add(self, docs, commit=False):
+            pass
+
+
+    def peak_memory(self, num_records):
+        record = dict(
+            (k, ','.join(v) if isinstance(v, list) else str(v))
+            for k, v in get_chromo('contracts')['examples']['record'].items())
+        org_detail = {'name': 'tbs-sct',
+                      'title_translated': {'en': 'TBS', 'fr': 'SCT'}}
+
+        tracemalloc.start()
+        try:
+            _add_records_windowed(
+                self.DiscardConnection(),
+                _iter_solr_records(
+                    (dict(record) for i in range(num_records)),
+                    org_detail, 'contracts'),
+                100)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+
+    def test_memory_does_not_grow_with_input(self):
+        self.peak_memory(100)
+
+        assert self.peak_memory(20000) < self.peak_memory(2000) * 1.5
+
+
+class TestPreviousYearIndex(CanadaTestBase):
+    def solrrec(self, chromo, org, year, value):
+        solrrec = {'id': org + year, 'org_name_code': org, 'year': year}
+        for f in chromo['fields']:
+            if 'solr_compare_previous_year' in f:
+                solrrec[f['datastore_id']] = value
+        return solrrec
+
+
+    def test_match_any_order(self):
+        chromo = get_chromo('travela')
+        comp = [f['solr_compare_previous_year'] for f in chromo['fields']
+                if 'solr_compare_previous_year' in f][0]
+        index = PreviousYearIndex(chromo)
+        try:
+            index.add(self.solrrec(chromo, 'b', '2021', '5'))
+            index.add(self.solrrec(chromo, 'a', '2021', '15'))
+            index.add(self.solrrec(chromo, 'b', '2019', '1'))
+            index.add(self.solrrec(chromo, 'a', '2020', '10'))
+
+            out = dict((r['id'], r) for r in index.solr_records())
+        finally:
+            index.close()
+
+        assert sorted(out) == ['a2020', 'a2021', 'b2019', 'b2021']
+        assert out['a2021'][comp['previous_year']] == '10'
+        assert out['a2021'][comp['change']] == 5.0
+        assert comp['previous_year'] not in out['a2020']
+        assert comp['previous_year'] not in out['b2021']
+
+
 class TestIndex(CanadaTestBase):
 
     ds_type = 'ati'
@@ -57,6 +169,7 @@ class TestIndex(CanadaTestBase):
         rval = self.lc.action.recombinant_show(dataset_type=self.ds_type, owner_org=self.org['name'])
 
         self.resource_id = rval['resources'][0]['id']
+        self.core = solr_connection(self.ds_type).url
 
 
     def get_records(self):
@@ -82,6 +195,93 @@ class TestIndex(CanadaTestBase):
         org_detail = self.lc.action.organization_show(id=self.org['id'])
         resource = self.lc.action.resource_show(id=self.resource_id)
 
-        _update_records(self.get_records(), org_detail, conn, resource['name'], None, retry=False)
+        _update_records(self.get_records(), org_detail, conn, resource['name'], retry=False)
 
         conn.commit()
+
+
+    def test_rebuild_jobs(self):
+        record = get_chromo(self.ds_type)['examples']['record']
+        self.lc.action.datastore_upsert(
+            resource_id=self.resource_id,
+            records=[record])
+
+        jobs = [j for j in _rebuild_jobs(self.ds_type, self.lc)
+                if j[1]['id'] == self.org['id']]
+
+        assert len(jobs) == 1
+        resource_name, org_detail, records = jobs[0]
+        assert records == self.get_records()
+
+        docs = _solr_records(self.get_records(), org_detail, resource_name)
+        assert _build_job_docs(resource_name, org_detail, records) == docs
+
+
+    def test_update(self):
+        record = get_chromo(self.ds_type)['examples']['record']
+        self.lc.action.datastore_upsert(
+            resource_id=self.resource_id,
+            records=[record])
+
+        clear_index(self.ds_type)
+        assert _get_index_digests(self.ds_type, self.core) == {}
+
+        update(self.ds_type)
+        digests = _get_index_digests(self.ds_type, self.core)
+        assert len(digests) == 1
+
+        update(self.ds_type)
+        assert _get_index_digests(self.ds_type, self.core) == digests
+
+        self.lc.action.datastore_delete(
+            resource_id=self.resource_id,
+            filters={},
+            force=True)
+        update(self.ds_type)
+        assert _get_index_digests(self.ds_type, self.core) == {}
+
+
+    def test_index_digests_per_core(self):
+        other_core = 'http://solr.example.com/solr/other'
+        _set_index_digests(self.ds_type, other_core, {'a': '1'}, [])
+
+        clear_index(self.ds_type)
+        assert _get_index_digests(self.ds_type, self.core) == {}
+        assert _get_index_digests(self.ds_type, other_core) == {'a': '1'}
+
+
+    def test_org_details(self):
+        org_show = self.lc.action.organization_show(id=self.org['id'])
+
+        org_detail = [o for o in _org_details(self.ds_type)
+                      if o['id'] == self.org['id']][0]
+
+        assert org_detail['name'] == org_show['name']
+        assert org_detail['title_translated'] == org_show['title_translated']
+        for e in get_chromo(self.ds_type).get('solr_org_fields', []):
+            assert org_detail.get(e) == org_show.get(e)
+
+
+    def test_datastore_records(self):
+        record = get_chromo(self.ds_type)['examples']['record']
+        records = []
+        for i in range(3):
+            r = dict(record)
+            r['request_number'] = 'A-%d' % i
+            records.append(r)
+        self.lc.action.datastore_upsert(
+            resource_id=self.resource_id,
+            records=records)
+
+        batches = list(datastore_records(self.resource_id, batch_size=2))
+
+        assert [len(b) for b in batches] == [2, 1]
+        assert batches[0] + batches[1] == self.get_records()
+
+
+    def test_dataset_resources(self):
+        org_resources = dataset_resources(self.ds_type)
+
+        assert len(org_resources[self.org['id']]) == 1
+        assert self.resource_id in [
+            r[0] for r in org_resources[self.org['id']][0]]
@@ -0,0 +1,144 @@
+# -*- coding: UTF-8 -*-
+import json
+
+from ckan import model
+
+from ckanext.canada.tests import CanadaTestBase
+from ckanapi import LocalCKAN
+
+from ckanext.canada.tests.factories import (
+    CanadaDataset as Dataset,
+    CanadaResource as Resource)
+
+from ckanext.canada.cli import (
+    _datastore_dictionary,
+    _datastore_dictionaries_batch,
+    _prefetch_packages,
+    _trim_package,
+    _package_digest,
+    _get_package_digest,
+    _set_package_digest,
+    _delete_package_digest,
+    get_datastore_and_views)
+
+
+class TestPrefetchPackages(CanadaTestBase):
+    @classmethod
+    def setup_method(self, method):
+        """Method is called at class level before EACH test methods of the class are called.
+        Setup any state specific to the execution of the given class methods.
+        """
+        super(TestPrefetchPackages, self).setup_method(method)
+
+        self.lc = LocalCKAN()
+        self.pkg = Dataset()
+        self.resource = Resource(package_id=self.pkg['id'])
+        self.lc.action.datastore_create(resource_id=self.resource['id'],
+                                        force=True,
+                                        fields=[{'id': 'example_id',
+                                                 'type': 'text',
+                                                 'info': {'label_en': 'Example Label',
+                                                          'label_fr': 'Example Label FR'}},
+                                                {'id': 'example_count',
+                                                 'type': 'int'},
+                                                {'id': 'example_tags',
+                                                 'type': '_text'}])
+
+
+    def test_dictionaries_match_datastore_search(self):
+        data_dicts = _datastore_dictionaries_batch([self.resource['id']])
+
+        assert data_dicts[self.resource['id']] == \
+            _datastore_dictionary(self.lc, self.resource['id'])
+
+
+    def test_dictionaries_missing_table(self):
+        other_resource = Resource(package_id=self.pkg['id'])
+
+        data_dicts = _datastore_dictionaries_batch(
+            [self.resource['id'], other_resource['id']])
+
+        assert self.resource['id'] in data_dicts
+        assert other_resource['id'] not in data_dicts
+
+
+    def test_prefetch_matches_get_datastore_and_views(self):
+        expected = get_datastore_and_views(
+            self.lc.action.package_show(id=self.pkg['id']), self.lc)
+
+        packages = list(_prefetch_packages(self.lc, [self.pkg['id']]))
+
+        assert len(packages) == 1
+        assert packages[0][0] == self.pkg['id']
+        assert json.loads(packages[0][1]) == json.loads(json.dumps(expected))
+
+
+    def test_prefetch_skips_missing_packages(self):
+        packages = list(_prefetch_packages(
+            self.lc, ['does-not-exist', self.pkg['id']]))
+
+        assert packages[0] == ('does-not-exist', None)
+        assert packages[1][0] == self.pkg['id']
+        assert json.loads(packages[1][1])['id'] == self.pkg['id']
+
+
+    def test_prefetch_reads_stale_index_from_database(self):
+        # changed without updating the search index
+        model.Session.execute(
+            u"UPDATE package SET title = 'changed', "
+            "metadata_modified = now() at time zone 'utc' WHERE id = :id",
+            {'id': self.pkg['id']})
+        model.Session.commit()
+
+        packages = list(_prefetch_packages(self.lc, [self.pkg['id']]))
+
+        assert json.loads(packages[0][1])['title'] == 'changed'
+
+
+class TestPackageDigest(CanadaTestBase):
+    @classmethod
+    def setup_method(self, method):
+        """Method is called at class level before EACH test methods of the class are called.
+        Setup any state specific to the execution of the given class methods.
+        """
+        super(TestPackageDigest, self).setup_method(method)
+
+        self.lc = LocalCKAN()
+        self.pkg = Dataset()
+        Resource(package_id=self.pkg['id'])
+
+
+    def _trimmed_package(self):
+        pkg = get_datastore_and_views(
+            self.lc.action.package_show(id=self.pkg['id']), self.lc)
+        _trim_package(pkg)
+        return pkg
+
+
+    def test_digest_ignores_trimmed_fields(self):
+        before = _package_digest(self._trimmed_package())
+        self.lc.action.package_patch(id=self.pkg['id'])
+
+        assert _package_digest(self._trimmed_package()) == before
+
+
+    def test_digest_changes_with_package(self):
+        before = _package_digest(self._trimmed_package())
+        self.lc.action.package_patch(
+            id=self.pkg['id'],
+            title_translated={'en': 'Changed Title', 'fr': 'Changed FR Title'})
+
+        assert _package_digest(self._trimmed_package()) != before
+
+
+    def test_digest_store(self):
+        assert _get_package_digest(self.pkg['id']) is None
+
+        _set_package_digest(self.pkg['id'], 'a')
+        assert _get_package_digest(self.pkg['id']) == 'a'
+
+        _set_package_digest(self.pkg['id'], 'b')
+        assert _get_package_digest(self.pkg['id']) == 'b'
+
+        _delete_package_digest(self.pkg['id'])
+        assert _get_package_digest(self.pkg['id']) is None
@@ -1,4 +1,7 @@
 # -*- coding: UTF-8 -*-
+import csv
+import pytest
+
 from ckanext.canada.tests import CanadaTestBase
 from ckanapi import LocalCKAN
 
@@ -8,6 +11,17 @@ from ckanext.canada.tests.factories import (
 )
 
 from ckanext.recombinant.tables import get_chromo
+from ckanext.recombinant.helpers import recombinant_choice_fields
+from ckanext.datastore.backend.postgres import get_read_engine, get_write_engine
+
+from ckanext.canada.cli import _load_csv, _get_user
+from ckanext.canada.triggers import (
+    UNGROUPED_SOURCE_PREFIX,
+    benchmark_triggers,
+    group_error_checks,
+    search_fields,
+    update_choice_sets,
+    update_triggers)
 
 
 class TestCanadaTriggers(CanadaTestBase):
@@ -193,3 +207,216 @@ class TestCanadaTriggers(CanadaTestBase):
         # sysadmin upserts should  NOT get a new record_modified, when it is not supplied
         assert record['record_modified'] != initial_modified_time
         assert record['record_modified'] == new_modified_time
+
+
+    def test_update_record_modified_created_trigger_bulk_load(self):
+        resource_id, nil_resource_id = self._setup_pd(type='ati', nil_type='ati-nil')
+        chromo = get_chromo('ati')
+        sql = "SELECT %s from \"%s\"" % (
+            ', '.join(f['datastore_id'] for f in chromo['fields']), resource_id)
+
+        record = self.sys_action.datastore_search_sql(sql=sql)['records'][0]
+        record['summary_en'] = 'Bulk English Summary'
+        record['record_modified'] = '2022-04-22T12:56:46.916648'
+        record['user_modified'] = 'bulk_loader'
+
+        LocalCKAN().call_action(
+            'datastore_upsert',
+            {'resource_id': resource_id, 'records': [record]},
+            context={'canada_bulk_load': True})
+
+        result = self.sys_action.datastore_search_sql(sql=sql)['records'][0]
+        assert result['summary_en'] == 'Bulk English Summary'
+        assert result['record_modified'] == '2022-04-22T12:56:46.916648'
+        assert result['user_modified'] == 'bulk_loader'
+
+        # missing values are kept from the existing row
+        del record['record_modified']
+        record['user_modified'] = ''
+        LocalCKAN().call_action(
+            'datastore_upsert',
+            {'resource_id': resource_id, 'records': [record]},
+            context={'canada_bulk_load': True})
+
+        result = self.sys_action.datastore_search_sql(sql=sql)['records'][0]
+        assert result['record_modified'] == '2022-04-22T12:56:46.916648'
+        assert result['user_modified'] == 'bulk_loader'
+
+        # ignored for non-sysadmins
+        record['summary_en'] = 'Editor English Summary'
+        LocalCKAN(username=self.editor['name']).call_action(
+            'datastore_upsert',
+            {'resource_id': resource_id, 'records': [record]},
+            context={'canada_bulk_load': True})
+
+        result = self.sys_action.datastore_search_sql(sql=sql)['records'][0]
+        assert result['user_modified'] == self.editor['name']
+        assert result['record_modified'] != '2022-04-22T12:56:46.916648'
+
+
+    def test_load_csv_bulk_load(self, tmp_path):
+        resource_id, nil_resource_id = self._setup_pd(type='ati', nil_type='ati-nil')
+        chromo = get_chromo('ati')
+        fields = [f['datastore_id'] for f in chromo['fields']]
+        sql = "SELECT %s from \"%s\"" % (', '.join(fields), resource_id)
+
+        record = self.sys_action.datastore_search_sql(sql=sql)['records'][0]
+        record['summary_en'] = 'Restored English Summary'
+        record['record_modified'] = '2022-04-22T12:56:46.916648'
+        record['user_modified'] = 'bulk_loader'
+        record['owner_org'] = self.org['name']
+        record['owner_org_title'] = self.org['title']
+
+        csv_path = tmp_path / 'ati.csv'
+        with open(csv_path, 'w', encoding='utf-8-sig', newline='') as f:
+            out = csv.DictWriter(f, fields + ['owner_org', 'owner_org_title'])
+            out.writeheader()
+            out.writerow(dict(
+                (k, ','.join(v) if isinstance(v, list) else v)
+                for k, v in record.items()))
+
+        assert _load_csv([str(csv_path)], _get_user(None))
+
+        result = self.sys_action.datastore_search_sql(sql=sql)['records'][0]
+        assert result['summary_en'] == 'Restored English Summary'
+        assert result['record_modified'] == '2022-04-22T12:56:46.916648'
+        assert result['user_modified'] == 'bulk_loader'
+
+
+    def test_inline_error_functions(self):
+        with get_read_engine().connect() as connection:
+            def call(sql):
+                return connection.execute(sql).scalar()
+
+            assert call(u"SELECT required_error(''::text, 'f')") == \
+                [['f', 'This field must not be empty']]
+            assert call(u"SELECT required_error('x'::text, 'f')") is None
+            assert call(u"SELECT required_error(NULL::date, 'f')") == \
+                [['f', 'This field must not be empty']]
+            assert call(u"SELECT choice_error('c', ARRAY['a', 'b'], 'f')") == \
+                [['f', 'Invalid choice: "c"']]
+            assert call(u"SELECT choice_error('a', ARRAY['a', 'b'], 'f')") is None
+            assert call(u"SELECT both_languages_error('', 'f_en', 'x', 'f_fr')") == \
+                [['f_en', 'This text must be provided in both languages']]
+            assert call(u"SELECT both_languages_error('x', 'f_en', 'x', 'f_fr')") is None
+            assert call(u"SELECT prolang FROM pg_proc WHERE proname = 'required_error' LIMIT 1") == \
+                call(u"SELECT oid FROM pg_language WHERE lanname = 'sql'")
+
+
+    def test_choice_set_functions(self):
+        choices = [c for c, label in
+                   recombinant_choice_fields('consultations')['subjects']]
+        with get_write_engine().begin() as connection:
+            update_choice_sets(connection)
+            assert update_choice_sets(connection, dry_run=True) == (0, 0)
+
+            def call(sql, *args):
+                return connection.execute(sql, *args).scalar()
+
+            assert call(
+                u"SELECT choice_set_error(%s, 'consultations.subjects', 'f')",
+                choices[0]) is None
+            assert call(
+                u"SELECT choice_set_error('zz', 'consultations.subjects', 'f')") == \
+                [['f', 'Invalid choice: "zz"']]
+            assert call(
+                u"SELECT choice_set_error('', 'consultations.subjects', 'f')") is None
+
+            # clean values are in choice order without duplicates
+            value = [choices[1], choices[0], choices[1]]
+            assert call(
+                u"SELECT (choice_set_clean_error(%s, 'consultations.subjects', 'f')).clean",
+                value) == choices[:2]
+            assert call(
+                u"SELECT (choice_set_clean_error(%s, 'consultations.subjects', 'f')).error",
+                value) is None
+            assert call(
+                u"SELECT (choice_set_clean_error(%s, 'consultations.subjects', 'f')).error",
+                [choices[0], 'zz']) == [['f', 'Invalid choice: "zz"']]
+
+
+    def test_update_triggers_skips_unchanged(self):
+        update_triggers()
+
+        report = update_triggers(dry_run=True)
+
+        assert ('choice_set_error(text, text, text)', 'unchanged') in report
+        assert ('required_error(text, text)', 'unchanged') in report
+        assert set(change for name, change in report[:-2]) == {'unchanged'}
+        assert report[-2] == ('canada_choice_set', '0 choices added, 0 removed')
+        assert report[-1] == ('table trigger functions', '0 grouped')
+
+
+    def test_group_error_checks(self):
+        definition = u'\n'.join([
+            u'BEGIN',
+            u"  errors := errors || required_error(NEW.a, 'a');",
+            u'',
+            u"  errors := errors || required_error(NEW.b, 'b');",
+            u"  IF NEW.c <> 'NA' THEN",
+            u"    errors := errors || ARRAY[['c', 'bad c']];",
+            u'  END IF;',
+            u'  NEW.d := trim(NEW.d);',
+            u"  IF errors = '{}' THEN",
+            u"    errors := errors || ARRAY[['d', 'bad d']];",
+            u'  END IF;',
+            u'END;'])
+
+        grouped = group_error_checks(definition)
+
+        assert grouped.split(u'\n') == [
+            u'BEGIN',
+            u"  errors := errors || (required_error(NEW.a, 'a') || "
+            u"required_error(NEW.b, 'b') || CASE WHEN NEW.c <> 'NA' "
+            u"THEN ARRAY[['c', 'bad c']] END);",
+            u'  NEW.d := trim(NEW.d);',
+            u"  IF errors = '{}' THEN",
+            u"    errors := errors || ARRAY[['d', 'bad d']];",
+            u'  END IF;',
+            u'END;']
+        assert group_error_checks(grouped) == grouped
+
+
+    def test_table_trigger_functions_are_grouped(self):
+        self._setup_pd(type='contracts')
+
+        with get_read_engine().connect() as conn:
+            prosrc, comment = conn.execute(
+                u"SELECT prosrc, obj_description(oid, 'pg_proc') "
+                u"FROM pg_proc WHERE proname = 'contracts_trigger'").first()
+
+        assert comment.startswith(UNGROUPED_SOURCE_PREFIX)
+        assert prosrc.count(u'errors := errors ||') < comment.count(
+            u'errors := errors ||')
+
+
+    def test_search_fields_must_be_text(self):
+        chromo = dict(get_chromo('contracts'))
+        text = [f['datastore_id'] for f in chromo['fields']
+                if f['datastore_type'] == 'text'][:2]
+        chromo['datatable_search_fields'] = text
+        assert search_fields(chromo) == text
+
+        other = [f['datastore_id'] for f in chromo['fields']
+                 if f['datastore_type'] != 'text'][0]
+        chromo['datatable_search_fields'] = text + [other]
+        with pytest.raises(ValueError):
+            search_fields(chromo)
+
+
+    def test_benchmark_triggers(self):
+        self._setup_pd(type='contracts')
+
+        results = list(benchmark_triggers([get_chromo('contracts')], rows=10))
+
+        resource_name, base, written, grouped, error = results[0]
+        assert resource_name == 'contracts'
+        assert error is None
+        assert base > 0
+        assert written > 0
+        assert grouped > 0
+        # benchmark rows are rolled back
+        rval = self.sys_action.recombinant_show(
+            dataset_type='contracts', owner_org=self.org['name'])
+        assert self.sys_action.datastore_search(
+            resource_id=rval['resources'][0]['id'])['total'] == 1
@@ -1,4 +1,5 @@
 # -*- coding: UTF-8 -*-
+import json
 from ckanext.canada.tests import CanadaTestBase
 import pytest
 from urllib.parse import urlparse
@@ -18,6 +19,9 @@ from ckanext.canada.tests.factories import (
     CanadaUser as User
 )
 
+from ckanext.canada.view import _ExpiringCache, _datatable_search
+from ckanext.canada.triggers import update_search_indexes
+from ckanext.datastore.backend.postgres import get_write_engine
 from ckanext.recombinant.tables import get_chromo
 from ckanext.recombinant.read_excel import read_excel
 from ckanext.recombinant.write_excel import (
@@ -562,6 +566,116 @@ class TestRecombinantWebForms(CanadaTestBase):
                 assert f['datastore_id'] in template_file[1][2]  # check each field id is in column names
 
 
+    def test_datatable(self, app):
+        resource_id = self._lc_create_pd_record(return_field='id')
+
+        offset = h.url_for('canada.datatable',
+                           resource_name=self.pd_type,
+                           resource_id=resource_id)
+        params = {'draw': '1', 'search[value]': '', 'start': '0', 'length': '10'}
+        response = app.post(offset, data=params,
+                            extra_environ=self.extra_environ_editor)
+
+        result = json.loads(response.body)
+        assert result['iTotalRecords'] == 1
+        assert result['iTotalDisplayRecords'] == 1
+        assert len(result['aaData']) == 1
+        # select checkbox, edit link and then the fields
+        assert len(result['aaData'][0]) == len(self.fields) + 2
+
+        params.update({'draw': '2', 'search[value]': 'zzzzzzzz'})
+        response = app.post(offset, data=params,
+                            extra_environ=self.extra_environ_editor)
+
+        result = json.loads(response.body)
+        assert result['iTotalRecords'] == 1
+        assert result['iTotalDisplayRecords'] == 0
+        assert result['aaData'] == []
+
+
+    def test_datatable_seek(self, app):
+        resource_id = self._lc_create_pd_record(return_field='id')
+        records = []
+        for n in ('A-0001', 'A-0002', 'A-0003'):
+            record = dict(self.example_record, request_number=n)
+            records.append(record)
+        LocalCKAN().action.datastore_upsert(resource_id=resource_id, records=records)
+
+        offset = h.url_for('canada.datatable',
+                           resource_name=self.pd_type,
+                           resource_id=resource_id)
+        fids = [f['datastore_id'] for f in self.fields]
+        params = {
+            'draw': '1',
+            'search[value]': '',
+            'start': '0',
+            'length': '1',
+            # after the select and edit columns
+            'order[0][column]': str(fids.index('request_number') + 2),
+            'order[0][dir]': 'asc',
+        }
+
+        def draw(**kwargs):
+            response = app.post(offset, data=dict(params, **kwargs),
+                                extra_environ=self.extra_environ_editor)
+            result = json.loads(response.body)
+            return result, result['aaData'][0][fids.index('request_number') + 2]
+
+        result, request_number = draw()
+        assert request_number == 'A-0001'
+
+        result, request_number = draw(start='1', cursor=result['cursor_next'], direction='next')
+        assert request_number == 'A-0002'
+        assert result['iTotalDisplayRecords'] == 4
+
+        result, request_number = draw(start='2', cursor=result['cursor_next'], direction='next')
+        assert request_number == 'A-0003'
+
+        result, request_number = draw(start='1', cursor=result['cursor_prev'], direction='prev')
+        assert request_number == 'A-0002'
+
+        # invalid cursors fall back to the offset
+        result, request_number = draw(start='2', cursor='invalid', direction='next')
+        assert request_number == 'A-0003'
+
+
+    @pytest.mark.ckan_config('ckanext.canada.datatable_trigram_search', 'true')
+    def test_datatable_trigram_search(self, app):
+        resource_id = self._lc_create_pd_record(return_field='id')
+        records = [
+            dict(self.example_record, request_number=n)
+            for n in ('A-0001', 'A-0002', 'B_0003')]
+        LocalCKAN().action.datastore_upsert(resource_id=resource_id, records=records)
+
+        # no index yet, datatable searches use datastore_search instead
+        chromo = get_chromo(self.pd_type)
+        assert _datatable_search(
+            resource_id, chromo, 'a-000', [], 0, 10) is None
+
+        with get_write_engine().connect().execution_options(
+                isolation_level='AUTOCOMMIT') as connection:
+            if update_search_indexes(connection) is None:
+                pytest.skip('pg_trgm extension not installed')
+
+        offset = h.url_for('canada.datatable',
+                           resource_name=self.pd_type,
+                           resource_id=resource_id)
+        params = {'draw': '1', 'search[value]': 'a-000', 'start': '0', 'length': '10'}
+
+        response = app.post(offset, data=params,
+                            extra_environ=self.extra_environ_editor)
+        result = json.loads(response.body)
+        assert result['iTotalRecords'] == 4
+        assert result['iTotalDisplayRecords'] == 2
+
+        # like wildcards are matched literally
+        params['search[value]'] = '_000'
+        response = app.post(offset, data=params,
+                            extra_environ=self.extra_environ_editor)
+        result = json.loads(response.body)
+        assert result['iTotalDisplayRecords'] == 1
+
+
     def test_selected_download_template(self, app):
         resource_name = self._lc_create_pd_record()
         nil_resource_name = self._lc_create_pd_record(is_nil=True)
@@ -948,3 +1062,29 @@ class TestRecombinantWebForms(CanadaTestBase):
                 'bulk-delete': records_to_delete
             }
         }
+
+
+class TestExpiringCache(object):
+    def test_get_set(self):
+        cache = _ExpiringCache(2, 60)
+        assert cache.get('a') is None
+        cache.set('a', 1)
+        assert cache.get('a') == 1
+
+
+    def test_expired(self):
+        cache = _ExpiringCache(2, -1)
+        cache.set('a', 1)
+        assert cache.get('a') is None
+
+
+    def test_size(self):
+        cache = _ExpiringCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('a', 3)
+        cache.set('c', 4)
+        # b was set least recently
+        assert cache.get('b') is None
+        assert cache.get('a') == 3
+        assert cache.get('c') == 4
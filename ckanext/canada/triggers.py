@@ -1,126 +1,601 @@
-from ckanapi import LocalCKAN
-from ckantoolkit import h
+import hashlib
+import re
+import time
 
+from ckantoolkit import h, config, asbool
+from ckanext.recombinant.tables import get_dataset_types, get_geno
+from ckanext.recombinant.helpers import recombinant_choice_fields
+import ckanext.datastore.backend.postgres as datastore
+from ckanext.datastore.backend.postgres import (
+    get_write_engine,
+    identifier,
+    literal_string)
 
-def update_triggers():
-    """Create/update triggers used by PD tables"""
+# (name, arguments, expression) for *_error functions simple enough to be
+# LANGUAGE sql functions. These are inlined into the expressions of the
+# PD table triggers by the planner instead of being called for every
+# field of every row like plpgsql functions.
+INLINE_ERROR_FUNCTIONS = [
+    (u'required_error', [(u'value', u'text'), (u'field_name', u'text')],
+        u"""CASE WHEN (value = '') IS NOT FALSE
+            THEN ARRAY[[field_name, 'This field must not be empty']] END"""),
+    (u'required_error', [(u'value', u'_text'), (u'field_name', u'text')],
+        u"""CASE WHEN value IS NULL OR value = '{}'
+            THEN ARRAY[[field_name, 'This field must not be empty']] END"""),
+    (u'required_error', [(u'value', u'date'), (u'field_name', u'text')],
+        u"""CASE WHEN value IS NULL
+            THEN ARRAY[[field_name, 'This field must not be empty']] END"""),
+    (u'required_error', [(u'value', u'numeric'), (u'field_name', u'text')],
+        u"""CASE WHEN value IS NULL
+            THEN ARRAY[[field_name, 'This field must not be empty']] END"""),
+    (u'required_error', [(u'value', u'int4'), (u'field_name', u'text')],
+        u"""CASE WHEN value IS NULL
+            THEN ARRAY[[field_name, 'This field must not be empty']] END"""),
+    (u'required_error', [(u'value', u'money'), (u'field_name', u'text')],
+        u"""CASE WHEN value IS NULL
+            THEN ARRAY[[field_name, 'This field must not be empty']] END"""),
+    (u'choice_error',
+        [(u'value', u'text'), (u'choices', u'_text'), (u'field_name', u'text')],
+        # \t is used when converting errors to string
+        r"""CASE WHEN value IS NOT NULL AND value <> '' AND NOT (value = ANY (choices))
+            THEN ARRAY[[field_name, 'Invalid choice: "'
+                || replace(value, E'\t', ' ') || '"']] END"""),
+    (u'must_be_empty_error', [(u'value', u'numeric'), (u'field_name', u'text')],
+        u"""CASE WHEN value IS NOT NULL
+            THEN ARRAY[[field_name, 'This field must be empty']] END"""),
+    (u'no_surrounding_whitespace_error',
+        [(u'value', u'text'), (u'field_name', u'text')],
+        u"""CASE WHEN trim(both E'\t\n\x0b\x0c\r ' from value) <> value
+            THEN ARRAY[[field_name, 'This field must not have surrounding whitespace']] END"""),
+    (u'integer_or_na_nd_error', [(u'value', u'text'), (u'field_name', u'text')],
+        u"""CASE WHEN value <> 'NA' AND value <> 'ND' AND NOT value ~ '^[0-9]+$'
+            THEN ARRAY[[field_name, 'This field must be NA or an integer']] END"""),
+    (u'both_languages_error',
+        [(u'value_en', u'text'), (u'field_name_en', u'text'),
+         (u'value_fr', u'text'), (u'field_name_fr', u'text')],
+        u"""CASE WHEN (value_en = '') IS NOT FALSE AND NOT((value_fr = '') IS NOT FALSE)
+            THEN ARRAY[[field_name_en, 'This text must be provided in both languages']]
+            WHEN (value_fr = '') IS NOT FALSE AND NOT((value_en = '') IS NOT FALSE)
+            THEN ARRAY[[field_name_fr, 'This text must be provided in both languages']]
+            END"""),
+]
 
-    lc = LocalCKAN()
 
+# choices of every PD field with choices, used by the choice_set_*
+# functions as '<resource_name>.<datastore_id>' instead of passing
+# the whole list of choices to every trigger call
+CHOICE_SET_TABLE = u'canada_choice_set'
+
+# comment on the functions created by update_triggers followed by the md5
+# of their CREATE statement, so unchanged functions can be skipped
+FUNCTION_DIGEST_PREFIX = u'canada update-triggers '
+
+# added to the resource id for the trigram index of datatable searches,
+# followed by the start of the md5 of the indexed expression
+SEARCH_INDEX_SUFFIX = u'_search_'
+
+# comment on the PD table trigger functions created with their error
+# checks grouped, followed by the source of the function as written
+UNGROUPED_SOURCE_PREFIX = u'canada ungrouped source\n'
+
+# single line statements of the PD table trigger functions
+_ERROR_APPEND = re.compile(r'^(\s*)errors := errors \|\| (.+);\s*$')
+_IF_THEN = re.compile(r'^(\s*)IF (.+) THEN\s*$')
+_END_IF = re.compile(r'^(\s*)END IF;\s*$')
+_USES_ERRORS = re.compile(r'\berrors\b')
+_FUNCTION_CALL = re.compile(r'^[\w.]+\s*\(')
+_NAME = re.compile(r'^[\w.]+$')
+_BRACKETS = {u'(': u')', u'[': u']'}
+
+
+def _closing(expr, start):
+    """
+    Return the index of the bracket closing the one at expr[start],
+    ignoring brackets in string literals
+    """
+    depth = 0
+    quoted = False
+    for i in range(start, len(expr)):
+        c = expr[i]
+        if c == u"'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif c in _BRACKETS:
+            depth += 1
+        elif c in _BRACKETS.values():
+            depth -= 1
+            if not depth:
+                return i
+    return None
+
+
+def _concat_operands(expr):
+    """
+    Return expr as one or more operands of a || chain
+    """
+    if expr.startswith(u'(') and _closing(expr, 0) == len(expr) - 1:
+        # a group of checks, || is associative
+        return expr[1:-1]
+    call = _FUNCTION_CALL.match(expr)
+    if call and _closing(expr, call.end() - 1) == len(expr) - 1:
+        return expr
+    if expr.startswith(u'ARRAY[') and _closing(expr, 5) == len(expr) - 1:
+        return expr
+    if _NAME.match(expr):
+        return expr
+    return u'(' + expr + u')'
+
+
+def group_error_checks(definition):
+    """
+    Return the plpgsql source of a PD table trigger function with its
+    error checks grouped: every IF block with a single error check
+    becomes a CASE expression and every run of consecutive
+    "errors := errors || ...;" statements becomes a single statement,
+    so the errors array is copied once per group instead of once per
+    checked field.
+
+    The *_error functions return NULL or ARRAY[[field_name, message]]
+    and NULL values are ignored by ||, so the grouped checks return
+    the same errors in the same order.
+    """
+    lines = definition.split(u'\n')
+    changed = True
+    while changed:
+        changed = False
+        grouped = []
+        i = 0
+        while i < len(lines):
+            start = _IF_THEN.match(lines[i])
+            check = i + 2 < len(lines) and _ERROR_APPEND.match(lines[i + 1])
+            end = i + 2 < len(lines) and _END_IF.match(lines[i + 2])
+            if (start and check and end and
+                    start.group(1) == end.group(1) and
+                    not _USES_ERRORS.search(start.group(2)) and
+                    not _USES_ERRORS.search(check.group(2))):
+                grouped.append(
+                    u'{0}errors := errors || (CASE WHEN {1} THEN {2} END);'
+                    .format(start.group(1), start.group(2),
+                            _concat_operands(check.group(2))))
+                i += 3
+                changed = True
+                continue
+
+            checks = []
+            while i < len(lines):
+                # blank lines between checks are dropped
+                j = i
+                while checks and j < len(lines) and not lines[j].strip():
+                    j += 1
+                check = j < len(lines) and _ERROR_APPEND.match(lines[j])
+                if not check or _USES_ERRORS.search(check.group(2)) or (
+                        checks and check.group(1) != checks[0].group(1)):
+                    break
+                checks.append(check)
+                i = j + 1
+            if len(checks) > 1:
+                grouped.append(u'{0}errors := errors || ({1});'.format(
+                    checks[0].group(1),
+                    u' || '.join(
+                        _concat_operands(c.group(2)) for c in checks)))
+                changed = True
+            elif checks:
+                grouped.append(checks[0].group(0))
+            else:
+                grouped.append(lines[i])
+                i += 1
+        lines = grouped
+    return u'\n'.join(lines)
+
+
+def create_trigger_function(connection, name, definition):
+    """
+    Create or replace a PD table trigger function the same way as
+    datastore_function_create
+
+    :param connection: DataStore write engine connection
+    """
+    # no special meaning for '%' in function definitions
+    connection.execution_options(no_parameters=True).execute(
+        u'CREATE OR REPLACE FUNCTION {name}() RETURNS trigger AS {definition} '
+        u'LANGUAGE plpgsql'.format(
+            name=identifier(name),
+            definition=literal_string(definition)))
+
+
+def set_ungrouped_source(connection, name, definition):
+    """
+    Keep the source as written of a trigger function created with its
+    error checks grouped, used by benchmark_triggers
+    """
+    connection.execution_options(no_parameters=True).execute(
+        u'COMMENT ON FUNCTION {name}() IS {comment}'.format(
+            name=identifier(name),
+            comment=literal_string(UNGROUPED_SOURCE_PREFIX + definition)))
+
+
+def _trigger_function_source(connection, name):
+    """
+    Return (source as written, grouped) for the trigger function name,
+    or None when it does not exist
+    """
+    row = connection.execute(
+        u"SELECT prosrc, obj_description(oid, 'pg_proc') FROM pg_proc "
+        u'WHERE oid = to_regprocedure(%s)',
+        identifier(name) + u'()').first()
+    if not row:
+        return None
+    source, comment = row
+    if comment and comment.startswith(UNGROUPED_SOURCE_PREFIX):
+        return comment[len(UNGROUPED_SOURCE_PREFIX):], source
+    return source, group_error_checks(source)
+
+
+def _table_trigger_names(chromo):
+    """
+    Return the names of the trigger functions defined in chromo
+    """
+    return [list(t)[0] for t in chromo.get('triggers', [])
+            if isinstance(t, dict)]
+
+
+def update_table_trigger_functions(connection, dry_run=False):
+    """
+    Group the error checks of the existing PD table trigger functions
+    created before their checks were grouped by datastore_function_create
+
+    :returns: number of functions grouped
+    """
+    count = 0
+    for dataset_type in get_dataset_types():
+        for chromo in get_geno(dataset_type)['resources']:
+            for name in _table_trigger_names(chromo):
+                row = connection.execute(
+                    u"SELECT obj_description(oid, 'pg_proc') FROM pg_proc "
+                    u'WHERE oid = to_regprocedure(%s)',
+                    identifier(name) + u'()').first()
+                if not row or (row[0] or u'').startswith(
+                        UNGROUPED_SOURCE_PREFIX):
+                    continue
+                source, grouped = _trigger_function_source(connection, name)
+                if grouped == source:
+                    continue
+                count += 1
+                if not dry_run:
+                    create_trigger_function(connection, name, grouped)
+                    set_ungrouped_source(connection, name, source)
+    return count
+
+
+def update_choice_sets(connection, dry_run=False):
+    """
+    Bring the choice set table up to date with the current choices of
+    all PD fields
+
+    :param connection: DataStore write engine connection
+    :param dry_run: only count the changes
+    :returns: (choices added, choices removed)
+    """
+    table = identifier(CHOICE_SET_TABLE)
+    exists = connection.execute(
+        u'SELECT to_regclass(%s) IS NOT NULL', table).scalar()
+    if not exists and not dry_run:
+        connection.execute(
+            u'CREATE TABLE {table} ('
+            u'set_name text NOT NULL, choice text NOT NULL, '
+            u'position int NOT NULL, '
+            u'PRIMARY KEY (set_name, choice))'.format(table=table))
+    existing = set()
+    if exists:
+        existing = set(tuple(r) for r in connection.execute(
+            u'SELECT set_name, choice, position FROM {table}'.format(
+                table=table)))
+    rows = set(_choice_set_rows())
+    added = sorted(rows - existing)
+    removed = sorted(existing - rows)
+    if not dry_run and (added or removed):
+        if removed:
+            connection.execute(
+                u'DELETE FROM {table} WHERE set_name = %s AND choice = %s '
+                u'AND position = %s'.format(table=table),
+                removed)
+        if added:
+            connection.execute(
+                u'INSERT INTO {table} (set_name, choice, position) '
+                u'VALUES (%s, %s, %s)'.format(table=table),
+                added)
+        connection.execute(u'ANALYZE {table}'.format(table=table))
+    return len(added), len(removed)
+
+
+def search_fields(chromo):
+    """
+    Return the datastore_ids of the text fields of chromo matched by
+    datatable searches: the chromo's datatable_search_fields, or its
+    primary key and free text fields (text fields without choices)
+
+    :raises ValueError: when a datatable_search_fields field is not a
+        text field
+    """
+    if 'datatable_search_fields' in chromo:
+        types = dict(
+            (f['datastore_id'], f['datastore_type']) for f in chromo['fields'])
+        for field in chromo['datatable_search_fields']:
+            if types.get(field) != 'text':
+                raise ValueError(
+                    u'{0}: datatable_search_fields {1} is not a text '
+                    u'field'.format(chromo['resource_name'], field))
+        return list(chromo['datatable_search_fields'])
+    pk = chromo['datastore_primary_key']
+    if not isinstance(pk, list):
+        pk = [pk]
+    return [
+        f['datastore_id'] for f in chromo['fields']
+        if f['datastore_type'] == 'text' and (
+            f['datastore_id'] in pk or
+            ('choices' not in f and 'choices_file' not in f))]
+
+
+def search_expression(chromo):
+    """
+    Return the immutable SQL expression of all the search_fields of
+    chromo used for the datatable search indexes and queries
+    """
+    return u" || ' ' || ".join(
+        u"coalesce({0}, '')".format(identifier(f))
+        for f in search_fields(chromo))
+
+
+def _search_index_name(resource_id, expression):
+    return resource_id + SEARCH_INDEX_SUFFIX + hashlib.md5(
+        expression.encode('utf-8')).hexdigest()[:8]
+
+
+def search_index_valid(connection, resource_id, chromo):
+    """
+    Return True when the resource_id DataStore table has a valid trigram
+    index on the current search_expression of chromo
+    """
+    return bool(connection.execute(
+        u'SELECT i.indisvalid FROM pg_index i '
+        u'JOIN pg_class c ON c.oid = i.indexrelid '
+        u'WHERE i.indrelid = to_regclass(%s) AND c.relname = %s',
+        identifier(resource_id),
+        _search_index_name(resource_id, search_expression(chromo))).scalar())
+
+
+def update_search_indexes(connection, dry_run=False):
+    """
+    Create the trigram indexes used by datatable searches on the
+    search_expression of every PD DataStore table, and drop the indexes
+    created for earlier expressions or left invalid by a failed build.
+
+    Indexes are created and dropped CONCURRENTLY so the PD tables stay
+    writable, connection must be in autocommit mode.
+
+    :param connection: DataStore write engine connection in autocommit mode
+    :param dry_run: only count the changes
+    :returns: (indexes created, indexes dropped) or None when the pg_trgm
+        extension is not installed
+    """
+    from ckanext.canada.dataset import dataset_resources
+
+    if not connection.execute(
+            u"SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").scalar():
+        return None
+    created = dropped = 0
+    for dataset_type in get_dataset_types():
+        expressions = dict(
+            (chromo['resource_name'], search_expression(chromo))
+            for chromo in get_geno(dataset_type)['resources'])
+        for datasets in dataset_resources(dataset_type).values():
+            for dataset in datasets:
+                for resource_id, resource_name in dataset:
+                    expression = expressions.get(resource_name)
+                    if not expression or not connection.execute(
+                            u'SELECT to_regclass(%s)',
+                            identifier(resource_id)).scalar():
+                        continue
+                    prefix = resource_id + SEARCH_INDEX_SUFFIX
+                    name = _search_index_name(resource_id, expression)
+                    existing = dict(connection.execute(
+                        u'SELECT c.relname, i.indisvalid FROM pg_index i '
+                        u'JOIN pg_class c ON c.oid = i.indexrelid '
+                        u'WHERE i.indrelid = to_regclass(%s) '
+                        u'AND position(%s in c.relname) = 1',
+                        identifier(resource_id), prefix).fetchall())
+                    for old, valid in sorted(existing.items()):
+                        if old == name and valid:
+                            continue
+                        dropped += 1
+                        if not dry_run:
+                            connection.execute(
+                                u'DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(
+                                    identifier(old)))
+                    if existing.get(name):
+                        continue
+                    created += 1
+                    if not dry_run:
+                        connection.execute(
+                            u'CREATE INDEX CONCURRENTLY {name} ON {table} '
+                            u'USING gin (({expression}) gin_trgm_ops)'.format(
+                                name=identifier(name),
+                                table=identifier(resource_id),
+                                expression=expression))
+    return created, dropped
+
+
+def _choice_set_rows():
+    """
+    generates (set name, choice, position) for the choice fields of all
+    PD resources
+    """
+    for dataset_type in get_dataset_types():
+        for chromo in get_geno(dataset_type)['resources']:
+            resource_name = chromo['resource_name']
+            choice_fields = recombinant_choice_fields(resource_name)
+            for datastore_id, choices in sorted(choice_fields.items()):
+                set_name = resource_name + u'.' + datastore_id
+                seen = set()
+                for position, (choice, label) in enumerate(choices):
+                    if choice in seen:
+                        continue
+                    seen.add(choice)
+                    yield set_name, choice, position
+
+
+def update_triggers(dry_run=False):
+    """
+    Create/update the functions used by PD table triggers and the choice
+    set table in a single transaction. Only the functions with changed
+    definitions are replaced and the error checks of PD table trigger
+    functions created before they were grouped are grouped. The datatable search indexes are updated
+    after that transaction, without locking the PD tables.
+
+    :param dry_run: only report the changes
+    :returns: list of (function or table name, change) where change is
+        u'new', u'changed' or u'unchanged' for functions, followed by the
+        choice set, table trigger function and search index changes
+    """
+    functions = trigger_functions()
+    report = []
+    with get_write_engine().connect() as connection:
+        trans = connection.begin()
+        try:
+            digests = _function_digests(
+                connection, set(f['name'] for f in functions))
+            names = set(name for name, comment, src in digests)
+            for f in functions:
+                sql, args, digest = _function_sql(f)
+                label = u'{0}({1})'.format(f['name'], u', '.join(
+                    a['argtype'] for a in f.get('arguments', [])
+                    if a.get('argmode', u'in') != u'out'))
+                src_digest = hashlib.md5(
+                    f['definition'].encode('utf-8')).hexdigest()
+                if (f['name'], digest, src_digest) in digests:
+                    report.append((label, u'unchanged'))
+                    continue
+                report.append(
+                    (label, u'changed' if f['name'] in names else u'new'))
+                if dry_run:
+                    continue
+                # no special meaning for '%' in function definitions
+                connection.execution_options(no_parameters=True).execute(sql)
+                connection.execute(
+                    u'COMMENT ON FUNCTION {name}({args}) IS {digest}'.format(
+                        name=identifier(f['name']),
+                        args=args,
+                        digest=literal_string(digest)))
+
+            added, removed = update_choice_sets(connection, dry_run)
+            report.append((CHOICE_SET_TABLE,
+                u'{0} choices added, {1} removed'.format(added, removed)))
+
+            grouped = update_table_trigger_functions(connection, dry_run)
+            report.append((u'table trigger functions',
+                u'{0} grouped'.format(grouped)))
+        except Exception:
+            trans.rollback()
+            raise
+        if dry_run:
+            trans.rollback()
+        else:
+            trans.commit()
+
+    if asbool(config.get('ckanext.canada.datatable_trigram_search', False)):
+        # CONCURRENTLY can't run in a transaction
+        with get_write_engine().connect().execution_options(
+                isolation_level='AUTOCOMMIT') as connection:
+            indexes = update_search_indexes(connection, dry_run)
+        report.append((u'datatable search indexes',
+            u'pg_trgm extension not installed' if indexes is None
+            else u'{0} created, {1} dropped'.format(*indexes)))
+    return report
+
+
+def _function_sql(f):
+    """
+    Return (CREATE OR REPLACE FUNCTION statement, argument list, digest
+    of the statement) for a function definition from trigger_functions
+    """
+    args = u', '.join(
+        u'{argmode} {argname} {argtype}'.format(
+            argmode=u'OUT' if a.get('argmode') == u'out' else u'IN',
+            argname=identifier(a['argname']),
+            argtype=identifier(a['argtype']))
+        for a in f.get('arguments', []))
+    sql = (
+        u'CREATE OR REPLACE FUNCTION {name}({args}) RETURNS {rettype} '
+        u'LANGUAGE {language} {volatility} AS {definition}'.format(
+            name=identifier(f['name']),
+            args=args,
+            rettype=identifier(f['rettype']),
+            language=f.get('language', u'plpgsql'),
+            volatility=f.get('volatility', u'VOLATILE'),
+            definition=literal_string(f['definition'])))
+    digest = FUNCTION_DIGEST_PREFIX + hashlib.md5(
+        sql.encode('utf-8')).hexdigest()
+    return sql, args, digest
+
+
+def _function_digests(connection, names):
+    """
+    Return set of (name, comment, md5 of the source) of the existing
+    functions with names
+    """
+    return set(tuple(r) for r in connection.execute(
+        u"SELECT p.proname::text, obj_description(p.oid, 'pg_proc'), "
+        u'md5(p.prosrc) FROM pg_proc p '
+        u'JOIN pg_namespace n ON n.oid = p.pronamespace '
+        u'WHERE n.nspname = current_schema() AND p.proname = ANY(%s)',
+        sorted(names)))
+
+
+def trigger_functions():
+    """
+    Return the definitions of the functions used by PD table triggers
+    as dicts with name, arguments, rettype, definition and optional
+    language and volatility
+    """
     # *_error functions return NULL or ARRAY[[field_name, error_message]]
-    lc.action.datastore_function_create(
-        name=u'required_error',
-        or_replace=True,
-        arguments=[
-            {u'argname': u'value', u'argtype': u'text'},
-            {u'argname': u'field_name', u'argtype': u'text'}],
-        rettype=u'_text',
-        definition=u'''
-            BEGIN
-                IF (value = '') IS NOT FALSE THEN
-                    RETURN ARRAY[[field_name, 'This field must not be empty']];
-                END IF;
-                RETURN NULL;
-            END;
-        ''')
-    lc.action.datastore_function_create(
-        name=u'required_error',
-        or_replace=True,
-        arguments=[
-            {u'argname': u'value', u'argtype': u'_text'},
-            {u'argname': u'field_name', u'argtype': u'text'}],
-        rettype=u'_text',
-        definition=u'''
-            BEGIN
-                IF value IS NULL OR value = '{}' THEN
-                    return ARRAY[[field_name, 'This field must not be empty']];
-                END IF;
-                RETURN NULL;
-            END;
-        ''')
-    lc.action.datastore_function_create(
-        name=u'required_error',
-        or_replace=True,
-        arguments=[
-            {u'argname': u'value', u'argtype': u'date'},
-            {u'argname': u'field_name', u'argtype': u'text'}],
-        rettype=u'_text',
-        definition=u'''
-            BEGIN
-                IF value IS NULL THEN
-                    RETURN ARRAY[[field_name, 'This field must not be empty']];
-                END IF;
-                RETURN NULL;
-            END;
-        ''')
-    lc.action.datastore_function_create(
-        name=u'required_error',
-        or_replace=True,
-        arguments=[
-            {u'argname': u'value', u'argtype': u'numeric'},
-            {u'argname': u'field_name', u'argtype': u'text'}],
-        rettype=u'_text',
-        definition=u'''
-            BEGIN
-                IF value IS NULL THEN
-                    RETURN ARRAY[[field_name, 'This field must not be empty']];
-                END IF;
-                RETURN NULL;
-            END;
-        ''')
-    lc.action.datastore_function_create(
-        name=u'required_error',
-        or_replace=True,
-        arguments=[
-            {u'argname': u'value', u'argtype': u'int4'},
-            {u'argname': u'field_name', u'argtype': u'text'}],
-        rettype=u'_text',
-        definition=u'''
-            BEGIN
-                IF value IS NULL THEN
-                    RETURN ARRAY[[field_name, 'This field must not be empty']];
-                END IF;
-                RETURN NULL;
-            END;
-        ''')
-    lc.action.datastore_function_create(
-        name=u'required_error',
-        or_replace=True,
-        arguments=[
-            {u'argname': u'value', u'argtype': u'money'},
-            {u'argname': u'field_name', u'argtype': u'text'}],
-        rettype=u'_text',
-        definition=u'''
-            BEGIN
-                IF value IS NULL THEN
-                    RETURN ARRAY[[field_name, 'This field must not be empty']];
-                END IF;
-                RETURN NULL;
-            END;
-        ''')
-    lc.action.datastore_function_create(
-        name=u'choice_error',
-        or_replace=True,
+    functions = [
+        dict(
+            name=name,
+            arguments=[
+                {u'argname': n, u'argtype': t} for n, t in arguments],
+            rettype=u'_text',
+            definition=u'SELECT ' + expression,
+            language=u'sql',
+            volatility=u'IMMUTABLE')
+        for name, arguments, expression in INLINE_ERROR_FUNCTIONS]
+
+    # same as choice_error but with the choices looked up by
+    # '<resource_name>.<datastore_id>' in the choice set table
+    functions.append(dict(
+        name=u'choice_set_error',
         arguments=[
             {u'argname': u'value', u'argtype': u'text'},
-            {u'argname': u'choices', u'argtype': u'_text'},
+            {u'argname': u'choice_set', u'argtype': u'text'},
             {u'argname': u'field_name', u'argtype': u'text'}],
         rettype=u'_text',
         definition=r'''
             BEGIN
-                IF value IS NOT NULL AND value <> '' AND NOT (value = ANY (choices)) THEN
-                    -- \t is used when converting errors to string
-                    RETURN ARRAY[[field_name, 'Invalid choice: "'
-                        || replace(value, E'\t', ' ') || '"']];
+                IF value IS NULL OR value = '' OR EXISTS (
+                        SELECT 1 FROM canada_choice_set s
+                        WHERE s.set_name = choice_set AND s.choice = value) THEN
+                    RETURN NULL;
                 END IF;
-                RETURN NULL;
+                -- \t is used when converting errors to string
+                RETURN ARRAY[[field_name, 'Invalid choice: "'
+                    || replace(value, E'\t', ' ') || '"']];
             END;
-        ''')
+        '''))
+
     # return record with .clean (normalized value) and .error
     # (NULL or ARRAY[[field_name, error_message]])
-    lc.action.datastore_function_create(
+    functions.append(dict(
         name=u'choices_clean_error',
-        or_replace=True,
         arguments=[
             {u'argname': u'value', u'argtype': u'_text'},
             {u'argname': u'choices', u'argtype': u'_text'},
@@ -143,43 +618,41 @@ def update_triggers():
                     SELECT c FROM(SELECT unnest(choices) as c) u
                     WHERE c = ANY(value));
             END;
-        ''')
+        '''))
 
-    lc.action.datastore_function_create(
-        name=u'must_be_empty_error',
-        or_replace=True,
+    # same as choices_clean_error but with the choices looked up by
+    # '<resource_name>.<datastore_id>' in the choice set table
+    functions.append(dict(
+        name=u'choice_set_clean_error',
         arguments=[
-            {u'argname': u'value', u'argtype': u'numeric'},
-            {u'argname': u'field_name', u'argtype': u'text'}],
-        rettype=u'_text',
-        definition=u'''
-            BEGIN
-                IF value IS NOT NULL THEN
-                    RETURN ARRAY[[field_name, 'This field must be empty']];
-                END IF;
-                RETURN NULL;
-            END;
-        ''')
-
-    lc.action.datastore_function_create(
-        name=u'no_surrounding_whitespace_error',
-        or_replace=True,
-        arguments=[
-            {u'argname': u'value', u'argtype': u'text'},
-            {u'argname': u'field_name', u'argtype': u'text'}],
-        rettype=u'_text',
-        definition=u'''
+            {u'argname': u'value', u'argtype': u'_text'},
+            {u'argname': u'choice_set', u'argtype': u'text'},
+            {u'argname': u'field_name', u'argtype': u'text'},
+            {u'argname': u'clean', u'argtype': u'_text', u'argmode': u'out'},
+            {u'argname': u'error', u'argtype': u'_text', u'argmode': u'out'}],
+        rettype=u'record',
+        definition=r'''
+            DECLARE
+                bad_choices text := array_to_string(ARRAY(
+                    SELECT c FROM(SELECT unnest(value) as c) u
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM canada_choice_set s
+                        WHERE s.set_name = choice_set AND s.choice = c)), ',');
             BEGIN
-                IF trim(both E'\t\n\x0b\x0c\r ' from value) <> value THEN
-                    RETURN ARRAY[[field_name, 'This field must not have surrounding whitespace']];
+                IF bad_choices <> '' THEN
+                    -- \t is used when converting errors to string
+                    error := ARRAY[[field_name, 'Invalid choice: "'
+                        || replace(bad_choices, E'\t', ' ') || '"']];
                 END IF;
-                RETURN NULL;
+                clean := ARRAY(
+                    SELECT s.choice FROM canada_choice_set s
+                    WHERE s.set_name = choice_set AND s.choice = ANY(value)
+                    ORDER BY s.position);
             END;
-        ''')
+        '''))
 
-    lc.action.datastore_function_create(
+    functions.append(dict(
         name=u'year_optional_month_day_error',
-        or_replace=True,
         arguments=[
             {u'argname': u'value', u'argtype': u'text'},
             {u'argname': u'field_name', u'argtype': u'text'}],
@@ -202,11 +675,10 @@ def update_triggers():
                 WHEN others THEN
                     RETURN ARRAY[[field_name, 'Dates must be in YYYY-MM-DD format']];
             END;
-        ''')
+        '''))
 
-    lc.action.datastore_function_create(
+    functions.append(dict(
         name=u'choices_from',
-        or_replace=True,
         arguments=[
             {u'argname': u'value', u'argtype': u'_text'},
             {u'argname': u'choices', u'argtype': u'_text'},
@@ -225,7 +697,7 @@ def update_triggers():
                     SELECT c FROM(SELECT unnest(choices) as c) u
                     WHERE c = ANY(value));
             END;
-        ''')
+        '''))
 
     # A: When sysadmin passes '*' as user_modified, replace with '' and
     #    set created+modified values to NULL. This is used when restoring
@@ -235,19 +707,43 @@ def update_triggers():
     #    or the modified user.
     # C: Otherwise update created+modified dates and replace user with
     #    current user
-    lc.action.datastore_function_create(
+    # D: In a sysadmin bulk load (see datastore_create_temp_user_table)
+    #    keep the values given and only fill in missing ones, without
+    #    comparing updated rows to the existing rows
+    functions.append(dict(
         name=u'update_record_modified_created_trigger',
-        or_replace=True,
         rettype=u'trigger',
         definition=u'''
             DECLARE
                 req_record_modified timestamp := NEW.record_modified;
                 req_user_modified text := NEW.user_modified;
-                username text NOT NULL := (SELECT username
-                    FROM datastore_user);
-                sysadmin boolean NOT NULL := (SELECT sysadmin
-                    FROM datastore_user);
+                username text;
+                sysadmin boolean;
+                bulk_load boolean;
             BEGIN
+                SELECT u.username, u.sysadmin, u.bulk_load
+                    INTO STRICT username, sysadmin, bulk_load
+                    FROM datastore_user u;
+                IF bulk_load THEN
+                    IF req_user_modified = '*' THEN
+                        NEW.user_modified := '';
+                        NEW.record_created := NULL;
+                        NEW.record_modified := NULL;
+                        RETURN NEW;
+                    END IF;
+                    IF TG_OP = 'UPDATE' THEN
+                        IF NEW.record_created IS NULL THEN
+                            NEW.record_created := OLD.record_created;
+                        END IF;
+                        IF NEW.record_modified IS NULL THEN
+                            NEW.record_modified := OLD.record_modified;
+                        END IF;
+                        IF (req_user_modified = '') IS NOT FALSE THEN
+                            NEW.user_modified := OLD.user_modified;
+                        END IF;
+                        RETURN NEW;
+                    END IF;
+                END IF;
                 IF NOT sysadmin THEN
                     NEW.record_created := NULL;
                     req_record_modified := NULL;
@@ -306,12 +802,11 @@ def update_triggers():
                 END IF;
                 RETURN NEW;
             END;
-            ''')
+            '''))
 
     inventory_choices = h.recombinant_choice_fields('inventory')
-    lc.action.datastore_function_create(
+    functions.append(dict(
         name=u'inventory_trigger',
-        or_replace=True,
         rettype=u'trigger',
         definition=u'''
             DECLARE
@@ -342,11 +837,10 @@ def update_triggers():
                 RAISE EXCEPTION E'TAB-DELIMITED\t%', array_to_string(errors, E'\t');
             END;
             ''',
-        )
+        ))
 
-    lc.action.datastore_function_create(
+    functions.append(dict(
         name=u'protect_user_votes_trigger',
-        or_replace=True,
         rettype=u'trigger',
         definition=u'''
             DECLARE
@@ -369,11 +863,10 @@ def update_triggers():
                 END IF;
                 RETURN NEW;
             END;
-            ''')
+            '''))
 
-    lc.action.datastore_function_create(
+    functions.append(dict(
         name=u'truthy_to_yn',
-        or_replace=True,
         arguments=[{u'argname': u'value', u'argtype': u'text'}],
         rettype=u'text',
         definition=u'''
@@ -391,41 +884,121 @@ def update_triggers():
                     RETURN NULL;
                 END IF;
             END;
-            ''')
+            '''))
 
-    lc.action.datastore_function_create(
-        name=u'integer_or_na_nd_error',
-        or_replace=True,
-        arguments=[
-            {u'argname': u'value', u'argtype': u'text'},
-            {u'argname': u'field_name', u'argtype': u'text'}],
-        rettype=u'_text',
-        definition=u'''
-            BEGIN
-                IF value <> 'NA' AND value <> 'ND' AND NOT value ~ '^[0-9]+$' THEN
-                    RETURN ARRAY[[field_name, 'This field must be NA or an integer']];
-                END IF;
-                RETURN NULL;
-            END;
-        ''')
+    return functions
 
-    lc.action.datastore_function_create(
-        name=u'both_languages_error',
-        or_replace=True,
-        arguments=[
-            {u'argname': u'value_en', u'argtype': u'text'},
-            {u'argname': u'field_name_en', u'argtype': u'text'},
-            {u'argname': u'value_fr', u'argtype': u'text'},
-            {u'argname': u'field_name_fr', u'argtype': u'text'}],
-        rettype=u'_text',
-        definition=u'''
-            BEGIN
-                IF (value_en = '') IS NOT FALSE AND NOT((value_fr = '') IS NOT FALSE) THEN
-                  RETURN ARRAY[[field_name_en, 'This text must be provided in both languages']];
-                END IF;
-                IF (value_fr = '') IS NOT FALSE AND NOT((value_en = '') IS NOT FALSE) THEN
-                  RETURN ARRAY[[field_name_fr, 'This text must be provided in both languages']];
-                END IF;
-                RETURN NULL;
-            END;
-        ''')
+
+def benchmark_triggers(chromos, rows=1000):
+    """
+    Time DataStore upserts of rows synthetic records into a scratch
+    table of each chromo: without triggers, with the chromo's trigger
+    functions as written and with their error checks grouped. The
+    scratch table, records and function versions only exist in a
+    transaction that is rolled back.
+
+    :param chromos: recombinant chromos to benchmark
+    :param rows: number of records upserted
+
+    generates (resource_name, rows/second without triggers,
+        rows/second as written, rows/second grouped, error message)
+        with None for the timings that could not be measured
+    """
+    engine = get_write_engine()
+    for chromo in chromos:
+        trigger_names = [
+            list(t)[0] if isinstance(t, dict) else t
+            for t in chromo.get('triggers', [])]
+        records = _benchmark_records(chromo, rows)
+
+        with engine.connect() as connection:
+            trans = connection.begin()
+            try:
+                sources = {}
+                for name in _table_trigger_names(chromo):
+                    sources[name] = _trigger_function_source(connection, name)
+                missing = [n for n, src in sources.items() if src is None]
+                if missing:
+                    yield (chromo['resource_name'], None, None, None,
+                           u'no trigger function ' + u', '.join(missing))
+                    continue
+
+                context = {u'connection': connection}
+                table = _create_benchmark_table(context, chromo)
+                base = _time_upsert(context, table, records)
+
+                for i, name in enumerate(trigger_names):
+                    connection.execute(
+                        u'CREATE TRIGGER {t} BEFORE INSERT OR UPDATE '
+                        u'ON {table} FOR EACH ROW '
+                        u'EXECUTE PROCEDURE {name}()'.format(
+                            t=identifier(u'benchmark_trigger_%d' % i),
+                            table=identifier(table),
+                            name=identifier(name)))
+                timings = []
+                error = None
+                for version in (0, 1):
+                    for name, src in sources.items():
+                        create_trigger_function(connection, name, src[version])
+                    try:
+                        timings.append(_time_upsert(context, table, records))
+                    except Exception as e:
+                        timings.append(None)
+                        error = str(getattr(e, 'orig', e)).strip().split('\n')[0]
+                yield (chromo['resource_name'], base, timings[0], timings[1],
+                       error)
+            finally:
+                trans.rollback()
+
+
+def _benchmark_records(chromo, rows):
+    """
+    Return rows copies of the example record of chromo with different
+    values for its integer primary key fields
+    """
+    pk = chromo['datastore_primary_key']
+    if not isinstance(pk, list):
+        pk = [pk]
+    int_pk = [
+        f['datastore_id'] for f in chromo['fields']
+        if f['datastore_id'] in pk and f['datastore_type'] == 'int']
+    record = chromo['examples']['record']
+    return [
+        dict(record, **dict((k, n) for k in int_pk))
+        for n in range(1, rows + 1)]
+
+
+def _create_benchmark_table(context, chromo):
+    """
+    Create a DataStore table for chromo without triggers or indexes,
+    returns its name
+    """
+    table = u'benchmark_' + chromo['resource_name']
+    datastore.create_table(context, {
+        u'resource_id': table,
+        u'fields': [
+            {u'id': f['datastore_id'], u'type': f['datastore_type']}
+            for f in chromo['fields']]})
+    # normally created by datastore_upsert, used by some triggers
+    context['connection'].execute(
+        u'CREATE TEMP TABLE IF NOT EXISTS datastore_user ('
+        u'username text NOT NULL, sysadmin boolean NOT NULL, '
+        u'bulk_load boolean NOT NULL) ON COMMIT DROP')
+    context['connection'].execute(
+        u"INSERT INTO datastore_user VALUES ('benchmark', true, false)")
+    return table
+
+
+def _time_upsert(context, table, records):
+    """
+    Return the rows/second for inserting records with the DataStore
+    upsert of datastore_upsert, the records are rolled back
+    """
+    savepoint = context['connection'].begin_nested()
+    try:
+        start = time.time()
+        datastore.upsert_data(context, {
+            u'resource_id': table, u'records': records, u'method': u'insert'})
+        return len(records) / (time.time() - start)
+    finally:
+        savepoint.rollback()
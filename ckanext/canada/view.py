@@ -1,5 +1,9 @@
+import base64
 import json
 import decimal
+import time
+import threading
+from collections import OrderedDict
 from pytz import timezone, utc
 from socket import error as socket_error
 from logging import getLogger
@@ -16,6 +20,7 @@ from ckan.plugins.toolkit import (
     config,
     check_access,
     aslist,
+    asbool,
     request,
     render
 )
@@ -66,6 +71,8 @@ from flask import Blueprint, make_response
 
 from ckanext.canada.urlsafe import url_part_unescape, url_part_escape
 from ckanext.canada.helpers import canada_date_str_to_datetime
+from ckanext.canada.triggers import (
+    search_fields, search_expression, search_index_valid)
 
 from io import StringIO
 
@@ -751,6 +758,7 @@ def view_help():
 
 @canada_views.route('/datatable/<resource_name>/<resource_id>', methods=['GET', 'POST'])
 def datatable(resource_name, resource_id):
+    start_time = time.time()
     params = parse_params(request.form)
     draw = int(params['draw'])
     search_text = str(params['search[value]'])
@@ -759,26 +767,13 @@ def datatable(resource_name, resource_id):
 
     chromo = h.recombinant_get_chromo(resource_name)
     lc = LocalCKAN(username=g.user)
-    try:
-        unfiltered_response = lc.action.datastore_search(
-            resource_id=resource_id,
-            limit=1,
-        )
-    except NotAuthorized:
-        # datatables js can't handle any sort of error response
-        # return no records instead
-        return json.dumps({
-            'draw': draw,
-            'iTotalRecords': -1,  # with a hint that something is wrong
-            'iTotalDisplayRecords': -1,
-            'aaData': [],
-        })
 
     can_edit = h.check_access('resource_update', {'id': resource_id})
     cols = [f['datastore_id'] for f in chromo['fields']]
     prefix_cols = 2 if chromo.get('edit_form', False) and can_edit else 1  # Select | (Edit) | ...
 
     sort_list = []
+    sort_fields = []
     i = 0
     while True:
         if u'order[%d][column]' % i not in params:
@@ -787,16 +782,85 @@ def datatable(resource_name, resource_id):
         sort_order = (
             u'desc' if params[u'order[%d][dir]' % i] == u'desc'
             else u'asc')
+        sort_fields.append((cols[sort_by_num - prefix_cols], sort_order))
         sort_list.append(cols[sort_by_num - prefix_cols] + u' ' + sort_order + u' nulls last')
         i += 1
 
-    response = lc.action.datastore_search(
-        q=search_text,
-        resource_id=resource_id,
-        offset=offset,
-        limit=limit,
-        sort=u', '.join(sort_list),
-    )
+    seek_key = _datatable_seek_key(chromo, sort_fields)
+    if seek_key:
+        # unique sort order so offset and seek pages match
+        key_columns, key_order = seek_key
+        for c in key_columns[len(sort_fields):]:
+            sort_fields.append((c, key_order))
+            sort_list.append(c + u' ' + key_order + u' nulls last')
+
+    # read before searching so a cached total is never newer than its state
+    table_state = _datatable_table_state(resource_id)
+    cursor_values = None
+    if seek_key and table_state and offset and not search_text:
+        cursor_values = _datatable_cursor_values(params.get('cursor'), seek_key)
+    try:
+        if cursor_values is not None:
+            # same access check as datastore_search
+            check_access('datastore_search', {'user': g.user},
+                         {'resource_id': resource_id})
+            response = {'records': _datatable_seek(
+                resource_id, seek_key, cursor_values,
+                params.get('direction') == u'prev', limit)}
+        else:
+            response = None
+            if search_text and table_state and search_fields(chromo) and asbool(
+                    config.get('ckanext.canada.datatable_trigram_search',
+                               False)):
+                check_access('datastore_search', {'user': g.user},
+                             {'resource_id': resource_id})
+                response = _datatable_search(
+                    resource_id, chromo, search_text, sort_fields,
+                    offset, limit)
+            if response is None:
+                response = lc.action.datastore_search(
+                    q=search_text,
+                    resource_id=resource_id,
+                    offset=offset,
+                    limit=limit,
+                    sort=u', '.join(sort_list),
+                )
+    except NotAuthorized:
+        # datatables js can't handle any sort of error response
+        # return no records instead
+        return json.dumps({
+            'draw': draw,
+            'iTotalRecords': -1,  # with a hint that something is wrong
+            'iTotalDisplayRecords': -1,
+            'aaData': [],
+        })
+
+    if cursor_values is None and not search_text:
+        total_records = response.get('total', 0)
+        if table_state:
+            _datatable_totals.set(resource_id, (table_state, total_records))
+    else:
+        cached = _datatable_totals.get(resource_id)
+        if table_state and cached and cached[0] == table_state:
+            total_records = cached[1]
+        else:
+            total_records = lc.action.datastore_search(
+                resource_id=resource_id,
+                limit=0,
+            ).get('total', 0)
+            if table_state:
+                _datatable_totals.set(resource_id, (table_state, total_records))
+
+    display_records = (
+        total_records if cursor_values is not None
+        else response.get('total', 0))
+
+    cursors = {}
+    if seek_key and response['records']:
+        cursors = {
+            'cursor_prev': _datatable_cursor(seek_key, response['records'][0]),
+            'cursor_next': _datatable_cursor(seek_key, response['records'][-1]),
+        }
 
     aadata = [
         [u'<input type="checkbox">'] +
@@ -804,8 +868,7 @@ def datatable(resource_name, resource_id):
         for row in response['records']]
 
     if chromo.get('edit_form', False) and can_edit:
-        res = lc.action.resource_show(id=resource_id)
-        pkg = lc.action.package_show(id=res['package_id'])
+        owner_org = _datatable_owner_org(lc, resource_id)
         fids = [f['datastore_id'] for f in chromo['fields']]
         pkids = [fids.index(k) for k in aslist(chromo['datastore_primary_key'])]
         for row in aadata:
@@ -814,19 +877,196 @@ def datatable(resource_name, resource_id):
                     u'<i class="fa fa-lg fa-edit" aria-hidden="true"></i></a>').format(
                     h.url_for(
                         'canada.update_pd_record',
-                        owner_org=pkg['organization']['name'],
+                        owner_org=owner_org,
                         resource_name=resource_name,
                         pk=','.join(url_part_escape(row[i+1]) for i in pkids)
                     )
                 )
             )
 
-    return json.dumps({
+    log.debug('datatable %s draw=%d start=%d length=%d search=%s seek=%s %.3fs',
+              resource_id, draw, offset, limit, bool(search_text),
+              cursor_values is not None, time.time() - start_time)
+    return json.dumps(dict({
         'draw': draw,
-        'iTotalRecords': unfiltered_response.get('total', 0),
-        'iTotalDisplayRecords': response.get('total', 0),
+        'iTotalRecords': total_records,
+        'iTotalDisplayRecords': display_records,
         'aaData': aadata,
-    })
+    }, **cursors))
+
+
+class _ExpiringCache(object):
+    """
+    Cache of at most size values that expire seconds after they were
+    set, the least recently set values are removed first
+    """
+    def __init__(self, size, seconds):
+        self.size = size
+        self.seconds = seconds
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            expires, value = self._values.get(key, (None, None))
+            if expires is not None and expires < time.time():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._values.pop(key, None)
+            self._values[key] = (time.time() + self.seconds, value)
+            while len(self._values) > self.size:
+                self._values.popitem(last=False)
+
+
+# resource_id: (table state, total records) from the last datatable draw
+# that counted the whole table. The table state counters are updated
+# asynchronously (and not at all on a hot standby) so totals also expire
+_datatable_totals = _ExpiringCache(1000, 60)
+
+# resource_id: owner organization name for datatable edit links
+_datatable_resource_orgs = _ExpiringCache(1000, 600)
+
+
+def _datatable_table_state(resource_id):
+    """
+    Return the inserted and deleted row counters of the resource_id
+    DataStore table, which change soon after its total number of records
+    might have changed, or None if not available
+    """
+    from ckanext.datastore.backend.postgres import get_read_engine, identifier
+    row = get_read_engine().execute(
+        u'SELECT n_tup_ins, n_tup_del FROM pg_stat_user_tables '
+        u'WHERE relid = to_regclass(%s)',
+        identifier(resource_id)).first()
+    return tuple(row) if row else None
+
+
+def _datatable_seek_key(chromo, sort_fields):
+    """
+    Return (key columns, u'asc' or u'desc') for seek pagination of a
+    datatable sorted by sort_fields, or None when the sort order can't be
+    used: the sort columns must all be primary key columns sorted in the
+    same direction. The remaining primary key columns are added to the
+    key to make it unique.
+    """
+    pk = aslist(chromo['datastore_primary_key'])
+    orders = set(o for c, o in sort_fields)
+    if len(orders) != 1 or any(c not in pk for c, o in sort_fields):
+        return None
+    columns = [c for c, o in sort_fields]
+    return columns + [c for c in pk if c not in columns], orders.pop()
+
+
+def _datatable_cursor(seek_key, record):
+    """
+    Return an opaque cursor for the seek key values of record
+    """
+    key_columns, key_order = seek_key
+    return base64.urlsafe_b64encode(json.dumps(
+        [key_columns, key_order, [record.get(c) for c in key_columns]],
+        default=str).encode('utf-8')).decode('ascii')
+
+
+def _datatable_cursor_values(cursor, seek_key):
+    """
+    Return the key values from cursor, or None if it is missing, invalid
+    or was created for a different sort order
+    """
+    if not cursor:
+        return None
+    try:
+        key_columns, key_order, values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if [key_columns, key_order] != list(seek_key) or \
+            not isinstance(values, list) or len(values) != len(key_columns):
+        return None
+    return values
+
+
+def _datatable_seek(resource_id, seek_key, values, backward, limit):
+    """
+    Return up to limit records of the resource_id DataStore table that
+    follow (or precede, when backward) the seek key values, in the same
+    format and order as datastore_search
+    """
+    from ckanext.datastore.backend.postgres import get_read_engine, identifier
+    key_columns, key_order = seek_key
+    forward = (key_order == u'asc') != backward
+    sql = (
+        u"SELECT (to_jsonb(t) - '_full_text')::text FROM {table} t "
+        u'WHERE ({columns}) {op} ({values}) '
+        u'ORDER BY {order} LIMIT %s'.format(
+            table=identifier(resource_id),
+            columns=u', '.join(identifier(c) for c in key_columns),
+            op=u'>' if forward else u'<',
+            values=u', '.join([u'%s'] * len(values)),
+            order=u', '.join(
+                identifier(c) + (u' asc' if forward else u' desc')
+                for c in key_columns)))
+    records = [
+        json.loads(row[0], parse_float=decimal.Decimal)
+        for row in get_read_engine().execute(sql, *(values + [limit]))]
+    if backward:
+        records.reverse()
+    return records
+
+
+def _datatable_search(resource_id, chromo, search_text, sort_fields,
+                      offset, limit):
+    """
+    Return {'records': ..., 'total': ...} like datastore_search for the
+    records of the resource_id DataStore table with search_text in their
+    search_fields, using the trigram index created by update-triggers.
+
+    Return None when the table has no valid index for the current
+    search_fields yet (e.g. tables created since update-triggers last ran)
+    so the caller falls back to datastore_search instead of a full scan.
+    """
+    from ckanext.datastore.backend.postgres import get_read_engine, identifier
+    pattern = u'%{0}%'.format(
+        search_text.replace(u'\\', u'\\\\')
+        .replace(u'%', u'\\%').replace(u'_', u'\\_'))
+    where = u'({0}) ILIKE %s'.format(search_expression(chromo))
+    table = identifier(resource_id)
+    order = u', '.join(
+        identifier(c) + u' ' + o + u' nulls last' for c, o in sort_fields
+    ) or u'_id'
+
+    with get_read_engine().connect() as connection:
+        if not search_index_valid(connection, resource_id, chromo):
+            return None
+        total = connection.execute(
+            u'SELECT count(*) FROM {table} WHERE {where}'.format(
+                table=table, where=where),
+            pattern).scalar()
+        records = [
+            json.loads(row[0], parse_float=decimal.Decimal)
+            for row in connection.execute(
+                u"SELECT (to_jsonb(t) - '_full_text')::text FROM {table} t "
+                u'WHERE {where} ORDER BY {order} '
+                u'OFFSET %s LIMIT %s'.format(
+                    table=table, where=where, order=order),
+                pattern, offset, limit)]
+    return {'records': records, 'total': total}
+
+
+def _datatable_owner_org(lc, resource_id):
+    """
+    Return the owner organization name of resource_id, cached
+    """
+    owner_org = _datatable_resource_orgs.get(resource_id)
+    if owner_org is None:
+        res = lc.action.resource_show(id=resource_id)
+        pkg = lc.action.package_show(id=res['package_id'])
+        owner_org = pkg['organization']['name']
+        _datatable_resource_orgs.set(resource_id, owner_org)
+    return owner_org
 
 
 def datatablify(v, colname):